@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""AsyncWebDAVClient对本地WebDAV服务器（webdav_local_server）的测试"""
+
+import asyncio
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import webdav_backup
+import webdav_local_server
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = webdav_local_server.start(str(tmp_path / "dav"))
+    # 统计服务器接受的TCP连接数
+    server.connections = 0
+    process_request = server.process_request
+
+    def counting_process_request(request, client_address):
+        server.connections += 1
+        process_request(request, client_address)
+
+    server.process_request = counting_process_request
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run_client(test, **kwargs):
+    """在新的事件循环中创建客户端并执行test(client)，结束后关闭客户端"""
+    async def main():
+        client = webdav_backup.AsyncWebDAVClient("user", "pass", http2=False, **kwargs)
+        client.retry_policy = webdav_backup.RetryPolicy(backoff=0)
+        try:
+            return await test(client)
+        finally:
+            await client.close()
+    return asyncio.run(main())
+
+
+def test_put_head_get_delete(server):
+    async def test(client):
+        url = f"{server.url}/a.txt"
+        assert await client.put(url, b"hello") == 201
+        assert await client.put(url, b"hello world") == 204
+        response = await client.head(url)
+        assert response.status_code == 200
+        assert response.headers["Content-Length"] == "11"
+        assert response.content == b""
+        response = await client.get(url)
+        assert response.status_code == 200
+        assert response.content == b"hello world"
+        assert await client.delete(url) == 204
+        assert (await client.get(url)).status_code == 404
+        assert await client.delete(url) == 404
+    run_client(test)
+
+
+def test_mkcol(server):
+    async def test(client):
+        assert await client.mkcol(f"{server.url}/backups/") == 201
+        assert await client.mkcol(f"{server.url}/backups/") == 405
+        assert await client.mkcol(f"{server.url}/missing/child/") == 409
+    run_client(test)
+
+
+def test_propfind(server):
+    async def test(client):
+        await client.mkcol(f"{server.url}/backups/")
+        await client.mkcol(f"{server.url}/backups/sub/")
+        await client.put(f"{server.url}/backups/backup 1.tar.gz", b"x" * 123)
+        entries = await client.propfind(f"{server.url}/backups/", depth=1)
+        by_name = {entry["name"]: entry for entry in entries}
+        assert set(by_name) == {"backups", "sub", "backup 1.tar.gz"}
+        assert by_name["sub"]["is_collection"]
+        assert not by_name["backup 1.tar.gz"]["is_collection"]
+        assert by_name["backup 1.tar.gz"]["size"] == 123
+        assert by_name["backup 1.tar.gz"]["etag"]
+        assert len(await client.propfind(f"{server.url}/backups/", depth=0)) == 1
+        assert await client.propfind(f"{server.url}/missing/") is None
+    run_client(test)
+
+
+def test_ranged_get(server):
+    data = bytes(range(256)) * 16
+
+    async def test(client):
+        url = f"{server.url}/data.bin"
+        await client.put(url, data)
+        response = await client.get(url, headers={"Range": "bytes=100-199"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 100-199/{len(data)}"
+        assert response.content == data[100:200]
+        # on_chunk接收响应体时不在content中保留数据
+        chunks = []
+        response = await client.get(url, headers={"Range": "bytes=-10"}, on_chunk=chunks.append)
+        assert response.status_code == 206
+        assert response.content == b""
+        assert b"".join(chunks) == data[-10:]
+    run_client(test)
+
+
+def test_keep_alive_reuses_connection(server):
+    async def test(client):
+        await client.mkcol(f"{server.url}/d/")
+        for i in range(5):
+            await client.put(f"{server.url}/d/{i}", b"data")
+            await client.head(f"{server.url}/d/{i}")
+        await client.propfind(f"{server.url}/d/")
+    run_client(test)
+    assert sum(server.request_counts.values()) == 12
+    assert server.connections == 1
+
+
+def test_concurrent_requests_limited_by_max_connections(server):
+    async def test(client):
+        await client.mkcol(f"{server.url}/d/")
+        statuses = await asyncio.gather(*[client.put(f"{server.url}/d/{i}", b"data") for i in range(20)])
+        assert statuses == [201] * 20
+    run_client(test, max_connections=3)
+    assert 1 < server.connections <= 3
+
+
+def test_retries_temporary_errors(server, monkeypatch):
+    failures = []
+    do_get = webdav_local_server.WebDAVRequestHandler.do_GET
+
+    def flaky_get(handler):
+        if len(failures) < 2:
+            failures.append(handler.path)
+            return handler._send(503, headers={"Retry-After": "0"})
+        return do_get(handler)
+
+    monkeypatch.setattr(webdav_local_server.WebDAVRequestHandler, "do_GET", flaky_get)
+
+    async def test(client):
+        await client.put(f"{server.url}/a.txt", b"hello")
+        chunks = []
+        response = await client.get(f"{server.url}/a.txt", on_chunk=chunks.append)
+        assert response.status_code == 200
+        # 错误响应的响应体不会交给on_chunk
+        assert b"".join(chunks) == b"hello"
+    run_client(test)
+    assert server.request_counts["GET"] == 3
+
+
+def test_retry_gives_up_after_max_retries(server, monkeypatch):
+    monkeypatch.setattr(webdav_local_server.WebDAVRequestHandler, "do_GET", lambda handler: handler._send(503))
+
+    async def test(client):
+        client.retry_policy = webdav_backup.RetryPolicy(max_retries=2, backoff=0)
+        return await client.get(f"{server.url}/a.txt")
+    assert run_client(test).status_code == 503
+    assert server.request_counts["GET"] == 3
+
+
+def test_read_timeout_applies_per_read(tmp_path):
+    # 512KB/s的带宽下载1.5MB约需3秒（超过连接与读取超时之和），每次读取的等待时间远小于1秒
+    server = webdav_local_server.start(str(tmp_path / "dav"), bandwidth="512K")
+    url = f"http://127.0.0.1:{server.server_port}/data.bin"
+    (tmp_path / "dav" / "data.bin").write_bytes(b"x" * 1536 * 1024)
+    try:
+        async def test(client):
+            received = []
+            response = await client.get(url, on_chunk=lambda chunk: received.append(len(chunk)), timeout=(1, 1))
+            assert response.status_code == 200
+            assert sum(received) == 1536 * 1024
+        run_client(test)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_read_timeout_when_server_stalls(tmp_path):
+    server = webdav_local_server.start(str(tmp_path / "dav"), latency=1.0)
+    try:
+        async def test(client):
+            client.retry_policy = webdav_backup.RetryPolicy(max_retries=0)
+            with pytest.raises(asyncio.TimeoutError):
+                await client.request("HEAD", f"http://127.0.0.1:{server.server_port}/", timeout=(1, 0.2))
+        run_client(test)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def start_socket_server(responses):
+    """在一个keep-alive连接上依次发送responses中的原始响应（每读取到一个请求发送一个），发送完后关闭连接"""
+    listener = socket.create_server(("127.0.0.1", 0))
+    accepted = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            accepted.append(conn)
+            with conn:
+                for response in responses:
+                    request = b""
+                    while b"\r\n\r\n" not in request:
+                        data = conn.recv(65536)
+                        if not data:
+                            return
+                        request += data
+                    conn.sendall(response)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener, accepted
+
+
+def test_reused_connection_dropped_mid_body_is_not_resent():
+    body = b"x" * 1000
+    response = b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n"
+    listener, accepted = start_socket_server([response + body, response + body[:500]])
+    url = f"http://127.0.0.1:{listener.getsockname()[1]}/a.bin"
+    try:
+        async def test(client):
+            assert (await client.get(url)).content == body
+            received = []
+            with pytest.raises(asyncio.IncompleteReadError):
+                await client.get(url, on_chunk=received.append)
+            # 已交给on_chunk的部分响应体不会因重发而重复
+            assert sum(map(len, received)) == 500
+        run_client(test)
+    finally:
+        listener.close()
+    assert len(accepted) == 1
+
+
+def test_reused_connection_closed_before_response_is_resent():
+    body = b"x" * 1000
+    response = b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n" + body
+    # 第二个请求到达后服务器不响应直接关闭连接，客户端换新连接重发
+    listener, accepted = start_socket_server([response, b""])
+    url = f"http://127.0.0.1:{listener.getsockname()[1]}/a.bin"
+    try:
+        async def test(client):
+            client.retry_policy = webdav_backup.RetryPolicy(max_retries=0)
+            assert (await client.get(url)).content == body
+            received = []
+            assert (await client.get(url, on_chunk=received.append)).status_code == 200
+            assert b"".join(received) == body
+        run_client(test)
+    finally:
+        listener.close()
+    assert len(accepted) == 2
+
+
+def test_follows_redirects(server):
+    class RedirectHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(302 if self.command == "GET" else 307)
+            self.send_header("Location", server.url + self.path)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_HEAD = do_PROPFIND = do_PUT = do_GET
+
+        def log_message(self, format, *args):
+            pass
+
+    redirector = ThreadingHTTPServer(("127.0.0.1", 0), RedirectHandler)
+    threading.Thread(target=redirector.serve_forever, daemon=True).start()
+    redirect_url = f"http://127.0.0.1:{redirector.server_port}"
+    try:
+        async def test(client):
+            await client.put(f"{server.url}/a.txt", b"hello")
+            assert (await client.get(f"{redirect_url}/a.txt")).content == b"hello"
+            assert (await client.head(f"{redirect_url}/a.txt")).headers["Content-Length"] == "5"
+            entries = await client.propfind(f"{redirect_url}/")
+            assert "a.txt" in {entry["name"] for entry in entries}
+            # 写入请求不跟随重定向
+            assert await client.put(f"{redirect_url}/b.txt", b"data") == 307
+        run_client(test)
+    finally:
+        redirector.shutdown()
+        redirector.server_close()
+
+
+def test_uses_session_for_proxy(server, monkeypatch):
+    # 本地服务器按请求行中的完整URL的路径处理请求，可以充当HTTP代理
+    monkeypatch.setenv("HTTP_PROXY", server.url)
+    monkeypatch.delenv("NO_PROXY", raising=False)
+    monkeypatch.delenv("no_proxy", raising=False)
+    session = webdav_backup.requests.Session()
+    session.auth = ("user", "pass")
+
+    async def test(client):
+        url = "http://webdav.invalid/a.txt"
+        assert await client.put(url, b"hello") == 201
+        assert (await client.get(url)).content == b"hello"
+    run_client(test, session=session)
+    assert server.request_counts["PUT"] == 1
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""守护进程在备份失败后保持待备份状态并安排重试的测试"""
+
+import os
+import time
+
+import pytest
+
+import webdav_backup
+import webdav_local_server
+
+
+@pytest.fixture
+def backup_env(tmp_path, monkeypatch):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "big.bin").write_bytes(os.urandom(1536 * 1024))
+    (source / "a.txt").write_text("a")
+    server = webdav_local_server.start(str(tmp_path / "dav"))
+    settings = {
+        "SOURCE_DIR": str(source),
+        "WEBDAV_BASE_URL": f"http://127.0.0.1:{server.server_port}",
+        "LOCAL_BACKUP_DIR": str(tmp_path / "local"),
+        "ENABLE_PREFLIGHT_CHECK": False,
+        "ENABLE_MULTIPART_UPLOAD": True,
+        "LARGE_FILE_THRESHOLD": 1,
+        "MULTIPART_PART_SIZE_MB": 1,
+        "MULTIPART_MAX_RETRIES": 0,
+        "HTTP_MAX_RETRIES": 0,
+        "STAGE_RETRIES": 0,
+        "LARGE_FILE_RATE_LIMIT": "",
+    }
+    for name, value in settings.items():
+        monkeypatch.setattr(webdav_backup, name, value)
+    yield tmp_path
+    server.shutdown()
+    server.server_close()
+
+
+def new_state(now):
+    return {"job": None, "pending_since": now, "last_change": now - webdav_backup.DAEMON_DEBOUNCE_SECONDS,
+            "last_backup": now - webdav_backup.DAEMON_MIN_INTERVAL_SECONDS, "retry_at": now}
+
+
+def test_failed_multipart_upload_is_retried(backup_env, monkeypatch):
+    do_put = webdav_local_server.WebDAVRequestHandler.do_PUT
+
+    def failing_put(handler):
+        # 第二个分片上传失败，分片上传日志保留已完成的分片
+        if handler.path.endswith(".parts/00002"):
+            handler.rfile.read(int(handler.headers["Content-Length"]))
+            return handler._send(507)
+        return do_put(handler)
+
+    monkeypatch.setattr(webdav_local_server.WebDAVRequestHandler, "do_PUT", failing_put)
+    daemon = webdav_backup.BackupDaemon()
+    state = new_state(time.monotonic())
+    daemon.run_due([state], [""], [state])
+    assert state["pending_since"] is not None
+    assert state["retry_at"] > time.monotonic()
+    journal_dir = os.path.join(str(backup_env / "local"), webdav_backup.STATE_DIR_NAME, webdav_backup.UPLOAD_JOURNAL_DIR_NAME)
+    assert any(name.endswith(".json") for name in os.listdir(journal_dir))
+
+    # 重试时继续上传缺失的分片，成功后不再处于待备份状态
+    monkeypatch.setattr(webdav_local_server.WebDAVRequestHandler, "do_PUT", do_put)
+    state["retry_at"] = state["last_backup"] = time.monotonic() - webdav_backup.DAEMON_MIN_INTERVAL_SECONDS
+    assert daemon.is_due(state, time.monotonic())
+    daemon.run_due([state], [""], [state])
+    assert state["pending_since"] is None
+    assert not os.listdir(journal_dir)
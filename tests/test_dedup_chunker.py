@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""ContentDefinedChunker的切分点只取决于内容：插入数据后只产生常数个新数据块"""
+
+import hashlib
+import random
+
+import pytest
+
+import webdav_backup
+
+MIN_SIZE, AVG_SIZE, MAX_SIZE = 2 * 1024, 8 * 1024, 32 * 1024
+
+
+def split(chunker, data):
+    mapped = chunker.map_hashes(data)
+    chunks = []
+    start = 0
+    while start < len(data):
+        cut = chunker.find_cut(mapped, start, len(data))
+        chunks.append(data[start:cut])
+        start = cut
+    return chunks
+
+
+@pytest.fixture
+def chunker():
+    return webdav_backup.ContentDefinedChunker(MIN_SIZE, AVG_SIZE, MAX_SIZE)
+
+
+def test_chunk_sizes(chunker):
+    data = random.Random(0).randbytes(2 * 1024 * 1024)
+    chunks = split(chunker, data)
+    assert b"".join(chunks) == data
+    assert all(MIN_SIZE < len(chunk) <= MAX_SIZE for chunk in chunks[:-1])
+    average = len(data) / len(chunks)
+    assert AVG_SIZE / 2 < average < AVG_SIZE * 2
+
+
+def test_constant_data_is_cut_at_max_size(chunker):
+    chunks = split(chunker, bytes(5 * MAX_SIZE))
+    assert [len(chunk) for chunk in chunks] == [MAX_SIZE] * 5
+
+
+@pytest.mark.parametrize("seed", range(8))
+@pytest.mark.parametrize("inserted", [1, 3 * 1024, 20 * 1024, 70 * 1024])
+def test_insertion_changes_constant_number_of_chunks(chunker, seed, inserted):
+    rng = random.Random(seed)
+    data = rng.randbytes(2 * 1024 * 1024)
+    position = rng.randrange(len(data))
+    shifted = data[:position] + rng.randbytes(inserted) + data[position:]
+    known = {hashlib.sha256(chunk).digest() for chunk in split(chunker, data)}
+    new_chunks = [chunk for chunk in split(chunker, shifted) if hashlib.sha256(chunk).digest() not in known]
+    # 插入的数据本身占用的块之外，只有常数个块在重新同步之前改变
+    assert len(new_chunks) <= inserted // AVG_SIZE + 8
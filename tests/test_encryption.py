@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""分块认证加密（ChunkCipher、EncryptingWriter、DecryptingReader）的测试"""
+
+import io
+import os
+import random
+
+import pytest
+
+import webdav_backup
+
+pytest.importorskip("cryptography")
+
+CHUNK_SIZE = 64
+ALGORITHMS = sorted(webdav_backup.ChunkCipher.ALGORITHMS)
+
+
+@pytest.fixture
+def key():
+    return webdav_backup.EncryptionKey(master=os.urandom(32))
+
+
+def encrypt(key, data, algorithm="aes-256-gcm", write_size=None):
+    """以很小的块大小加密，使少量数据也跨越多个加密块"""
+    output = io.BytesIO()
+    writer = webdav_backup.EncryptingWriter(output, webdav_backup.ChunkCipher.create(key, algorithm, CHUNK_SIZE))
+    write_size = write_size or max(1, len(data))
+    for offset in range(0, len(data), write_size):
+        writer.write(data[offset:offset + write_size])
+    writer.close()
+    return output.getvalue()
+
+
+def decrypt(key, encrypted):
+    return webdav_backup.decrypt_bytes(key, encrypted)
+
+
+def split_blocks(encrypted):
+    """拆分为文件头和各个加密块"""
+    header_size = webdav_backup.ChunkCipher.HEADER.size
+    block_size = CHUNK_SIZE + webdav_backup.ChunkCipher.TAG_SIZE
+    body = encrypted[header_size:]
+    return encrypted[:header_size], [body[i:i + block_size] for i in range(0, len(body), block_size)]
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+@pytest.mark.parametrize("size", [0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 5 * CHUNK_SIZE, 1000])
+def test_round_trip(key, algorithm, size):
+    data = os.urandom(size)
+    encrypted = encrypt(key, data, algorithm, write_size=7)
+    header, blocks = split_blocks(encrypted)
+    # 末块带有末块标记，空数据也有一个只包含认证标签的末块
+    assert len(blocks) == max(1, -(-size // CHUNK_SIZE))
+    assert len(encrypted) == len(header) + size + len(blocks) * webdav_backup.ChunkCipher.TAG_SIZE
+    assert decrypt(key, encrypted) == data
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+def test_header_records_algorithm(key, algorithm):
+    encrypted = encrypt(key, b"data", algorithm)
+    reader = webdav_backup.DecryptingReader(io.BytesIO(encrypted), len(encrypted), key)
+    assert reader.cipher.algorithm == algorithm
+    assert reader.cipher.chunk_size == CHUNK_SIZE
+    assert reader.size == 4
+
+
+def test_passphrase_round_trip():
+    key = webdav_backup.EncryptionKey(passphrase=b"correct horse")
+    data = os.urandom(300)
+    encrypted = webdav_backup.encrypt_bytes(key, data)
+    assert decrypt(webdav_backup.EncryptionKey(passphrase=b"correct horse"), encrypted) == data
+    with pytest.raises(IOError):
+        decrypt(webdav_backup.EncryptionKey(passphrase=b"wrong horse"), encrypted)
+    # 口令加密的文件不能用密钥文件解密
+    with pytest.raises(ValueError):
+        decrypt(webdav_backup.EncryptionKey(master=os.urandom(32)), encrypted)
+
+
+def test_wrong_key_fails(key):
+    encrypted = encrypt(key, os.urandom(300))
+    with pytest.raises(IOError):
+        decrypt(webdav_backup.EncryptionKey(master=os.urandom(32)), encrypted)
+
+
+@pytest.mark.parametrize("removed", [1, CHUNK_SIZE + webdav_backup.ChunkCipher.TAG_SIZE])
+def test_truncation_is_rejected(key, removed):
+    # 截掉末块的一部分，或截掉末块并截断前一块
+    encrypted = encrypt(key, os.urandom(5 * CHUNK_SIZE + 10))
+    with pytest.raises(IOError):
+        decrypt(key, encrypted[:-removed])
+
+
+def test_truncation_at_block_boundary_is_rejected(key):
+    encrypted = encrypt(key, os.urandom(5 * CHUNK_SIZE))
+    header, blocks = split_blocks(encrypted)
+    with pytest.raises(IOError):
+        decrypt(key, header + b"".join(blocks[:3]))
+
+
+def test_reordered_blocks_are_rejected(key):
+    encrypted = encrypt(key, os.urandom(5 * CHUNK_SIZE + 10))
+    header, blocks = split_blocks(encrypted)
+    blocks[1], blocks[2] = blocks[2], blocks[1]
+    with pytest.raises(IOError):
+        decrypt(key, header + b"".join(blocks))
+
+
+def test_modified_header_is_rejected(key):
+    encrypted = bytearray(encrypt(key, os.urandom(100)))
+    # 修改nonce前缀的最后一个字节（文件头作为附加认证数据）
+    encrypted[webdav_backup.ChunkCipher.HEADER.size - 1] ^= 1
+    with pytest.raises(IOError):
+        decrypt(key, bytes(encrypted))
+
+
+def test_not_an_encrypted_file(key):
+    with pytest.raises(ValueError):
+        decrypt(key, b"x" * 100)
+
+
+@pytest.mark.parametrize("algorithm", ALGORITHMS)
+def test_ranged_reads_across_chunk_boundaries(key, algorithm):
+    data = os.urandom(10 * CHUNK_SIZE + 17)
+    encrypted = encrypt(key, data, algorithm)
+    reader = webdav_backup.DecryptingReader(io.BytesIO(encrypted), len(encrypted), key)
+    rng = random.Random(0)
+    ranges = [(0, len(data)), (CHUNK_SIZE - 1, 2), (CHUNK_SIZE, CHUNK_SIZE), (3 * CHUNK_SIZE - 5, 2 * CHUNK_SIZE + 10),
+              (len(data) - 3, 100), (len(data), 10)]
+    ranges += [(rng.randrange(len(data)), rng.randrange(1, 4 * CHUNK_SIZE)) for _ in range(50)]
+    for start, length in ranges:
+        expected = data[start:start + length]
+        assert b"".join(reader.iter_range(start, length, 16)) == expected
+        reader.seek(start)
+        assert reader.read(length) == expected
+        assert reader.tell() == start + len(expected)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""保留策略（plan_retention、select_backups_to_delete）的表格测试"""
+
+import pytest
+
+import webdav_backup
+
+
+def name(timestamp, kind="full", extension="tar.gz"):
+    """生成备份文件名，kind为None时生成没有备份类型标记的旧版文件名"""
+    marker = f"_{kind}" if kind else ""
+    return f"backup_{timestamp}{marker}.{extension}"
+
+
+CASES = [
+    # (说明, 文件名, keep_last, 分层保留策略, 应删除的文件名)
+    ("keep_last_only",
+     [name(f"2026010{day}_120000") for day in range(1, 6)], 2, None,
+     [name(f"2026010{day}_120000") for day in range(1, 4)]),
+    ("keep_all_when_fewer_than_keep_last",
+     [name("20260101_120000"), name("20260102_120000")], 5, None,
+     []),
+    ("hourly",
+     [name("20260101_100000"), name("20260101_103000"), name("20260101_110000"), name("20260101_115959"),
+      name("20260101_120000")], 0, {"hourly": 2},
+     [name("20260101_100000"), name("20260101_103000"), name("20260101_110000")]),
+    ("daily",
+     [name("20260101_080000"), name("20260101_200000"), name("20260102_080000"), name("20260102_200000"),
+      name("20260103_080000"), name("20260103_200000")], 0, {"daily": 2},
+     [name("20260101_080000"), name("20260101_200000"), name("20260102_080000"), name("20260103_080000")]),
+    ("weekly_uses_iso_weeks_across_new_year",
+     # 2025-12-28是2025年第52周的周日，2025-12-29与2026-01-02同属2026年第1周
+     [name("20251228_120000"), name("20251229_120000"), name("20260102_120000")], 0, {"weekly": 2},
+     [name("20251229_120000")]),
+    ("monthly",
+     [name("20260115_120000"), name("20260131_120000"), name("20260201_120000"), name("20260301_120000")],
+     0, {"monthly": 2},
+     [name("20260115_120000"), name("20260131_120000")]),
+    ("yearly",
+     [name("20241231_120000"), name("20250101_120000"), name("20251231_120000"), name("20260101_120000")],
+     0, {"yearly": 2},
+     [name("20241231_120000"), name("20250101_120000")]),
+    ("tiers_combined",
+     # 每天一个备份：最近3天每天一个，另外每月保留最新的一个（1月31日）
+     [name(f"202601{day:02d}_120000") for day in range(25, 32)] + [name(f"202602{day:02d}_120000") for day in range(1, 4)],
+     0, {"daily": 3, "monthly": 2},
+     [name(f"202601{day:02d}_120000") for day in range(25, 31)]),
+    ("zero_count_period_is_ignored",
+     [name("20260101_120000"), name("20260102_120000")], 1, {"daily": 0},
+     [name("20260101_120000")]),
+    ("keep_last_overlaps_tiers",
+     # 最新的3个与每天最新的备份重叠：只额外保留第一天最新的备份
+     [name("20260101_080000"), name("20260101_200000"), name("20260102_080000"), name("20260102_200000"),
+      name("20260103_080000"), name("20260103_200000")], 3, {"daily": 3},
+     [name("20260101_080000"), name("20260102_080000")]),
+    ("keep_last_covers_tiers",
+     [name(f"2026010{day}_120000") for day in range(1, 6)], 3, {"daily": 2},
+     [name("20260101_120000"), name("20260102_120000")]),
+    ("incremental_chain_kept_whole",
+     [name("20260101_100000"), name("20260101_110000", "incr"), name("20260101_120000", "incr"),
+      name("20260102_100000"), name("20260102_110000", "incr")], 1, None,
+     [name("20260101_100000"), name("20260101_110000", "incr"), name("20260101_120000", "incr")]),
+    ("incremental_kept_by_tier_keeps_its_chain",
+     [name("20251231_100000"), name("20260101_100000"), name("20260101_110000", "incr"),
+      name("20260101_120000", "incr"), name("20260102_100000"), name("20260102_110000", "incr")], 0, {"daily": 2},
+     [name("20251231_100000")]),
+    ("differential_chain_kept_whole",
+     # 每年保留的2025年最后一个差异备份依赖12月1日的全量备份，两者之间的备份一并保留
+     [name("20251101_100000"), name("20251201_100000"), name("20251215_100000", "diff"),
+      name("20251231_100000", "diff"), name("20260101_100000"), name("20260102_100000", "diff")], 1, {"yearly": 2},
+     [name("20251101_100000")]),
+    ("full_backup_alone_does_not_keep_older_chain",
+     [name("20260101_100000"), name("20260101_110000", "incr"), name("20260102_100000")], 1, None,
+     [name("20260101_100000"), name("20260101_110000", "incr")]),
+    ("legacy_names_without_marker",
+     [name("20260101_120000", None), name("20260102_120000", None, "zip"), name("20260103_120000", None)], 2, None,
+     [name("20260101_120000", None)]),
+    ("legacy_name_starts_a_chain",
+     [name("20260101_120000", None), name("20260102_120000", None), name("20260103_120000", "incr")], 1, None,
+     [name("20260101_120000", None)]),
+    ("encrypted_names",
+     [name("20260101_120000", extension="tar.gz.enc"), name("20260102_120000", "incr", "tar.gz.enc"),
+      name("20260103_120000", extension="zip.enc"), name("20260104_120000", extension="tar.zst.enc")], 1, None,
+     [name("20260101_120000", extension="tar.gz.enc"), name("20260102_120000", "incr", "tar.gz.enc"),
+      name("20260103_120000", extension="zip.enc")]),
+    ("unrelated_names_are_ignored",
+     [name("20260101_120000"), name("20260102_120000"), name("20260101_120000") + ".index.json.gz",
+      name("20260101_120000") + ".parts", "other_20260101_120000_full.tar.gz", "backup_20260101_120000_full.tar.bz2",
+      "backup_2026010_120000_full.tar.gz", "notes.txt"], 1, None,
+     [name("20260101_120000")]),
+]
+
+
+@pytest.mark.parametrize("filenames, keep_last, policy, expected",
+                         [case[1:] for case in CASES], ids=[case[0] for case in CASES])
+def test_select_backups_to_delete(filenames, keep_last, policy, expected):
+    assert webdav_backup.select_backups_to_delete("backup", filenames, keep_last, policy) == expected
+
+
+def test_input_order_does_not_matter():
+    filenames = [name(f"2026010{day}_120000") for day in range(1, 6)]
+    expected = webdav_backup.select_backups_to_delete("backup", filenames, 2, {"daily": 3})
+    assert webdav_backup.select_backups_to_delete("backup", filenames[::-1] + filenames[:1], 2, {"daily": 3}) == expected
+
+
+def test_plan_retention_snapshots():
+    # 去重存储的快照没有备份类型标记，每个快照都是完整的
+    snapshots = [(f"snap{day}", f"2026010{day}_120000", None) for day in range(1, 6)]
+    assert webdav_backup.plan_retention(snapshots, 1, {"daily": 2}) == ["snap1", "snap2", "snap3"]
+
+
+def test_unknown_period_is_rejected():
+    with pytest.raises(ValueError):
+        webdav_backup.select_backups_to_delete("backup", [name("20260101_120000")], 1, {"fortnightly": 2})
@@ -9,17 +9,53 @@
 import os
 import sys
 import tarfile
+import threading
+import queue
+import zlib
+import math
+import struct
 import datetime
 import hashlib
+import hmac
+import bisect
+import errno
+import subprocess
+import json
+import gzip
+import lzma
+import io
 import re
+import random
+import asyncio
+import base64
+import inspect
+import ssl
+import socket
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.structures import CaseInsensitiveDict
 import shutil
+import uuid
+import xml.etree.ElementTree as ET
+from urllib.parse import quote, unquote, urljoin, urlparse
 from pathlib import Path
+from collections import deque, Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
 import time
+import contextlib
+import concurrent.futures
+import functools
+import contextvars
+import select
+import signal
+import ctypes
+import ctypes.util
 import smtplib
 from email.mime.text import MIMEText
 from email.header import Header
-from email.utils import formataddr
+from email.utils import formataddr, parsedate_to_datetime
 
 # 配置参数 - 请根据实际情况修改
 SOURCE_DIR = "/path/to/source/directory"          # 要备份的源目录
@@ -31,7 +67,101 @@ LOCAL_BACKUP_DIR = "/path/to/local/backups"       # 本地备份保存目录
 BACKUP_PREFIX = "backup"                          # 备份文件前缀
 MAX_REMOTE_BACKUPS = 5                            # WebDAV保留的最大备份数量
 MAX_LOCAL_BACKUPS = 3                             # 本地保留的最大备份数量
-BACKUP_FORMAT = "tar.gz"                          # 备份文件格式，可选值: tar.gz, zip
+BACKUP_FORMAT = "tar.gz"                          # 备份文件格式，可选值: tar.gz, tar.zst（需安装zstandard）, tar.lz4（需安装lz4）, tar.xz, zip
+
+# 保留策略参数
+# 分层保留（GFS）：在保留最新的MAX_REMOTE_BACKUPS/MAX_LOCAL_BACKUPS个备份之外，再按周期各保留最近若干个周期中每个周期最新的一个备份，
+# 时间取自备份文件名中的时间戳；可填写的周期: hourly（小时）, daily（天）, weekly（ISO周）, monthly（月）, yearly（年），未填写或为0表示不按该周期保留
+# 例如保留最近7天每天、最近4周每周、最近12个月每月的备份: {"daily": 7, "weekly": 4, "monthly": 12}
+RETENTION_POLICY = {}                                      # WebDAV上备份（及去重存储快照）的分层保留策略，为空时只保留最新的MAX_REMOTE_BACKUPS个
+LOCAL_RETENTION_POLICY = {}                                # 本地备份的分层保留策略，为空时只保留最新的MAX_LOCAL_BACKUPS个
+RETENTION_DELETE_CONCURRENCY = 8                           # 同时发送的WebDAV删除请求数
+RETENTION_DRY_RUN = False                                  # 试运行（True/False）：只列出按保留策略将要删除的备份及可释放的空间，不实际删除
+
+# 多任务参数
+# 在一个进程中执行多个备份任务，每个任务为一个字典，未填写的项使用上面的全局配置，backup_prefix默认使用任务名称
+# 可填写的项: name, source_dir, webdav_base_url, webdav_upload_dir, webdav_user, webdav_pass, local_backup_dir,
+#             backup_prefix, max_remote_backups, max_local_backups, retention_policy, local_retention_policy,
+#             backup_format, backup_mode, compression_workers, compression_level, exclude_patterns
+# 例如:
+# BACKUP_JOBS = [
+#     {"name": "docs", "source_dir": "/srv/docs", "webdav_upload_dir": "backups/docs"},
+#     {"name": "www", "source_dir": "/srv/www", "webdav_base_url": "https://other-server.com", "max_remote_backups": 10},
+# ]
+BACKUP_JOBS = []                                           # 为空时只执行上面配置的单个备份任务
+JOB_COMPRESSION_CONCURRENCY = 2                            # 同时执行扫描/压缩阶段的任务数（CPU密集）
+JOB_UPLOAD_CONCURRENCY = 4                                 # 同时执行上传/校验阶段的任务数（网络密集），与压缩阶段互相独立，不同任务的压缩和上传可以重叠进行
+MAX_CONNECTIONS_PER_HOST = 8                               # 多任务模式下每个WebDAV服务器的最大连接数，所有连接到同一服务器的任务共享连接池（上传与校验/清理各占一半，至少各1个）
+
+# 压缩参数
+COMPRESSION_WORKERS = 1                                    # 并行压缩线程数，1表示单线程压缩（原有方式），0表示使用全部CPU核心
+COMPRESSION_BLOCK_SIZE_MB = 4                              # 并行压缩时每个独立压缩块的大小（MB），块越大压缩率越高、内存占用越大
+COMPRESSION_LEVEL = None                                   # tar格式的压缩级别，None表示使用各格式的默认级别（tar.gz: 9, tar.zst: 3, tar.lz4: 0, tar.xz: 6）
+                                                           # 设为"auto"时抽样测试各级别的压缩速度和压缩率，结合上传带宽选择预计总耗时最短的级别
+AUTO_LEVEL_SAMPLE_MB = 16                                  # auto模式下从源目录抽样测试的数据量（MB）
+UPLOAD_BANDWIDTH_ESTIMATE = "10M"                          # auto模式下的上传带宽估计值（格式同速度限制），仅在没有历史上传速度记录时使用，设置了速度限制时取两者中较小的值
+SKIP_INCOMPRESSIBLE = True                                 # zip格式下是否对已压缩的文件（图片、视频、压缩包等）只存储不压缩（True/False），按扩展名和开头数据的字节熵判断
+TAR_STORE_INCOMPRESSIBLE = False                           # tar.gz/tar.xz格式下是否对已压缩的文件切换为存储（tar.gz）或最快级别（tar.xz）压缩（True/False）
+                                                           # 开启后压缩流按块分成多个独立成员（与并行压缩的输出格式相同），gzip、tar等工具均可直接解压
+INCOMPRESSIBLE_EXTENSIONS = (                              # 视为已压缩的文件扩展名
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp3", ".aac", ".m4a", ".ogg", ".opus", ".flac",
+    ".mp4", ".m4v", ".mkv", ".mov", ".avi", ".webm", ".wmv",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".7z", ".rar",
+    ".jar", ".apk", ".docx", ".xlsx", ".pptx", ".odt", ".epub",
+)
+ENTROPY_SAMPLE_KB = 64                                     # 判断是否已压缩时读取文件开头的数据量（KB），小于此大小的文件总是正常压缩
+ENTROPY_THRESHOLD = 7.5                                    # 字节熵（位/字节，最大为8）不低于此值的文件视为已压缩
+
+# 扫描与排除参数
+SCAN_WORKERS = 8                                           # 并行扫描源目录的线程数，目录很多或位于网络文件系统上时可适当增大，1表示逐个目录扫描
+# 排除规则，语法与.gitignore相同（路径相对于源目录）：*匹配除/以外的任意字符，**匹配任意层目录，以/结尾只匹配目录，
+# 以/开头或中间含有/时只匹配相对源目录的完整路径，以!开头表示重新包含之前被排除的文件，多条规则匹配时以最后一条为准
+# 被排除的目录不再扫描，其中的文件也无法用!重新包含，例如:
+# EXCLUDE_PATTERNS = ["node_modules/", ".git/", "__pycache__/", "*.tmp", "*.log", "!important.log", "/cache/"]
+EXCLUDE_PATTERNS = []
+EXCLUDE_FROM_FILE = ""                                     # 从文件中读取排除规则（每行一条，语法同上，#开头为注释），追加在EXCLUDE_PATTERNS之后，为空表示不使用
+
+# 一致性快照参数（源目录在备份期间仍有程序写入时使用）
+SNAPSHOT_MODE = "none"                                     # 可选值: none（直接读取源目录，原有方式）, copy（归档前把需要归档的文件复制到快照目录，再从快照目录归档）
+                                                           # copy模式优先使用reflink（FICLONE，只复制元数据，与源文件共享数据块，需要Btrfs/XFS等文件系统），
+                                                           # 不支持时改用copy_file_range（在内核中复制），增量/差异模式下只复制本次需要归档的文件
+SNAPSHOT_DIR = ""                                          # 快照目录，为空时使用本地备份目录下的状态目录；需与源目录在同一文件系统上才能使用reflink
+SNAPSHOT_RETRIES = 3                                       # 复制期间发生变化（复制前后大小或修改时间不同）的文件重新复制的次数
+SNAPSHOT_RETRY_BUDGET_MB = 256                             # 所有重新复制的数据量上限（MB），超过后不再重试，使用最后一次复制的内容
+QUIESCE_COMMAND = ""                                       # 扫描源目录前执行的命令（如暂停应用写入、刷新数据库），返回非0时备份失败，为空表示不执行
+RESUME_COMMAND = ""                                        # 恢复写入的命令，copy模式下在快照完成后执行，否则在压缩包写入完成后执行，备份出错时同样会执行
+
+# 恢复参数
+WRITE_RESTORE_INDEX = True                                 # tar.gz/tar.xz/tar.lz4格式备份时是否在备份文件旁写入随机访问索引（备份文件名.index.json.gz）（True/False）
+                                                           # 索引记录每个文件在tar流中的位置和压缩块的起点，恢复单个文件时只需下载所在的压缩块
+                                                           # 开启后压缩流分成多个独立成员（与并行压缩的输出格式相同），gzip、tar等工具均可直接解压
+RESTORE_INDEX_BLOCK_KB = 1024                              # 写入索引时每个独立压缩块的最大大小（KB），块越小恢复单个文件时下载越少，压缩率略有下降
+
+# 预检参数
+ENABLE_PREFLIGHT_CHECK = True                              # 压缩前是否执行预检（True/False）：分层抽样压缩估计压缩包大小和耗时，检查本地剩余空间和WebDAV剩余配额
+PREFLIGHT_SAMPLE_MB = 8                                    # 预检时抽样压缩的数据量（MB），按文件大小和是否为已压缩格式分层，从每层中均匀抽取文件
+PREFLIGHT_SPACE_MARGIN = 1.2                               # 所需空间按估计的压缩包大小乘以此系数计算，抵消抽样误差
+PREFLIGHT_AUTO_STREAMING = True                            # 本地剩余空间不足时是否改用流式上传且不保留本地副本（True/False），为False时中止本次备份
+
+# 加密参数（需安装cryptography）
+ENABLE_ENCRYPTION = False                                  # 是否在压缩的同时加密备份文件（True/False），WebDAV服务器上只保存密文，加密备份的文件名以.enc结尾，随机访问索引同样加密
+ENCRYPTION_ALGORITHM = "aes-256-gcm"                       # 加密算法，可选值: aes-256-gcm（CPU支持AES指令时最快）, chacha20-poly1305（没有AES指令的ARM等设备上更快）
+ENCRYPTION_KEY_FILE = ""                                   # 密钥文件（32字节的原始数据、64位十六进制或base64文本），可用 head -c 32 /dev/urandom > backup.key 生成
+ENCRYPTION_PASSPHRASE = ""                                 # 口令（未设置密钥文件时使用），每个备份文件使用随机盐通过scrypt派生密钥；恢复时需要相同的密钥文件或口令
+ENCRYPTION_CHUNK_KB = 1024                                 # 每个加密块的明文大小（KB），每块单独认证，恢复单个文件时只需下载并解密所在的块
+
+# 增量备份参数
+BACKUP_MODE = "full"                                       # 备份模式，可选值: full（每次全量备份）, incremental（增量，相对上一次备份）, differential（差异，相对上一次全量备份）
+FULL_BACKUP_INTERVAL = 7                                   # 增量/差异模式下每隔多少次备份执行一次全量备份，设为0表示只在首次执行全量备份
+INCREMENTAL_HASH_CHECK = True                              # 文件时间戳变化但大小未变时，是否通过内容哈希确认文件是否真的被修改（True/False）
+
+# 去重存储参数
+ENABLE_DEDUP_STORE = False                                 # 是否启用内容分块去重存储（True/False），开启后不再上传完整压缩包，只上传远程尚不存在的数据块
+DEDUP_MIN_CHUNK_KB = 256                                   # 数据块最小大小（KB）
+DEDUP_AVG_CHUNK_KB = 1024                                  # 数据块平均大小（KB），建议为2的整数次幂
+DEDUP_MAX_CHUNK_KB = 4096                                  # 数据块最大大小（KB）
+DEDUP_UPLOAD_WORKERS = 4                                   # 并发上传数据块的线程数
 
 # 文件上传参数
 # 是否区分大文件和非大文件（True/False）
@@ -46,18 +176,85 @@ CONNECT_TIMEOUT = 30                                   # 连接超时时间（
 # 非大文件上传参数
 SMALL_FILE_MAX_TIME = 1800                                 # 非大文件最大上传时间（秒），默认30分钟
 SMALL_FILE_RATE_LIMIT = "2M"                               # 非大文件上传速度限制，格式为数字加单位（如2M=2MB/s），设为空字符串""表示无限制
-                                                           # Python版本目前不支持上传速度限制功能，相关参数会被忽略 
 
 # 大文件上传参数
 LARGE_FILE_MAX_TIME = 7200                                 # 大文件最大上传时间（秒），默认2小时
 LARGE_FILE_RATE_LIMIT = "1M"                               # 大文件上传速度限制，格式为数字加单位（如1M=1MB/s），设为空字符串""表示无限制
-                                                           # Python版本目前不支持上传速度限制功能，相关参数会被忽略 
+
+# 限速时间表：在指定时间段内使用指定的速度限制（覆盖上面的大文件/非大文件限速），格式为 (开始时间, 结束时间, 速度限制)
+# 时间段可跨越午夜，速度限制设为空字符串""表示该时间段内不限速，例如夜间全速、白天限速:
+# RATE_LIMIT_SCHEDULE = [("22:00", "07:00", "")]
+RATE_LIMIT_SCHEDULE = []
+
+# 流式上传参数
+ENABLE_STREAMING_UPLOAD = False                            # 是否启用流式打包上传（True/False），开启后边压缩边上传，不在本地暂存完整压缩包再上传
+STREAMING_KEEP_LOCAL_COPY = True                           # 流式上传时是否同时在本地保留一份备份文件（True/False），设为False则不占用本地磁盘空间
+STREAMING_BUFFER_SIZE_MB = 64                              # 压缩线程与上传线程之间的内存缓冲区大小（MB）
+                                                           # 注意：流式上传使用分块传输编码（chunked），需要WebDAV服务器支持
+
+# 分片上传参数
+ENABLE_MULTIPART_UPLOAD = False                            # 是否对大文件启用分片并发上传（True/False），仅对大于LARGE_FILE_THRESHOLD的文件生效，中断后重新运行脚本只上传缺失的分片
+MULTIPART_PART_SIZE_MB = 64                                # 每个分片的大小（MB），Nextcloud要求不小于5MB
+MULTIPART_CONCURRENCY = 4                                  # 同时上传的分片数，高延迟链路上适当增大可提升吞吐量
+MULTIPART_MAX_RETRIES = 3                                  # 单个分片上传失败后的重试次数
+MULTIPART_ASSEMBLY = "auto"                                # 分片合并方式，可选值: auto（自动选择）, nextcloud（Nextcloud分片上传v2，由服务器合并）,
+                                                           # content-range（使用Content-Range头写入同一文件，需服务器支持，如Apache mod_dav）,
+                                                           # manifest（服务器不合并，分片保存在"备份文件名.parts"目录中并附带清单）
+                                                           # auto模式下地址包含/remote.php/dav/files/时使用nextcloud，否则使用manifest
+
+# 异步客户端参数（目录创建、校验、清理等请求通过异步客户端并发执行）
+ASYNC_MAX_CONNECTIONS = 8                                  # 异步客户端到每个WebDAV服务器的最大并发连接数
+ASYNC_HTTP2 = False                                        # 是否使用HTTP/2（需要安装httpx和h2: pip install "httpx[http2]"，未安装时自动使用HTTP/1.1）
+CACHE_WEBDAV_COLLECTIONS = True                            # 是否在本地缓存已确认存在的WebDAV目录（True/False），下次只需一个PROPFIND确认上传目录，
+                                                           # 目录不存在时按路径深度二分查找，只创建缺失的部分，不再逐级发送MKCOL
+
+# 重试与连接参数（同步会话和异步客户端的所有WebDAV请求）
+HTTP_MAX_RETRIES = 4                                       # 临时错误（连接失败/重置、超时、HTTP_RETRY_STATUSES中的状态码）的最大重试次数，0表示不重试
+                                                           # 只重试幂等请求（GET、HEAD、PUT、DELETE、PROPFIND、MKCOL），请求体为文件流的上传由阶段重试处理
+HTTP_RETRY_BACKOFF = 1.0                                   # 指数退避的基准时间（秒），第n次重试前在0到 基准×2^(n-1) 秒之间随机等待（避免多个客户端同时重试）
+HTTP_RETRY_MAX_BACKOFF = 60                                # 单次重试前的最长等待时间（秒），服务器返回的Retry-After也不超过此值
+HTTP_RETRY_STATUSES = (429, 502, 503, 504)                 # 视为临时错误的HTTP状态码
+HTTP_POOL_SIZE = 0                                         # 同步会话的连接池大小，0表示按并发上传线程数自动设置（至少10）
+TCP_KEEPALIVE = True                                       # 是否为WebDAV连接启用TCP keepalive，避免长时间上传或校验时连接被NAT/防火墙断开（True/False）
+TCP_KEEPALIVE_IDLE = 60                                    # 连接空闲多少秒后开始发送keepalive探测
+TCP_KEEPALIVE_INTERVAL = 15                                # keepalive探测的间隔（秒）
+TCP_KEEPALIVE_COUNT = 4                                    # 连续多少次探测无响应后断开连接
+STAGE_RETRIES = 2                                          # 上传（含完整性检测）或创建目录阶段失败后重新执行该阶段的次数，从本地备份文件重新上传，不重新压缩
 
 # 完整性检测参数
 ENABLE_INTEGRITY_CHECK = True                              # 是否启用上传后的文件完整性检测（True/False）
 INTEGRITY_CHECK_TIMEOUT = 300                              # 完整性检测超时时间（秒），默认5分钟
 ENABLE_MD5_VERIFICATION = True                             # 是否启用MD5校验和验证（True/False）开启后会从WebDAV下载文件并计算MD5校验和以验证文件完整性
-MD5_VERIFICATION_EXCLUDE_THRESHOLD = 100                   # 大于此大小的文件不进行MD5验证（MB），设为0表示所有文件都进行验证
+MD5_VERIFICATION_EXCLUDE_THRESHOLD = 100                   # 大于此大小的文件不进行完整下载的MD5验证（MB），设为0表示所有文件都完整下载验证
+INTEGRITY_VERIFICATION_MODE = "auto"                       # 内容校验方式，可选值: auto（优先使用服务器提供的校验和，其次在阈值内完整下载验证MD5，超出阈值时抽样校验）,
+                                                           # checksum（只使用服务器提供的校验和）, sample（抽样范围下载校验）, download（完整下载验证MD5，原有方式）
+INTEGRITY_BLOCK_SIZE_MB = 4                                # 抽样校验时的块大小（MB），创建压缩包时同步计算每块的SHA-256哈希树
+INTEGRITY_SAMPLE_BLOCKS = 16                               # 抽样校验的块数（始终包含首尾两块），越多越可靠，下载量也越大
+INTEGRITY_HASH_ALGORITHMS = ("md5", "sha256")              # 创建或上传压缩包时同步计算的哈希算法（数据只读取一遍），可选hashlib支持的算法，如md5, sha1, sha256
+HASH_BUFFER_SIZE_MB = 8                                    # 读取文件计算哈希及上传时使用的可复用缓冲区大小（MB）
+
+# 传输缓冲参数
+ZERO_COPY_UPLOAD = True                                    # 上传本地备份文件时是否使用sendfile直接从文件发送到连接（True/False），数据不经过Python进程；
+                                                           # 只用于明文HTTP或已启用内核TLS（kTLS）的HTTPS连接，且上传时不需要再计算哈希，其他情况使用可复用的大缓冲区
+IO_BUFFER_MEMORY_MB = 64                                   # 上传、下载和计算哈希使用的缓冲区内存总量上限（MB），并发读取超出上限时等待其他读取释放缓冲区
+DROP_PAGE_CACHE = True                                     # 读取本地备份文件时是否通过posix_fadvise提示顺序读取，并在数据读取或发送后释放对应的页缓存（True/False），
+                                                           # 避免备份挤出其他服务依赖的页缓存（仅Linux等支持posix_fadvise的系统）
+
+# 运行指标参数（各阶段的耗时、数据量、吞吐量、重试次数和HTTP状态码）
+METRICS_TEXTFILE = ""                                      # Prometheus node_exporter textfile收集器的输出文件，如 "/var/lib/node_exporter/textfile_collector/webdav_backup.prom"，
+                                                           # 为空表示不输出；多任务模式下文件名后加任务名称（如 webdav_backup_www.prom）
+WRITE_RUN_RECORD = True                                    # 是否在本地状态目录的runs/下保存每次运行的JSON记录（True/False）
+MAX_RUN_RECORDS = 30                                       # 保留的JSON运行记录数量
+
+# 守护进程参数（python webdav_backup.py daemon：常驻运行，源目录有变化时自动备份，会话和连接在多次备份之间保持）
+DAEMON_WATCH_MODE = "auto"                                 # 监视源目录变化的方式，可选值: auto（Linux上使用inotify，不可用时改用轮询）, inotify, poll（定期扫描源目录）
+DAEMON_DEBOUNCE_SECONDS = 60                               # 源目录最后一次变化后等待多久没有新的变化再开始备份（秒），避免连续写入期间反复备份
+DAEMON_MAX_DELAY_SECONDS = 1800                            # 源目录持续变化时，从第一次变化起最多等待多久就开始备份（秒）
+DAEMON_MIN_INTERVAL_SECONDS = 600                          # 两次备份之间的最小间隔（秒）
+DAEMON_POLL_INTERVAL_SECONDS = 300                         # 轮询方式下扫描源目录的间隔（秒）
+DAEMON_MAX_INTERVAL_SECONDS = 86400                        # 没有检测到变化时，距上次备份超过此时间也执行一次备份（秒），用于弥补监视不到的变化（如网络文件系统上其他主机的修改），0表示不执行
+DAEMON_RETRY_DELAY_SECONDS = 900                           # 备份失败后等待多久重试（秒）
+DAEMON_BACKUP_ON_START = True                              # 守护进程启动时是否先执行一次备份（True/False）
 
 # 邮箱通知参数
 ENABLE_EMAIL_NOTIFICATION = False                          # 是否启用邮箱通知（True/False）
@@ -74,24 +271,3164 @@ EMAIL_TO = "recipient@example.com"                         # 收件人邮箱
 EMAIL_SUBJECT_PREFIX = "服务器"                             # 邮件主题前缀，最终显示为"[服务器]WebDAV备份"
 
 
-class WebDAVBackup:
+def parse_rate_limit(value):
+    """解析curl风格的速度限制字符串（如"2M"、"500K"、"1G"，不带单位表示字节/秒），空值返回None"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if not value:
+        return None
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([kKmMgG]?)[bB]?$', value)
+    if not match:
+        raise ValueError(f"无法解析速度限制: {value}，格式应为数字加单位（如2M=2MB/s）")
+    multiplier = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}[match.group(2).lower()]
+    rate = int(float(match.group(1)) * multiplier)
+    return rate or None
+
+
+def parse_clock_time(value):
+    """把"HH:MM"解析为当天的分钟数"""
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class RateLimiter:
+    """令牌桶限速器：按块扣除令牌，令牌不足时休眠补足，多个线程共享同一个限速器时限制的是总速度"""
+
+    # 令牌桶容量（秒）：空闲后最多允许以该时长的额度突发发送
+    BURST_SECONDS = 0.25
+    # 限速时间表的重新检查间隔（秒），长时间上传跨越时间段时自动切换速度
+    SCHEDULE_CHECK_INTERVAL = 1.0
+
+    def __init__(self, base_rate, schedule=None):
+        self._base_rate = parse_rate_limit(base_rate)
+        self._schedule = [(parse_clock_time(start), parse_clock_time(end), parse_rate_limit(rate))
+                          for start, end, rate in (schedule or [])]
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._rate = self._base_rate
+        self._rate_checked = 0.0
+        self.waited = 0.0
+
+    def current_rate(self):
+        """当前生效的速度限制（字节/秒），None表示不限速"""
+        now = time.monotonic()
+        if self._schedule and now - self._rate_checked >= self.SCHEDULE_CHECK_INTERVAL:
+            self._rate_checked = now
+            current = datetime.datetime.now()
+            minute = current.hour * 60 + current.minute
+            rate = self._base_rate
+            for start, end, window_rate in self._schedule:
+                in_window = start <= minute < end if start <= end else (minute >= start or minute < end)
+                if in_window:
+                    rate = window_rate
+                    break
+            self._rate = rate
+        return self._rate
+
+    def reserve(self, size):
+        """扣除size字节的令牌，返回调用方需要等待的秒数（令牌可以透支，透支部分由等待偿还，保证多线程下的总速度准确）"""
+        with self._lock:
+            rate = self.current_rate()
+            if not rate:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(rate * self.BURST_SECONDS, self._tokens + (now - self._last) * rate) - size
+            self._last = now
+            wait = -self._tokens / rate if self._tokens < 0 else 0
+            self.waited += wait
+        return wait
+
+    def consume(self, size):
+        """扣除size字节的令牌，超出速度限制时阻塞到允许发送为止"""
+        wait = self.reserve(size)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def consume_async(self, size):
+        """consume的协程版本，等待时不阻塞事件循环"""
+        wait = self.reserve(size)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def describe(self):
+        """当前速度限制的可读描述"""
+        rate = self.current_rate()
+        return f"{rate / 1024 / 1024:.2f} MB/s" if rate else "不限速"
+
+
+def rate_limited_iter(iterable, limiter):
+    """按块限速地迭代数据（用于分块传输编码的上传和流式下载）"""
+    for chunk in iterable:
+        if limiter is not None and chunk:
+            limiter.consume(len(chunk))
+        yield chunk
+
+
+class BlockHashTree:
+    """按固定块大小增量计算每块的SHA-256（哈希树的叶子）及整棵树的根哈希，用于抽样校验远程文件"""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.leaves = []
+        self.size = 0
+        self._current = hashlib.sha256()
+        self._current_size = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        self.size += len(view)
+        while len(view):
+            take = min(len(view), self.block_size - self._current_size)
+            self._current.update(view[:take])
+            self._current_size += take
+            view = view[take:]
+            if self._current_size == self.block_size:
+                self.leaves.append(self._current.hexdigest())
+                self._current = hashlib.sha256()
+                self._current_size = 0
+
+    def finish(self):
+        """写入结束后调用，结束最后一个不满的块"""
+        if self._current_size:
+            self.leaves.append(self._current.hexdigest())
+            self._current = hashlib.sha256()
+            self._current_size = 0
+        return self
+
+    def root(self):
+        """计算哈希树的根哈希（逐层两两合并，奇数个时末尾节点直接上移）"""
+        level = [bytes.fromhex(leaf) for leaf in self.leaves] or [hashlib.sha256(b"").digest()]
+        while len(level) > 1:
+            level = [hashlib.sha256(b"".join(level[i:i + 2])).digest() if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+        return level[0].hex()
+
+
+
+class ArchiveHasher:
+    """单遍计算备份数据的多种哈希（INTEGRITY_HASH_ALGORITHMS）及抽样校验用的哈希树"""
+
+    def __init__(self, algorithms=None, with_tree=True):
+        if algorithms is None:
+            algorithms = INTEGRITY_HASH_ALGORITHMS
+        self.hashes = {name: hashlib.new(name) for name in algorithms}
+        self.tree = BlockHashTree(INTEGRITY_BLOCK_SIZE_MB * 1024 * 1024) if with_tree else None
+        self.size = 0
+
+    def update(self, data):
+        for file_hash in self.hashes.values():
+            file_hash.update(data)
+        if self.tree is not None:
+            self.tree.update(data)
+        self.size += len(data)
+
+    def finish(self):
+        """数据写完或读完后调用"""
+        if self.tree is not None:
+            self.tree.finish()
+        return self
+
+    def hexdigest(self, name):
+        """返回指定算法的十六进制哈希，未计算该算法时返回None"""
+        file_hash = self.hashes.get(name)
+        return file_hash.hexdigest() if file_hash is not None else None
+
+    @classmethod
+    def from_file(cls, file_path, algorithms=None, with_tree=True):
+        """读取已有文件计算哈希（压缩包不是由本脚本写出，或写出时未计算所需算法时使用）"""
+        hasher = cls(algorithms, with_tree)
+        reader = HashingFileReader(file_path, hasher)
+        try:
+            while reader.read():
+                pass
+        finally:
+            reader.close()
+        return hasher
+
+
+class HashingWriter:
+    """写入时同步计算哈希的文件包装器"""
+
+    def __init__(self, fileobj, hasher):
+        self._fileobj = fileobj
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+
+def advise_file(fileobj, offset, length, advice):
+    """对文件区间调用posix_fadvise（advice为SEQUENTIAL、DONTNEED等），DROP_PAGE_CACHE关闭或系统不支持时不执行"""
+    if DROP_PAGE_CACHE and hasattr(os, "posix_fadvise"):
+        with contextlib.suppress(OSError):
+            os.posix_fadvise(fileobj.fileno(), offset, length, getattr(os, f"POSIX_FADV_{advice}"))
+
+
+class BufferPool:
+    """进程内共享的可复用I/O缓冲区：缓冲区总内存不超过IO_BUFFER_MEMORY_MB，全部借出时等待其他读取归还"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, buffer_size, max_bytes):
+        self.buffer_size = max(64 * 1024, min(buffer_size, max_bytes))
+        self._slots = threading.Semaphore(max(1, max_bytes // self.buffer_size))
+        self._free = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(int(HASH_BUFFER_SIZE_MB * 1024 * 1024), int(IO_BUFFER_MEMORY_MB * 1024 * 1024))
+            return cls._instance
+
+    def acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            return self._free.pop() if self._free else bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        with self._lock:
+            self._free.append(buffer)
+        self._slots.release()
+
+
+class FileSegment:
+    """请求体中的一段文件数据，由ZeroCopyConnectionMixin以sendfile直接从文件发送到套接字"""
+
+    def __init__(self, fileobj, offset, length):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def send_to(self, sock):
+        sent = sock.sendfile(self.fileobj, self.offset, self.length)
+        if sent != self.length:
+            raise IOError("文件在上传过程中被截断")
+        advise_file(self.fileobj, self.offset, self.length, "DONTNEED")
+
+
+class FileRangeReader:
+    """以可复用的大缓冲区（BufferPool，readinto）读取文件中的一个区间，可直接作为上传请求体；
+    read返回缓冲区的切片视图，调用方需在下一次read之前用完（HTTP发送端即是如此）；
+    发送端支持时改为返回FileSegment，由sendfile发送；已读取或发送的数据随即释放页缓存"""
+
+    # 限速时每次读取的最大数据量，使发送保持平稳
+    RATE_LIMITED_READ_SIZE = 256 * 1024
+
+    def __init__(self, file_path, offset=0, length=None, limiter=None):
+        self._file = open(file_path, 'rb', buffering=0)
+        self._pool = BufferPool.get()
+        self._buffer = self._pool.acquire()
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        if length is None:
+            length = os.fstat(self._file.fileno()).st_size - offset
+        self.length = length
+        self.position = offset
+        self._stop = offset + length
+        self.limiter = limiter
+        # 可否由发送端改用sendfile（ZeroCopyConnectionMixin判断连接是否支持后设置use_sendfile）
+        self.sendfile_allowed = ZERO_COPY_UPLOAD and hasattr(os, "sendfile")
+        self.use_sendfile = False
+        self._file.seek(offset)
+        advise_file(self._file, offset, length, "SEQUENTIAL")
+
+    def _update(self, data):
+        """读取到数据后调用（子类用于计算哈希）"""
+
+    def _finish(self):
+        """数据读完后调用"""
+
+    def read(self, size=-1):
+        limit = self.RATE_LIMITED_READ_SIZE if self.limiter is not None else None
+        if self.use_sendfile:
+            count = min(self._stop - self.position, self._pool.buffer_size, limit or self._pool.buffer_size)
+            if count <= 0:
+                self._finish()
+                return b""
+            segment = FileSegment(self._file, self.position, count)
+            self.position += count
+            self._update(segment)
+            if self.limiter is not None:
+                self.limiter.consume(count)
+            return segment
+        if self._start >= self._end:
+            wanted = min(len(self._buffer), self._stop - self.position)
+            filled = self._file.readinto(self._view[:wanted]) if wanted > 0 else 0
+            if not filled:
+                self._finish()
+                return b""
+            self._update(self._view[:filled])
+            # 数据已在缓冲区中，不再需要页缓存
+            advise_file(self._file, self.position, filled, "DONTNEED")
+            self.position += filled
+            self._start, self._end = 0, filled
+        if size is None or size < 0:
+            size = self._end - self._start
+        if limit is not None:
+            size = min(size, limit)
+        end = min(self._end, self._start + size)
+        chunk = self._view[self._start:end]
+        self._start = end
+        if self.limiter is not None:
+            self.limiter.consume(len(chunk))
+        return chunk
+
+    def __len__(self):
+        return self.length
+
+    def close(self):
+        if self._buffer is not None:
+            self._view.release()
+            self._pool.release(self._buffer)
+            self._buffer = None
+        self._file.close()
+
+
+class HashingFileReader(FileRangeReader):
+    """读取整个文件并同步计算哈希，可直接作为上传请求体；哈希只需统计大小（创建压缩包时已计算）时可由发送端改用sendfile"""
+
+    def __init__(self, file_path, hasher, limiter=None):
+        super().__init__(file_path, limiter=limiter)
+        self.hasher = hasher
+        self.sendfile_allowed = self.sendfile_allowed and not hasher.hashes and hasher.tree is None
+
+    def _update(self, data):
+        if isinstance(data, FileSegment):
+            self.hasher.size += len(data)
+        else:
+            self.hasher.update(data)
+
+    def _finish(self):
+        self.hasher.finish()
+
+
+class ZeroCopyConnectionMixin:
+    """发送FileRangeReader请求体时，明文连接或已启用内核TLS的连接改用sendfile发送文件数据"""
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        if isinstance(body, FileRangeReader) and body.sendfile_allowed:
+            body.use_sendfile = self.sendfile_supported()
+        return super().request(method, url, body=body, headers=headers, **kwargs)
+
+    def sendfile_supported(self):
+        # 明文HTTP连接可能尚未建立（发送时才连接），HTTPS连接在发送请求前已完成握手
+        if isinstance(self.sock, ssl.SSLSocket):
+            uses_ktls = getattr(getattr(self.sock, "_sslobj", None), "uses_ktls_for_send", None)
+            return bool(uses_ktls is not None and uses_ktls())
+        return not isinstance(self, HTTPSConnection)
+
+    def send(self, data):
+        if isinstance(data, FileSegment):
+            if self.sock is None:
+                self.connect()
+            data.send_to(self.sock)
+            return
+        super().send(data)
+
+
+class ZeroCopyHTTPConnection(ZeroCopyConnectionMixin, HTTPConnection):
+    pass
+
+
+class ZeroCopyHTTPSConnection(ZeroCopyConnectionMixin, HTTPSConnection):
+    pass
+
+
+class ZeroCopyHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = ZeroCopyHTTPConnection
+
+
+class ZeroCopyHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = ZeroCopyHTTPSConnection
+
+
+def parse_retry_after(value):
+    """解析Retry-After响应头（秒数或HTTP日期），返回需要等待的秒数，无法解析时返回None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+def keepalive_socket_options():
+    """TCP keepalive的套接字选项（平台不支持的选项跳过）"""
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    # macOS上空闲时间的选项名为TCP_KEEPALIVE
+    idle_option = getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None))
+    for option, value in ((idle_option, TCP_KEEPALIVE_IDLE),
+                          (getattr(socket, "TCP_KEEPINTVL", None), TCP_KEEPALIVE_INTERVAL),
+                          (getattr(socket, "TCP_KEEPCNT", None), TCP_KEEPALIVE_COUNT)):
+        if option is not None:
+            options.append((socket.IPPROTO_TCP, option, value))
+    return options
+
+
+class RetryPolicy:
+    """临时错误的重试策略：带随机抖动的指数退避，服务器返回Retry-After时按其等待"""
+    
+    # 可以安全重发的方法：MKCOL重发时目录已存在会返回405（视为成功），PROPFIND只读取属性
+    IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "PROPFIND", "MKCOL"))
+    
+    def __init__(self, max_retries=None, backoff=None, max_backoff=None, statuses=None):
+        self.max_retries = HTTP_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = HTTP_RETRY_BACKOFF if backoff is None else backoff
+        self.max_backoff = HTTP_RETRY_MAX_BACKOFF if max_backoff is None else max_backoff
+        self.statuses = frozenset(HTTP_RETRY_STATUSES if statuses is None else statuses)
+    
+    def allows(self, method):
+        return method.upper() in self.IDEMPOTENT_METHODS
+    
+    def delay(self, attempt, retry_after=None):
+        """第attempt次（从0开始）重试前的等待时间（秒）"""
+        seconds = parse_retry_after(retry_after)
+        if seconds is None:
+            seconds = random.uniform(0, self.backoff * 2 ** attempt)
+        return min(max(seconds, 0), self.max_backoff)
+    
+    def announce(self, method, url, attempt, delay, reason):
+        """输出重试信息，并计入当前阶段的重试次数"""
+        print(f"警告：{method} {url} 失败（{reason}），{delay:.1f} 秒后第 {attempt} 次重试")
+        RunMetrics.note_retry()
+
+
+class RetryingHTTPAdapter(HTTPAdapter):
+    """同步会话的传输适配器：幂等请求遇到临时错误时按重试策略重发，并为连接启用TCP keepalive"""
+    
+    def __init__(self, policy=None, **kwargs):
+        self.policy = policy or RetryPolicy()
+        super().__init__(**kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        if TCP_KEEPALIVE:
+            kwargs["socket_options"] = HTTPConnection.default_socket_options + keepalive_socket_options()
+        # 文件请求体按缓冲区大小读取发送（urllib3默认每次只读取16KB）
+        kwargs["blocksize"] = BufferPool.get().buffer_size
+        super().init_poolmanager(*args, **kwargs)
+        if ZERO_COPY_UPLOAD:
+            self.poolmanager.pool_classes_by_scheme = {"http": ZeroCopyHTTPConnectionPool,
+                                                       "https": ZeroCopyHTTPSConnectionPool}
+    
+    def send(self, request, **kwargs):
+        # 请求体为文件或生成器时发送后已被读取，无法重发，由调用方在阶段层面重试
+        retryable = self.policy.allows(request.method) and (request.body is None or isinstance(request.body, (bytes, str)))
+        attempt = 0
+        while True:
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if (not retryable or attempt >= self.policy.max_retries
+                        or isinstance(e, requests.exceptions.SSLError)):
+                    raise
+                reason = type(e).__name__
+                delay = self.policy.delay(attempt)
+            else:
+                if not retryable or attempt >= self.policy.max_retries or response.status_code not in self.policy.statuses:
+                    return response
+                reason = f"HTTP状态码: {response.status_code}"
+                delay = self.policy.delay(attempt, response.headers.get("Retry-After"))
+                response.close()
+            attempt += 1
+            self.policy.announce(request.method, request.url, attempt, delay, reason)
+            time.sleep(delay)
+
+
+def parse_checksum_header(value):
+    """解析形如 "SHA1:abc MD5:def" 的校验和字符串，返回 {算法: 十六进制值}（只保留可在本地计算的算法）"""
+    checksums = {}
+    for algo, digest in re.findall(r'([A-Za-z0-9-]+):([0-9a-fA-F]+)', value or ""):
+        algo = algo.lower().replace('-', '')
+        if algo in ("md5", "sha1", "sha256"):
+            checksums[algo] = digest.lower()
+    return checksums
+
+
+class StreamingPipe:
+    """有界的生产者/消费者缓冲区：压缩线程写入，上传线程按块读取"""
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, max_buffer_bytes, tee_path=None):
+        # 队列中最多保留 max_buffer_bytes 字节，写满后压缩线程会阻塞等待上传
+        self._queue = queue.Queue(maxsize=max(1, max_buffer_bytes // self.CHUNK_SIZE))
+        self._pending = bytearray()
+        self._tee = open(tee_path, 'wb') if tee_path else None
+        self._consumer_attached = True
+        self._aborted = False
+        self.error = None
+        self.bytes_written = 0
+        self.hasher = ArchiveHasher()
+
+    def write(self, data):
+        if self._aborted:
+            raise IOError("流式上传已中止")
+        self._pending += data
+        while len(self._pending) >= self.CHUNK_SIZE:
+            chunk = bytes(self._pending[:self.CHUNK_SIZE])
+            del self._pending[:self.CHUNK_SIZE]
+            self._emit(chunk)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _emit(self, chunk):
+        self.hasher.update(chunk)
+        self.bytes_written += len(chunk)
+        if self._tee:
+            self._tee.write(chunk)
+        # 上传端已断开时只写本地副本，不再入队
+        while self._consumer_attached:
+            try:
+                self._queue.put(chunk, timeout=1)
+                break
+            except queue.Full:
+                if self._aborted:
+                    raise IOError("流式上传已中止")
+
+    def _finish(self):
+        self.hasher.finish()
+        if self._tee:
+            self._tee.close()
+            self._tee = None
+        while self._consumer_attached:
+            try:
+                self._queue.put(None, timeout=1)
+                break
+            except queue.Full:
+                continue
+
+    def close(self):
+        """生产者正常结束：写出剩余数据并发送结束标记"""
+        if self._pending:
+            self._emit(bytes(self._pending))
+            self._pending = bytearray()
+        self._finish()
+
+    def fail(self, error):
+        """生产者异常结束：记录错误并通知上传端"""
+        self.error = error
+        self._finish()
+
+    def detach_consumer(self):
+        """上传端提前结束：若有本地副本则让压缩继续写完，否则中止压缩"""
+        self._consumer_attached = False
+        if not self._tee:
+            self._aborted = True
+        # 清空队列，唤醒可能阻塞的生产者
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def __iter__(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        if self.error is not None:
+            # 抛出异常使请求中断，服务器不会收到完整的分块结束标记
+            raise IOError(f"创建备份数据流失败: {self.error}")
+
+
+# 备份类型在文件名中的标记，未带标记的文件视为全量备份（兼容旧版本文件名）
+BACKUP_KIND_TAGS = {"full": "full", "incremental": "incr", "differential": "diff"}
+
+# 写入每个备份压缩包根目录的清单文件，记录备份类型、基准备份和已删除的文件
+BACKUP_MANIFEST_NAME = ".webdav_backup_manifest.json"
+
+# 本地状态目录（位于LOCAL_BACKUP_DIR下），保存增量索引等持久化数据
+STATE_DIR_NAME = ".webdav_backup_state"
+
+# 远程目录状态缓存文件名（位于状态目录下，文件名前加备份前缀），按目录的ETag/修改时间判断缓存是否仍然有效
+REMOTE_INDEX_NAME = "remote_index.json"
+
+# 随机访问索引文件的后缀（与备份文件同名，保存在备份文件旁），记录tar成员的偏移和压缩块的起点
+ARCHIVE_INDEX_SUFFIX = ".index.json.gz"
+
+# 加密备份文件名的后缀，加在格式扩展名之后（如 backup_20250101_020000.tar.gz.enc）
+ENCRYPTED_SUFFIX = ".enc"
+
+# 运行统计文件名（位于状态目录下，文件名前加备份前缀），记录历史上传速度等，用于自动选择压缩级别
+RUN_STATS_NAME = "run_stats.json"
+
+# 已确认存在的WebDAV目录缓存文件名（位于状态目录下，文件名前加备份前缀），按基础地址记录
+COLLECTION_CACHE_NAME = "collections.json"
+
+# 运行记录目录（位于状态目录下），每次运行保存一个JSON记录（文件名前加备份前缀）
+RUN_RECORD_DIR_NAME = "runs"
+
+# 分片上传日志目录（位于状态目录下），记录每个未完成上传已成功的分片，用于断点续传
+UPLOAD_JOURNAL_DIR_NAME = "uploads"
+
+# Nextcloud分片上传v2要求除最后一个分片外每个分片不小于5MB
+NEXTCLOUD_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def backup_filename_pattern(prefix):
+    """返回匹配备份文件名的正则表达式（分组：时间戳、备份类型标记、格式），加密备份带有ENCRYPTED_SUFFIX后缀"""
+    extensions = "|".join(re.escape(backup_format) for backup_format in BACKUP_FORMATS)
+    return f"{prefix}_(\\d{{8}}_\\d{{6}})(?:_(full|incr|diff))?\\.({extensions})(?:{re.escape(ENCRYPTED_SUFFIX)})?"
+
+
+# 分层保留策略中可用的周期
+RETENTION_PERIODS = ("hourly", "daily", "weekly", "monthly", "yearly")
+
+
+def retention_period_key(period, timestamp):
+    """返回时间戳（YYYYmmdd_HHMMSS）所在周期的标识，同一周期内的时间戳标识相同"""
+    if period == "hourly":
+        return timestamp[:11]
+    if period == "daily":
+        return timestamp[:8]
+    if period == "weekly":
+        return datetime.date(int(timestamp[:4]), int(timestamp[4:6]), int(timestamp[6:8])).isocalendar()[:2]
+    if period == "monthly":
+        return timestamp[:6]
+    if period == "yearly":
+        return timestamp[:4]
+    raise ValueError(f"不支持的保留周期: {period}，可选值: {', '.join(RETENTION_PERIODS)}")
+
+
+def plan_retention(backups, keep_last, policy=None):
+    """计算需要删除的备份：backups为按时间升序排列的 (名称, 时间戳, 备份类型标记) 列表，返回需要删除的名称列表；
+    保留最新的keep_last个，并按分层保留策略保留各周期中最新的备份；保留的增量/差异备份所在备份链中更早的备份一并保留"""
+    remaining = {period: count for period, count in (policy or {}).items() if count}
+    for period in remaining:
+        if period not in RETENTION_PERIODS:
+            raise ValueError(f"不支持的保留周期: {period}，可选值: {', '.join(RETENTION_PERIODS)}")
+    keep = [False] * len(backups)
+    last_keys = {}
+    # 从新到旧遍历一遍：每遇到一个新的周期，该周期内最新的备份占用该层级的一个名额
+    for position in range(len(backups) - 1, -1, -1):
+        timestamp = backups[position][1]
+        if len(backups) - position <= keep_last:
+            keep[position] = True
+        for period, count in remaining.items():
+            if count <= 0:
+                continue
+            key = retention_period_key(period, timestamp)
+            if key != last_keys.get(period):
+                last_keys[period] = key
+                remaining[period] = count - 1
+                keep[position] = True
+    # 从旧到新遍历一遍：保留的增量/差异备份依赖的全量备份及其间的备份一并保留
+    pending = []
+    for position, (name, timestamp, kind) in enumerate(backups):
+        if kind not in ("incr", "diff"):
+            pending = []
+        pending.append(position)
+        if keep[position]:
+            if kind in ("incr", "diff"):
+                for dependency in pending:
+                    keep[dependency] = True
+            pending = []
+    return [backup[0] for backup, kept in zip(backups, keep) if not kept]
+
+
+def select_backups_to_delete(prefix, filenames, max_keep, policy=None):
+    """按保留策略选出需要删除的旧备份（时间戳从文件名中解析），保证保留的增量/差异备份所依赖的整条备份链不被拆散"""
+    pattern = re.compile(f"^{backup_filename_pattern(prefix)}$")
+    backups = []
+    for name in set(filenames):
+        match = pattern.match(name)
+        if match:
+            backups.append((name, match.group(1), match.group(2)))
+    backups.sort(key=lambda backup: (backup[1], backup[0]))
+    return plan_retention(backups, max_keep, policy)
+
+
+class _HashingReader:
+    """读取时同步计算内容哈希的文件包装器，避免为计算哈希额外读取一遍文件"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+class _SizedReader:
+    """按扫描时的大小读取文件：读取期间文件变短时以0补足、变长时截断，保证tar条目头中的大小与数据一致"""
+
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self._remaining = size
+        self.changed = False
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._fileobj.read(size)
+        if len(data) < size:
+            self.changed = True
+            data += bytes(size - len(data))
+        self._remaining -= size
+        if not self._remaining and not self.changed and self._fileobj.read(1):
+            self.changed = True
+        return data
+
+
+class FileCloner:
+    """复制单个文件：优先使用reflink（FICLONE），不支持时依次改用copy_file_range和普通复制，并统计各方式复制的文件数"""
+
+    FICLONE = 0x40049409
+    # 这些错误表示文件系统或内核不支持该复制方式（如不在同一文件系统上），之后的文件直接使用下一种方式
+    UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS)
+
     def __init__(self):
-        # 初始化配置
-        self.source_dir = SOURCE_DIR
-        self.webdav_base_url = WEBDAV_BASE_URL.rstrip('/')
-        self.webdav_upload_dir = WEBDAV_UPLOAD_DIR
-        self.webdav_user = WEBDAV_USER
-        self.webdav_pass = WEBDAV_PASS
-        self.local_backup_dir = LOCAL_BACKUP_DIR
-        self.backup_prefix = BACKUP_PREFIX
-        self.max_remote_backups = MAX_REMOTE_BACKUPS
-        self.max_local_backups = MAX_LOCAL_BACKUPS
-        self.backup_format = BACKUP_FORMAT
+        self.reflink = sys.platform.startswith("linux")
+        self.copy_range = hasattr(os, "copy_file_range")
+        self.counts = Counter()
+
+    def copy(self, src_path, dst_path):
+        """复制文件并返回复制得到的文件大小"""
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            if self.reflink:
+                try:
+                    import fcntl
+                    fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+                    self.counts["reflink"] += 1
+                    return os.fstat(dst.fileno()).st_size
+                except OSError as e:
+                    if e.errno not in self.UNSUPPORTED_ERRORS:
+                        raise
+                    self.reflink = False
+            if self.copy_range:
+                try:
+                    while os.copy_file_range(src.fileno(), dst.fileno(), 64 * 1024 * 1024):
+                        pass
+                    self.counts["copy_file_range"] += 1
+                    return os.fstat(dst.fileno()).st_size
+                except OSError as e:
+                    if e.errno not in self.UNSUPPORTED_ERRORS:
+                        raise
+                    self.copy_range = False
+                    os.lseek(src.fileno(), 0, os.SEEK_SET)
+                    os.lseek(dst.fileno(), 0, os.SEEK_SET)
+                    os.ftruncate(dst.fileno(), 0)
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+            self.counts["copy"] += 1
+            return dst.tell()
+
+
+def resolve_worker_count(workers):
+    """解析并行线程数配置，0或负数表示使用全部CPU核心"""
+    if workers is None or workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+
+def free_disk_space(path):
+    """path所在文件系统中当前用户可用的空间（字节），无法获取时返回None"""
+    try:
+        if hasattr(os, "statvfs"):
+            stat = os.statvfs(path)
+            return stat.f_bavail * stat.f_frsize
+        return shutil.disk_usage(path).free
+    except OSError:
+        return None
+
+
+def deflate_block(data, level, final):
+    """独立压缩一个数据块为原始deflate数据
+
+    非最后一块以同步刷新结束（字节对齐且不带结束标记），因此各块的输出可以直接首尾拼接成一个合法的deflate流
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+def gzip_member(data, level):
+    """将一个数据块压缩为完整的gzip成员（头部 + deflate数据 + CRC32与长度尾部）"""
+    xfl = b"\x02" if level >= 9 else (b"\x04" if level <= 1 else b"\x00")
+    header = b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + xfl + b"\xff"
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + deflate_block(data, level, True) + trailer
+
+
+class ParallelGzipWriter:
+    """pigz风格的并行gzip压缩：数据按块在线程池中独立压缩，按顺序输出为标准的多成员gzip流
+
+    compress_member可替换为其他格式的整块压缩函数（xz流、lz4帧等同样可以首尾拼接），用于这些格式的并行压缩
+    """
+
+    def __init__(self, fileobj, workers, block_size, level=9, compress_member=None):
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._level = level
+        self._compress_member = compress_member or gzip_member
+        self._workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = bytearray()
+        self._futures = deque()
+        self._members_written = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # 每个独立成员的起点 (压缩后偏移, 压缩前偏移)，可从任一起点开始解压，用于随机访问索引
+        self.restart_points = []
+        self._uncompressed_out = 0
+
+    def write(self, data):
+        self._pending += data
+        self.bytes_in += len(data)
+        while len(self._pending) >= self._block_size:
+            block = bytes(self._pending[:self._block_size])
+            del self._pending[:self._block_size]
+            self._submit(block)
+        return len(data)
+
+    def set_level(self, level):
+        """切换后续数据的压缩级别：已缓存的数据先按原级别单独成块，切换点之后的数据使用新级别"""
+        if level == self._level:
+            return
+        if self._pending:
+            self._submit(bytes(self._pending))
+            self._pending = bytearray()
+        self._level = level
+
+    def _submit(self, block):
+        # zlib（以及lzma、lz4）在压缩时会释放GIL，线程池即可利用多核
+        self._futures.append((self._pool.submit(self._compress_member, block, self._level), len(block)))
+        # 限制在途块数量，避免内存无限增长
+        while len(self._futures) > self._workers * 2:
+            self._write_next()
+
+    def _write_next(self):
+        future, length = self._futures.popleft()
+        data = future.result()
+        self.restart_points.append((self.bytes_out, self._uncompressed_out))
+        self._fileobj.write(data)
+        self._members_written += 1
+        self.bytes_out += len(data)
+        self._uncompressed_out += length
+
+    def flush(self):
+        pass
+
+    def close(self):
+        try:
+            if self._pending or self._members_written + len(self._futures) == 0:
+                self._submit(bytes(self._pending))
+                self._pending = bytearray()
+            while self._futures:
+                self._write_next()
+        finally:
+            self._pool.shutdown(wait=True)
+
+
+class TarCodec:
+    """tar流的压缩格式：open返回写入端（close时结束压缩流，不关闭底层文件），compress用于抽样测试压缩级别"""
+
+    name = None
+    default_level = None
+    auto_levels = ()
+    package = None
+    # 已压缩文件使用的压缩级别，None表示不支持按文件切换
+    store_level = None
+    # 是否可以输出由独立压缩块拼接而成的流（可从块的起点开始解压，用于随机访问索引）
+    restartable = False
+
+    def load(self):
+        """导入所需的模块，未安装时抛出带安装提示的ImportError"""
+        return None
+
+    def open(self, fileobj, level, workers, block_size, switchable=False, blocks=False):
+        """switchable为True时返回支持set_level按文件切换压缩级别的写入端，blocks为True时返回按块独立压缩的写入端"""
+        raise NotImplementedError
+
+    def compress(self, data, level):
+        raise NotImplementedError
+
+    def decompressor(self):
+        """返回解压单个压缩块（或整个流）的解压对象，具有decompress、eof和unused_data"""
+        raise NotImplementedError
+
+
+class GzipCodec(TarCodec):
+    name = "tar.gz"
+    default_level = 9
+    auto_levels = (1, 3, 6, 9)
+    # 0级deflate即为存储块，几乎不消耗CPU
+    store_level = 0
+    restartable = True
+
+    def open(self, fileobj, level, workers, block_size, switchable=False, blocks=False):
+        if workers > 1 or switchable or blocks:
+            return ParallelGzipWriter(fileobj, max(workers, 1), block_size, level)
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level)
+
+    def compress(self, data, level):
+        return zlib.compress(data, level)
+
+    def decompressor(self):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+
+class ZstdCodec(TarCodec):
+    name = "tar.zst"
+    default_level = 3
+    auto_levels = (1, 3, 6, 9, 12, 15, 19)
+    package = "zstandard"
+
+    def load(self):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("tar.zst格式需要安装zstandard: pip install zstandard")
+        return zstandard
+
+    def open(self, fileobj, level, workers, block_size, switchable=False, blocks=False):
+        # zstd自带多线程压缩，输出为单个zstd帧
+        compressor = self.load().ZstdCompressor(level=level, threads=workers if workers > 1 else 0)
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    def compress(self, data, level):
+        return self.load().ZstdCompressor(level=level).compress(data)
+
+    def decompressor(self):
+        return self.load().ZstdDecompressor().decompressobj()
+
+
+class Lz4Codec(TarCodec):
+    name = "tar.lz4"
+    default_level = 0
+    auto_levels = (0, 3, 6, 9, 12)
+    package = "lz4"
+
+    def load(self):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError("tar.lz4格式需要安装lz4: pip install lz4")
+        return lz4.frame
+
+    def _compress_frame(self, data, level):
+        return self.load().compress(data, compression_level=level)
+
+    restartable = True
+
+    def open(self, fileobj, level, workers, block_size, switchable=False, blocks=False):
+        if workers > 1 or blocks:
+            # 多个独立的lz4帧首尾拼接仍是合法的lz4流
+            return ParallelGzipWriter(fileobj, max(workers, 1), block_size, level, compress_member=self._compress_frame)
+        return self.load().LZ4FrameFile(fileobj, mode='wb', compression_level=level)
+
+    def compress(self, data, level):
+        return self._compress_frame(data, level)
+
+    def decompressor(self):
+        return self.load().LZ4FrameDecompressor()
+
+
+class XzCodec(TarCodec):
+    name = "tar.xz"
+    default_level = 6
+    auto_levels = (0, 1, 3, 6)
+    # lzma没有存储模式，已压缩文件使用最快的0级
+    store_level = 0
+    restartable = True
+
+    def _compress_stream(self, data, level):
+        return lzma.compress(data, preset=level)
+
+    def open(self, fileobj, level, workers, block_size, switchable=False, blocks=False):
+        if workers > 1 or switchable or blocks:
+            # 多个独立的xz流首尾拼接仍是合法的xz文件（xz、tar -J均可直接解压）
+            return ParallelGzipWriter(fileobj, max(workers, 1), block_size, level, compress_member=self._compress_stream)
+        return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+
+    def compress(self, data, level):
+        return self._compress_stream(data, level)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+# 支持的tar压缩格式，键为BACKUP_FORMAT的取值（同时也是备份文件扩展名）
+TAR_CODECS = {codec.name: codec for codec in (GzipCodec(), ZstdCodec(), Lz4Codec(), XzCodec())}
+
+# 全部备份格式
+BACKUP_FORMATS = tuple(TAR_CODECS) + ("zip",)
+
+
+class IndexedTarFile(tarfile.TarFile):
+    """写入时记录每个成员数据在tar流中的位置，用于生成随机访问索引"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 每项为 [名称, 类型, 大小, 数据偏移, 修改时间, 权限, 链接目标]
+        self.index_members = []
+
+    def addfile(self, tarinfo, fileobj=None):
+        super().addfile(tarinfo, fileobj)
+        size = tarinfo.size if tarinfo.isreg() else 0
+        # 数据位于条目头之后，按512字节块对齐，写完后self.offset指向数据块的末尾
+        data_offset = self.offset - (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+        self.index_members.append([tarinfo.name, tarinfo.type.decode('ascii'), size, data_offset,
+                                   int(tarinfo.mtime), tarinfo.mode & 0o7777, tarinfo.linkname])
+
+
+def iter_decompressed(chunks, codec):
+    """解压由多个独立压缩块首尾拼接而成的数据流，逐块返回解压后的数据"""
+    decompressor = codec.decompressor()
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            # 一个压缩块结束，剩余数据属于下一个块
+            chunk = decompressor.unused_data
+            decompressor = codec.decompressor()
+
+
+def iter_file_range(fileobj, start, length, chunk_size=64 * 1024):
+    """读取文件中从start开始的length字节，远程文件使用单个范围请求流式下载"""
+    if hasattr(fileobj, "iter_range"):
+        yield from fileobj.iter_range(start, length, chunk_size)
+        return
+    fileobj.seek(start)
+    while length > 0:
+        data = fileobj.read(min(chunk_size, length))
+        if not data:
+            break
+        length -= len(data)
+        yield data
+
+
+class RemoteRangeFile(io.RawIOBase):
+    """以HTTP范围请求按需读取远程文件的可随机访问文件对象（zipfile可直接读取其中央目录和单个条目）"""
+
+    def __init__(self, session, url, size, timeout=None):
+        self._session = session
+        self._url = url
+        self._size = size
+        self._position = 0
+        self._timeout = timeout or (CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME)
+        self.downloaded = 0
+        self.requests = 0
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._position)
+        if length <= 0:
+            return 0
+        filled = 0
+        for chunk in self.iter_range(self._position, length, length):
+            buffer[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+        self._position += filled
+        return filled
+
+    def iter_range(self, start, length, chunk_size=64 * 1024):
+        """以单个范围请求流式下载 [start, start+length) 区间的数据"""
+        length = min(length, self._size - start)
+        if length <= 0:
+            return
+        self.requests += 1
+        headers = {"Range": f"bytes={start}-{start + length - 1}"}
+        with self._session.get(self._url, headers=headers, stream=True, timeout=self._timeout) as response:
+            if response.status_code != 206 and not (response.status_code == 200 and start == 0):
+                raise IOError(f"范围请求失败 (HTTP状态码: {response.status_code})，服务器可能不支持Range请求")
+            remaining = length
+            for chunk in response.iter_content(chunk_size):
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+                self.downloaded += len(chunk)
+                yield chunk
+                if remaining <= 0:
+                    break
+            if remaining > 0:
+                raise IOError("范围请求返回的数据不完整")
+
+
+class RemotePartsFile(RemoteRangeFile):
+    """以manifest方式分片保存的远程备份：按清单把偏移换算到各个分片，读取方式与RemoteRangeFile相同"""
+
+    def __init__(self, session, parts_url, parts, timeout=None):
+        # 空分片不包含数据，不参与偏移换算
+        self._parts = [RemoteRangeFile(session, f"{parts_url}/{name}", size, timeout) for name, size in parts if size]
+        self._starts = []
+        self._size = 0
+        for part in self._parts:
+            self._starts.append(self._size)
+            self._size += part._size
+        self._position = 0
+
+    @property
+    def downloaded(self):
+        return sum(part.downloaded for part in self._parts)
+
+    @property
+    def requests(self):
+        return sum(part.requests for part in self._parts)
+
+    def iter_range(self, start, length, chunk_size=64 * 1024):
+        """流式下载 [start, start+length) 区间的数据，跨越多个分片时依次对每个分片发送范围请求"""
+        length = min(length, self._size - start)
+        while length > 0:
+            index = bisect.bisect_right(self._starts, start) - 1
+            part = self._parts[index]
+            offset = start - self._starts[index]
+            count = min(length, part._size - offset)
+            yield from part.iter_range(offset, count, chunk_size)
+            start += count
+            length -= count
+
+
+def load_aead(algorithm):
+    """加载加密算法的实现（需要安装cryptography），返回AEAD类"""
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    except ImportError:
+        raise ImportError("加密备份需要安装cryptography: pip install cryptography")
+    algorithms = {"aes-256-gcm": AESGCM, "chacha20-poly1305": ChaCha20Poly1305}
+    if algorithm not in algorithms:
+        raise ValueError(f"不支持的加密算法: {algorithm}，请使用 {', '.join(repr(name) for name in algorithms)}")
+    return algorithms[algorithm]
+
+
+class EncryptionKey:
+    """加密主密钥（来自密钥文件或口令），每个备份文件按随机盐派生独立的内容密钥"""
+
+    KDF_KEY_FILE = 1
+    KDF_SCRYPT = 2
+
+    def __init__(self, master=None, passphrase=None):
+        self.master = master
+        self.passphrase = passphrase
+        self.kdf = self.KDF_KEY_FILE if master is not None else self.KDF_SCRYPT
+
+    @classmethod
+    def from_config(cls):
+        if ENCRYPTION_KEY_FILE:
+            with open(os.path.expanduser(ENCRYPTION_KEY_FILE), 'rb') as f:
+                return cls(master=cls.parse_key(f.read()))
+        if ENCRYPTION_PASSPHRASE:
+            return cls(passphrase=ENCRYPTION_PASSPHRASE.encode('utf-8'))
+        raise ValueError("使用加密时需要设置ENCRYPTION_KEY_FILE或ENCRYPTION_PASSPHRASE")
+
+    @staticmethod
+    def parse_key(data):
+        """解析密钥文件内容：32字节的原始数据、64位十六进制或base64文本"""
+        if len(data) == 32:
+            return data
+        text = data.strip()
+        try:
+            key = bytes.fromhex(text.decode('ascii')) if len(text) == 64 else base64.b64decode(text, validate=True)
+        except ValueError:
+            key = b""
+        if len(key) != 32:
+            raise ValueError("密钥文件需包含32字节的密钥（原始数据、64位十六进制或base64文本）")
+        return key
+
+    def derive(self, kdf, salt):
+        """按加密文件头中记录的派生方式和盐派生该文件的内容密钥"""
+        if kdf == self.KDF_KEY_FILE:
+            if self.master is None:
+                raise ValueError("该备份使用密钥文件加密，请设置ENCRYPTION_KEY_FILE")
+            return hmac.new(self.master, b"webdav-backup-chunk-key" + salt, hashlib.sha256).digest()
+        if kdf == self.KDF_SCRYPT:
+            if self.passphrase is None:
+                raise ValueError("该备份使用口令加密，请设置ENCRYPTION_PASSPHRASE")
+            return hashlib.scrypt(self.passphrase, salt=salt, n=2 ** 15, r=8, p=1, maxmem=64 * 1024 * 1024, dklen=32)
+        raise ValueError(f"不支持的密钥派生方式: {kdf}")
+
+
+class ChunkCipher:
+    """分块认证加密：文件头记录算法、块大小、盐和nonce前缀，之后每块明文单独加密并附带认证标签。
+    nonce由前缀、块序号和末块标记组成，文件头作为附加认证数据，块被截断、重排或替换时解密失败"""
+
+    MAGIC = b"WDBKENC1"
+    HEADER = struct.Struct(">8sBBxxI16s7s")
+    TAG_SIZE = 16
+    ALGORITHMS = {"aes-256-gcm": 1, "chacha20-poly1305": 2}
+
+    def __init__(self, key, algorithm, chunk_size, kdf, salt, nonce_prefix):
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.block_size = chunk_size + self.TAG_SIZE
+        self.header = self.HEADER.pack(self.MAGIC, self.ALGORITHMS[algorithm], kdf, chunk_size, salt, nonce_prefix)
+        self._nonce_prefix = nonce_prefix
+        self._aead = load_aead(algorithm)(key.derive(kdf, salt))
+
+    @classmethod
+    def create(cls, key, algorithm=None, chunk_size=None):
+        """为新的加密文件生成随机盐和nonce前缀"""
+        algorithm = algorithm or ENCRYPTION_ALGORITHM
+        load_aead(algorithm)
+        chunk_size = chunk_size or max(1, int(ENCRYPTION_CHUNK_KB * 1024))
+        return cls(key, algorithm, chunk_size, key.kdf, os.urandom(16), os.urandom(7))
+
+    @classmethod
+    def from_header(cls, key, header):
+        if len(header) < cls.HEADER.size:
+            raise ValueError("加密文件头不完整")
+        magic, algorithm_id, kdf, chunk_size, salt, nonce_prefix = cls.HEADER.unpack(header[:cls.HEADER.size])
+        algorithm = next((name for name, value in cls.ALGORITHMS.items() if value == algorithm_id), None)
+        if magic != cls.MAGIC or algorithm is None or chunk_size <= 0:
+            raise ValueError("不是可识别的加密备份文件")
+        return cls(key, algorithm, chunk_size, kdf, salt, nonce_prefix)
+
+    def _nonce(self, index, final):
+        return self._nonce_prefix + struct.pack(">IB", index, 1 if final else 0)
+
+    def encrypt_chunk(self, index, data, final):
+        return self._aead.encrypt(self._nonce(index, final), data, self.header)
+
+    def decrypt_chunk(self, index, data, final):
+        try:
+            return self._aead.decrypt(self._nonce(index, final), data, self.header)
+        except Exception:
+            raise IOError(f"第 {index + 1} 个加密块解密失败（密钥错误或数据已被截断、修改）")
+
+    def chunk_count(self, encrypted_size):
+        """加密文件中的块数（末块至少包含认证标签）"""
+        data_size = encrypted_size - self.HEADER.size
+        if data_size < self.TAG_SIZE:
+            raise ValueError("加密文件不完整")
+        return -(-data_size // self.block_size)
+
+    def plaintext_size(self, encrypted_size):
+        return encrypted_size - self.HEADER.size - self.chunk_count(encrypted_size) * self.TAG_SIZE
+
+
+class EncryptingWriter:
+    """把写入的数据按固定大小分块加密后写入下层文件对象，close时写出带末块标记的最后一块（不关闭下层文件）"""
+
+    def __init__(self, fileobj, cipher):
+        self.fileobj = fileobj
+        self.cipher = cipher
+        self.bytes_in = 0
+        self._buffer = bytearray()
+        self._index = 0
+        self._closed = False
+        fileobj.write(cipher.header)
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+        chunk_size = self.cipher.chunk_size
+        # 缓冲区中至少留下一个字节，末块（明文长度可能为0）在close时写出
+        full = (len(self._buffer) - 1) // chunk_size
+        if full > 0:
+            with memoryview(self._buffer) as view:
+                for offset in range(0, full * chunk_size, chunk_size):
+                    self.fileobj.write(self.cipher.encrypt_chunk(self._index, view[offset:offset + chunk_size], False))
+                    self._index += 1
+            del self._buffer[:full * chunk_size]
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.fileobj.write(self.cipher.encrypt_chunk(self._index, bytes(self._buffer), True))
+        self._buffer = bytearray()
+
+
+class DecryptingReader(io.RawIOBase):
+    """按需读取并解密分块加密文件的可随机访问文件对象（下层为本地文件或RemoteRangeFile），只读取所需的加密块"""
+
+    def __init__(self, source, encrypted_size, key):
+        self.source = source
+        self.cipher = ChunkCipher.from_header(key, b"".join(iter_file_range(source, 0, ChunkCipher.HEADER.size)))
+        self.size = self.cipher.plaintext_size(encrypted_size)
+        self._encrypted_size = encrypted_size
+        self._count = self.cipher.chunk_count(encrypted_size)
+        self._position = 0
+        self._cached = (None, b"")
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+    def _iter_chunks(self, first, last):
+        """连续读取第first到last个加密块（远程文件使用单个范围请求），逐块解密返回 (序号, 明文)"""
+        header_size = ChunkCipher.HEADER.size
+        start = header_size + first * self.cipher.block_size
+        end = min(header_size + (last + 1) * self.cipher.block_size, self._encrypted_size)
+        buffer = bytearray()
+        index = first
+        for data in iter_file_range(self.source, start, end - start, self.cipher.block_size):
+            buffer += data
+            while index <= last:
+                length = min(self.cipher.block_size, self._encrypted_size - header_size - index * self.cipher.block_size)
+                if len(buffer) < length:
+                    break
+                yield index, self.cipher.decrypt_chunk(index, bytes(buffer[:length]), index == self._count - 1)
+                del buffer[:length]
+                index += 1
+        if index <= last:
+            raise IOError("加密数据不完整")
+
+    def readinto(self, buffer):
+        chunk_size = self.cipher.chunk_size
+        filled = 0
+        while filled < len(buffer) and self._position < self.size:
+            index = self._position // chunk_size
+            if self._cached[0] != index:
+                for cached in self._iter_chunks(index, index):
+                    self._cached = cached
+            offset = self._position - index * chunk_size
+            data = self._cached[1][offset:offset + len(buffer) - filled]
+            buffer[filled:filled + len(data)] = data
+            filled += len(data)
+            self._position += len(data)
+        return filled
+
+    def iter_range(self, start, length, chunk_size=64 * 1024):
+        """解密并返回明文中 [start, start+length) 区间的数据，只读取覆盖该区间的加密块"""
+        length = min(length, self.size - start)
+        if length <= 0:
+            return
+        plain_chunk = self.cipher.chunk_size
+        for index, data in self._iter_chunks(start // plain_chunk, (start + length - 1) // plain_chunk):
+            base = index * plain_chunk
+            yield data[max(start - base, 0):min(start + length - base, len(data))]
+
+    def close(self):
+        super().close()
+        self.source.close()
+
+
+def encrypt_bytes(key, data):
+    """以分块加密格式加密一段完整的数据（用于随机访问索引等小文件）"""
+    output = io.BytesIO()
+    writer = EncryptingWriter(output, ChunkCipher.create(key))
+    writer.write(data)
+    writer.close()
+    return output.getvalue()
+
+
+def decrypt_bytes(key, data):
+    with DecryptingReader(io.BytesIO(data), len(data), key) as reader:
+        return reader.read()
+
+
+def decrypt_backup_file(input_path, output_path, key):
+    """把本地的加密备份文件解密为普通的压缩包（可用tar、unzip等工具直接解压），返回解密后的大小"""
+    temp_path = output_path + ".tmp"
+    try:
+        with DecryptingReader(open(input_path, 'rb'), os.path.getsize(input_path), key) as reader:
+            with open(temp_path, 'wb') as f:
+                for data in reader.iter_range(0, reader.size):
+                    f.write(data)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return reader.size
+
+
+class _ChunkReader:
+    """把数据块迭代器包装为只读文件对象（供tarfile以流式模式读取），position为已读取数据在整个流中的位置"""
+
+    def __init__(self, chunks, position=0):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self.position = position
+
+    def read(self, size=-1):
+        parts = [self._buffer]
+        available = len(self._buffer)
+        while size < 0 or available < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            available += len(chunk)
+        data = b"".join(parts)
+        if size >= 0:
+            data, self._buffer = data[:size], data[size:]
+        else:
+            self._buffer = b""
+        self.position += len(data)
+        return data
+
+    def iter_exact(self, size, chunk_size=1024 * 1024):
+        """依次返回接下来的size字节，数据不足时抛出异常"""
+        while size > 0:
+            data = self.read(min(chunk_size, size))
+            if not data:
+                raise IOError("解压后的数据不完整")
+            size -= len(data)
+            yield data
+
+
+class ParallelZipWriter:
+    """zip格式的并行压缩：每个文件按块并行deflate，再按顺序写出zip条目（本地文件头、压缩数据、数据描述符），最后写入中央目录
+
+    条目的校验和与大小记录在数据之后的数据描述符中，输出端不需要支持seek（流式上传时同样适用）；
+    读取文件中途出错时该条目不写入中央目录（已写出的数据成为不被引用的空间），解压时不会出现内容不完整的文件
+    """
+
+    # 超过此大小的条目及中央目录使用ZIP64格式（与zipfile相同）
+    ZIP64_LIMIT = (1 << 31) - 1
+    # 标志位：大小与校验和记录在数据描述符中；文件名为UTF-8编码
+    FLAG_DATA_DESCRIPTOR = 0x08
+    FLAG_UTF8 = 0x800
+
+    def __init__(self, fileobj, workers, block_size):
+        self._fileobj = fileobj
+        self._workers = workers
+        self._block_size = block_size
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        # 按写入顺序排列的待处理项：('start', zinfo) / ('block', future) / ('end', crc, size) / ('abort',)
+        self._items = deque()
+        self._inflight_blocks = 0
+        self._offset = 0
+        # 当前正在写出的条目及已写入中央目录的条目：(ZipInfo, 是否使用ZIP64)
+        self._current = None
+        self._entries = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_file(self, file_path, arcname, hasher=None, store=False, zinfo=None):
+        """读取文件并提交压缩任务，store为True时只存储不压缩，已有扫描得到的ZipInfo时直接使用（出错时抛出异常，调用方负责记录并继续）"""
+        import zipfile
+
+        if zinfo is None:
+            zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+        zinfo.compress_type = zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED
+        with open(file_path, 'rb') as f:
+            self._items.append(('start', zinfo))
+            crc = 0
+            size = 0
+            try:
+                block = f.read(self._block_size)
+                while True:
+                    next_block = f.read(self._block_size) if len(block) == self._block_size else b""
+                    final = not next_block
+                    crc = zlib.crc32(block, crc)
+                    size += len(block)
+                    if hasher is not None:
+                        hasher.update(block)
+                    self._submit_block(block, final, store)
+                    if final:
+                        break
+                    block = next_block
+            except BaseException:
+                # 读取中途出错：放弃该条目（不写入中央目录），由调用方跳过该文件
+                self._items.append(('abort',))
+                raise
+            self._items.append(('end', crc & 0xffffffff, size))
+
+    def writestr(self, zinfo_or_arcname, data):
+        """写入内存中的数据（目录条目、备份清单），参数与zipfile.ZipFile.writestr相同"""
+        import zipfile
+
+        zinfo = zinfo_or_arcname
+        if not isinstance(zinfo, zipfile.ZipInfo):
+            zinfo = zipfile.ZipInfo(zinfo_or_arcname, time.localtime(time.time())[:6])
+            if zinfo.is_dir():
+                zinfo.external_attr = 0o40775 << 16 | 0x10
+            else:
+                zinfo.external_attr = 0o600 << 16
+        store = zinfo.is_dir() or not data
+        zinfo.compress_type = zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED
+        self._items.append(('start', zinfo))
+        self._submit_block(data, True, store)
+        self._items.append(('end', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    def _submit_block(self, block, final, store=False):
+        if store:
+            # 存储的数据原样写入，不经过线程池
+            done = Future()
+            done.set_result(block)
+            self._items.append(('block', done))
+        else:
+            self._items.append(('block', self._pool.submit(deflate_block, block, -1, final)))
+        self._inflight_blocks += 1
+        # 限制在途块数量，避免内存无限增长
+        while self._inflight_blocks > self._workers * 2:
+            self._process_next()
+
+    def _write(self, data):
+        self._fileobj.write(data)
+        self._offset += len(data)
+
+    def _process_next(self):
+        item = self._items.popleft()
+        if item[0] == 'start':
+            zinfo = item[1]
+            zip64 = zinfo.file_size * 1.05 > self.ZIP64_LIMIT
+            zinfo.header_offset = self._offset
+            zinfo.compress_size = 0
+            zinfo.flag_bits = self.FLAG_DATA_DESCRIPTOR
+            self._current = (zinfo, zip64)
+            self._write(self._local_header(zinfo, zip64))
+        elif item[0] == 'block':
+            data = item[1].result()
+            self._inflight_blocks -= 1
+            if self._current is not None:
+                self._current[0].compress_size += len(data)
+                self._write(data)
+        elif item[0] == 'end':
+            zinfo, zip64 = self._current
+            self._current = None
+            zinfo.CRC, zinfo.file_size = item[1], item[2]
+            if not zip64 and max(zinfo.file_size, zinfo.compress_size) > self.ZIP64_LIMIT:
+                # 文件在归档期间变大，超出了条目头中声明的格式，放弃该条目
+                print(f"警告：文件 {zinfo.filename} 在归档期间变大，超出zip格式的限制，已跳过")
+                return
+            self._write(struct.pack("<4sL2Q" if zip64 else "<4s3L", b"PK\x07\x08",
+                                    zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+            self._entries.append((zinfo, zip64))
+        else:
+            self._current = None
+
+    @staticmethod
+    def _dos_time(zinfo):
+        year, month, day, hour, minute, second = zinfo.date_time
+        return (hour << 11 | minute << 5 | second // 2), ((year - 1980) << 9 | month << 5 | day)
+
+    def _encoded_name(self, zinfo):
+        try:
+            return zinfo.filename.encode('ascii'), 0
+        except UnicodeEncodeError:
+            return zinfo.filename.encode('utf-8'), self.FLAG_UTF8
+
+    def _local_header(self, zinfo, zip64):
+        name, flags = self._encoded_name(zinfo)
+        dostime, dosdate = self._dos_time(zinfo)
+        # ZIP64条目的大小记录在扩展字段中（写出数据前未知，填0），数据描述符中的大小为8字节
+        extra = struct.pack("<2H2Q", 1, 16, 0, 0) if zip64 else b""
+        size = 0xffffffff if zip64 else 0
+        return struct.pack("<4s5H3L2H", b"PK\x03\x04", 45 if zip64 else 20, zinfo.flag_bits | flags,
+                           zinfo.compress_type, dostime, dosdate, 0, size, size, len(name), len(extra)) + name + extra
+
+    def _central_directory_entry(self, zinfo, zip64):
+        name, flags = self._encoded_name(zinfo)
+        dostime, dosdate = self._dos_time(zinfo)
+        # 超出32位范围的字段在中央目录中以0xffffffff表示，实际值按顺序记录在ZIP64扩展字段中
+        values = [zinfo.file_size, zinfo.compress_size, zinfo.header_offset]
+        large = [value for value in values if value > self.ZIP64_LIMIT]
+        extra = struct.pack(f"<2H{len(large)}Q", 1, 8 * len(large), *large) if large else b""
+        file_size, compress_size, header_offset = (0xffffffff if value > self.ZIP64_LIMIT else value for value in values)
+        version = 45 if zip64 or large else 20
+        return struct.pack("<4s6H3L5H2L", b"PK\x01\x02", zinfo.create_system << 8 | version, version,
+                           zinfo.flag_bits | flags, zinfo.compress_type, dostime, dosdate, zinfo.CRC,
+                           compress_size, file_size, len(name), len(extra), 0, 0, zinfo.internal_attr,
+                           zinfo.external_attr, header_offset) + name + extra
+
+    def _write_end_record(self):
+        directory_offset = self._offset
+        for zinfo, zip64 in self._entries:
+            self._write(self._central_directory_entry(zinfo, zip64))
+        directory_size = self._offset - directory_offset
+        count = len(self._entries)
+        if count >= 0xffff or directory_offset > self.ZIP64_LIMIT or directory_size > self.ZIP64_LIMIT:
+            # ZIP64结束记录及其定位符
+            zip64_offset = self._offset
+            self._write(struct.pack("<4sQ2H2L4Q", b"PK\x06\x06", 44, 45, 45, 0, 0, count, count,
+                                    directory_size, directory_offset))
+            self._write(struct.pack("<4sLQL", b"PK\x06\x07", 0, zip64_offset, 1))
+            count = min(count, 0xffff)
+            directory_offset = min(directory_offset, 0xffffffff)
+            directory_size = min(directory_size, 0xffffffff)
+        self._write(struct.pack("<4s4H2LH", b"PK\x05\x06", 0, 0, count, count, directory_size, directory_offset, 0))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            while self._items:
+                self._process_next()
+            self._write_end_record()
+        finally:
+            self._pool.shutdown(wait=True)
+
+
+def byte_entropy(data):
+    """计算数据的字节熵（位/字节），已压缩或加密的数据接近8"""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+class CompressibilityFilter:
+    """判断文件是否已经压缩过（扩展名或开头数据的字节熵），这类文件只存储不压缩，并统计跳过的数据量"""
+
+    # 用于估算节省的CPU时间的样本上限
+    REPORT_SAMPLE_BYTES = 1024 * 1024
+
+    def __init__(self, extensions=None, sample_size=None, threshold=None):
+        self.extensions = tuple(ext.lower() for ext in (INCOMPRESSIBLE_EXTENSIONS if extensions is None else extensions))
+        self.sample_size = int(ENTROPY_SAMPLE_KB * 1024) if sample_size is None else sample_size
+        self.threshold = ENTROPY_THRESHOLD if threshold is None else threshold
+        self.stored_files = 0
+        self.stored_bytes = 0
+        self._samples = bytearray()
+        self._tar_output = None
+
+    def is_incompressible(self, file_path, size):
+        """判断文件是否已压缩，是则计入统计"""
+        if size < self.sample_size:
+            return False
+        matched = file_path.lower().endswith(self.extensions)
+        sample = b""
+        if not matched or len(self._samples) < self.REPORT_SAMPLE_BYTES:
+            with open(file_path, 'rb') as f:
+                sample = f.read(self.sample_size)
+        if not matched and byte_entropy(sample) < self.threshold:
+            return False
+        self.stored_files += 1
+        self.stored_bytes += size
+        self._samples += sample[:self.REPORT_SAMPLE_BYTES - len(self._samples)]
+        return True
+
+    def attach_tar(self, compressor, level, store_level):
+        """tar格式：写入端支持切换压缩级别时，在每个文件的数据写入前按文件切换级别"""
+        if store_level is not None and hasattr(compressor, "set_level"):
+            self._tar_output = (compressor, level, store_level)
+
+    def prepare_tar_member(self, file_path, size):
+        if self._tar_output is None:
+            return
+        compressor, level, store_level = self._tar_output
+        try:
+            incompressible = self.is_incompressible(file_path, size)
+        except OSError:
+            incompressible = False
+        compressor.set_level(store_level if incompressible else level)
+
+    def report(self, compress, store_compress=None):
+        """输出跳过再压缩的文件数和数据量，并用已跳过文件的样本实测两种方式的耗时差来估算节省的CPU时间"""
+        if not self.stored_files:
+            return
+        saved = None
+        if self._samples:
+            sample = bytes(self._samples)
+            elapsed = 0.0
+            for func, sign in ((compress, 1), (store_compress, -1)):
+                if func is not None:
+                    start_time = time.process_time()
+                    func(sample)
+                    elapsed += sign * (time.process_time() - start_time)
+            saved = max(0.0, elapsed) / len(sample) * self.stored_bytes
+        message = f"已压缩的文件跳过再压缩: {self.stored_files} 个文件（{self.stored_bytes / 1024 / 1024:.2f} MB）"
+        if saved is not None:
+            message += f"，预计节省CPU时间约 {saved:.1f} 秒"
+        print(message)
+
+
+class ExcludeRules:
+    """gitignore风格的排除规则，每条规则在创建时编译为正则表达式，匹配时以最后一条匹配的规则为准"""
+
+    def __init__(self, patterns):
+        self.rules = []
+        for line in patterns:
+            rule = self._compile(line)
+            if rule is not None:
+                self.rules.append(rule)
+        # 没有!规则时结果与顺序无关，把所有规则合并为一个正则表达式，每个路径只匹配一次
+        self._combined = None
+        if self.rules and not any(negate for regex, negate, dir_only in self.rules):
+            self._combined = (
+                re.compile("|".join(regex.pattern for regex, negate, dir_only in self.rules)),
+                re.compile("|".join(regex.pattern for regex, negate, dir_only in self.rules if not dir_only) or "(?!)"),
+            )
+
+    @classmethod
+    def from_config(cls, patterns, pattern_file=None):
+        """由配置的规则列表和规则文件创建，没有任何规则时返回None"""
+        patterns = list(patterns or [])
+        if pattern_file:
+            with open(pattern_file, 'r', encoding='utf-8') as f:
+                patterns.extend(f.read().splitlines())
+        rules = cls(patterns)
+        return rules if rules.rules else None
+
+    @staticmethod
+    def _compile(line):
+        """将一条规则编译为 (正则表达式, 是否为!规则, 是否只匹配目录)，空行和注释返回None"""
+        pattern = line.rstrip()
+        if not pattern or pattern.startswith('#'):
+            return None
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        elif pattern.startswith(('\\!', '\\#')):
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern:
+            return None
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        
+        parts = []
+        i = 0
+        while i < len(pattern):
+            char = pattern[i]
+            if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+                parts.append("(?:.*/)?")
+                i += 3
+            elif pattern.startswith('**', i) and i + 2 == len(pattern) and (i == 0 or pattern[i - 1] == '/'):
+                parts.append(".*")
+                i += 2
+            elif char == '*':
+                parts.append("[^/]*")
+                i += 1
+            elif char == '?':
+                parts.append("[^/]")
+                i += 1
+            elif char == '[' and ']' in pattern[i + 2:]:
+                end = pattern.index(']', i + 2)
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                parts.append("[" + body.replace('\\', '\\\\') + "]")
+                i = end + 1
+            elif char == '\\' and i + 1 < len(pattern):
+                parts.append(re.escape(pattern[i + 1]))
+                i += 2
+            else:
+                parts.append(re.escape(char))
+                i += 1
+        # 不含/的规则匹配任意层级的文件名，否则匹配相对源目录的完整路径
+        regex = ("" if anchored else "(?:.*/)?") + "".join(parts)
+        return re.compile(f"(?:{regex})\\Z"), negate, dir_only
+
+    def excluded(self, rel_path, is_dir):
+        """判断相对源目录的路径（以/分隔）是否被排除"""
+        if self._combined is not None:
+            return (self._combined[0] if is_dir else self._combined[1]).match(rel_path) is not None
+        for regex, negate, dir_only in reversed(self.rules):
+            if (is_dir or not dir_only) and regex.match(rel_path):
+                return not negate
+        return False
+
+
+# 源目录文件清单中的一项，kind为"d"（目录）、"f"（文件）或"l"（符号链接），stat为扫描时取得的stat结果
+ManifestEntry = namedtuple("ManifestEntry", "arcname kind size mtime_ns mode link stat")
+
+
+class SourceScanner:
+    """并行扫描源目录，输出按路径排序的文件清单（每项只stat一次，归档时直接使用清单中的stat结果）
+
+    每个子目录作为一个任务提交到线程池，os.scandir和stat在等待文件系统时释放GIL，
+    目录很多或位于网络文件系统上时多个目录的读取可以重叠进行。被排除的目录不再进入
+    """
+
+    def __init__(self, source_dir, rules=None, workers=None, follow_file_links=False):
+        self.source_dir = source_dir
+        self.root_name = os.path.basename(source_dir)
+        self.rules = rules
+        self.workers = max(1, workers or 1)
+        self.follow_file_links = follow_file_links
+        self.excluded = 0
+        self.warnings = []
+
+    def scan(self):
+        """扫描源目录，返回按路径排序的ManifestEntry列表（目录的内容紧跟在目录之后，与tar递归添加的顺序一致）"""
+        entries = []
+        try:
+            st = os.stat(self.source_dir)
+            entries.append(ManifestEntry(self.root_name, "d", 0, st.st_mtime_ns, st.st_mode, None, st))
+        except OSError:
+            pass
+        
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scan") as pool:
+            pending = {pool.submit(self._scan_dir, self.source_dir, "")}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    dir_entries, sub_dirs = future.result()
+                    entries.extend(dir_entries)
+                    for dir_path, rel_dir in sub_dirs:
+                        pending.add(pool.submit(self._scan_dir, dir_path, rel_dir))
+        
+        # 警告在主线程中统一输出，多任务模式下可以带上任务名称
+        for message in self.warnings:
+            print(message)
+        entries.sort(key=lambda entry: entry.arcname.split(os.sep))
+        return entries
+
+    def _scan_dir(self, dir_path, rel_dir):
+        """读取一个目录，返回 (该目录下的清单项, 需要继续扫描的子目录)"""
+        results = []
+        sub_dirs = []
+        try:
+            with os.scandir(dir_path) as it:
+                dir_entries = list(it)
+        except OSError as e:
+            self.warnings.append(f"警告：无法读取目录 {dir_path}，错误: {str(e)}")
+            return results, sub_dirs
+        
+        arc_dir = os.path.join(self.root_name, *rel_dir.split('/')) if rel_dir else self.root_name
+        for entry in dir_entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            arcname = os.path.join(arc_dir, entry.name)
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if self.rules is not None and self.rules.excluded(rel_path, is_dir):
+                    self.excluded += 1
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if is_dir:
+                    results.append(ManifestEntry(arcname, "d", 0, st.st_mtime_ns, st.st_mode, None, st))
+                    sub_dirs.append((entry.path, rel_path))
+                elif entry.is_symlink():
+                    if self.follow_file_links:
+                        # zip格式与原有方式一致：跟随指向文件的链接，跳过指向目录的链接
+                        if not entry.is_file():
+                            continue
+                        st = entry.stat()
+                        results.append(ManifestEntry(arcname, "f", st.st_size, st.st_mtime_ns, st.st_mode, None, st))
+                    else:
+                        results.append(ManifestEntry(arcname, "l", 0, st.st_mtime_ns, st.st_mode,
+                                                     os.readlink(entry.path), st))
+                elif entry.is_file(follow_symlinks=False):
+                    results.append(ManifestEntry(arcname, "f", st.st_size, st.st_mtime_ns, st.st_mode, None, st))
+            except OSError as e:
+                self.warnings.append(f"警告：无法读取文件信息 {entry.path}，错误: {str(e)}")
+        return results, sub_dirs
+
+
+def is_subpath(path, directory):
+    """判断path是否为directory本身或位于其中"""
+    path = os.path.abspath(path)
+    directory = os.path.abspath(directory)
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+class PollingWatcher:
+    """以轮询方式监视源目录：定期扫描目录，由各项的路径、大小、修改时间和inode计算签名，与上次扫描的签名比较"""
+
+    def __init__(self, source_dir, rules=None, ignore=(), interval=None):
+        self.source_dir = source_dir
+        self.rules = rules
+        self.interval = DAEMON_POLL_INTERVAL_SECONDS if interval is None else interval
+        # 位于源目录内的本地备份目录、快照目录等由备份本身写入，其中的变化不触发备份
+        root_name = os.path.basename(source_dir)
+        self._ignored = tuple(os.path.join(root_name, os.path.relpath(path, source_dir)) for path in ignore
+                              if path and is_subpath(path, source_dir))
+        self._signature = self._scan()
+        self._next_poll = time.monotonic() + self.interval
+
+    def _scan(self):
+        if not os.path.isdir(self.source_dir):
+            return None
+        digest = hashlib.blake2b(digest_size=16)
+        for entry in SourceScanner(self.source_dir, self.rules, SCAN_WORKERS).scan():
+            if self._ignored and any(entry.arcname == path or entry.arcname.startswith(path + os.sep)
+                                     for path in self._ignored):
+                continue
+            # 目录的修改时间只反映其中项目的增删（已由各项本身体现），被排除或忽略的项目变化时也会改变，不计入签名
+            mtime_ns = entry.mtime_ns if entry.kind != "d" else 0
+            digest.update(f"{entry.arcname}\0{entry.kind}\0{entry.size}\0{mtime_ns}\0{entry.stat.st_ino}\0{entry.link}\n"
+                          .encode('utf-8', 'surrogateescape'))
+        return digest.digest()
+
+    def fileno(self):
+        return None
+
+    def timeout(self):
+        """距下次扫描的秒数"""
+        return max(0.0, self._next_poll - time.monotonic())
+
+    def check(self):
+        """到了扫描时间时扫描源目录，返回与上次扫描相比是否有变化"""
+        if time.monotonic() < self._next_poll:
+            return False
+        signature = self._scan()
+        self._next_poll = time.monotonic() + self.interval
+        changed = signature != self._signature
+        self._signature = signature
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """通过inotify（以ctypes调用libc，不需要额外依赖）递归监视源目录：新建或移入的子目录自动加入监视，被排除的目录不监视"""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                  | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    # struct inotify_event: wd, mask, cookie, len，之后是len字节以\0补齐的文件名
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, source_dir, rules=None, ignore=()):
+        if not hasattr(os, "O_CLOEXEC"):
+            raise OSError(errno.ENOSYS, "当前系统不支持inotify")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "当前系统不支持inotify")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1失败: {os.strerror(error)}")
+        self.source_dir = source_dir
+        self.rules = rules
+        self._ignored = tuple(os.path.relpath(path, source_dir).replace(os.sep, '/') for path in ignore
+                              if path and is_subpath(path, source_dir))
+        # 监视描述符 -> 相对源目录的目录路径（以/分隔，源目录本身为空字符串）
+        self._watches = {}
+        try:
+            self._add_tree(source_dir, "")
+        except BaseException:
+            self.close()
+            raise
+
+    def _skipped(self, rel_path, is_dir):
+        if any(rel_path == path or rel_path.startswith(path + '/') for path in self._ignored):
+            return True
+        return self.rules is not None and self.rules.excluded(rel_path, is_dir)
+
+    def _add_watch(self, path, rel_dir):
+        """为一个目录添加监视，目录已不存在（扫描期间被删除）时返回False"""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if rel_dir and error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return False
+            # ENOSPC表示达到fs.inotify.max_user_watches上限
+            raise OSError(error, f"无法监视目录 {path}: {os.strerror(error)}")
+        self._watches[wd] = rel_dir
+        return True
+
+    def _add_tree(self, path, rel_dir):
+        """为目录及其下全部未排除的子目录添加监视"""
+        pending = [(path, rel_dir)]
+        while pending:
+            dir_path, rel = pending.pop()
+            if not self._add_watch(dir_path, rel):
+                continue
+            try:
+                with os.scandir(dir_path) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                child = f"{rel}/{entry.name}" if rel else entry.name
+                with contextlib.suppress(OSError):
+                    if entry.is_dir(follow_symlinks=False) and not self._skipped(child, True):
+                        pending.append((entry.path, child))
+
+    @property
+    def watch_count(self):
+        return len(self._watches)
+
+    def fileno(self):
+        return self.fd
+
+    def timeout(self):
+        return None
+
+    def check(self):
+        """读取已到达的事件，返回其中是否有未被排除的变化"""
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    # 事件队列溢出，部分事件（包括新建的子目录）已丢失：视为有变化，并重新为整个目录树添加监视
+                    changed = True
+                    self._add_tree(self.source_dir, "")
+                    continue
+                if mask & self.IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                rel_dir = self._watches.get(wd)
+                if rel_dir is None:
+                    continue
+                if not name:
+                    # 被监视的目录本身被删除或移动；源目录本身被删除或移动后监视失效，由调用方重新建立监视
+                    if not rel_dir and mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                        raise OSError(errno.ENOENT, f"源目录 {self.source_dir} 已被删除或移动")
+                    changed = True
+                    continue
+                rel_path = f"{rel_dir}/{os.fsdecode(name)}" if rel_dir else os.fsdecode(name)
+                is_dir = bool(mask & self.IN_ISDIR)
+                if self._skipped(rel_path, is_dir):
+                    continue
+                changed = True
+                if is_dir and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self._add_tree(os.path.join(self.source_dir, *rel_path.split('/')), rel_path)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+@functools.lru_cache(maxsize=None)
+def owner_names(uid, gid):
+    """查询用户名和组名（结果缓存，避免每个文件都查询一次）"""
+    uname = gname = ""
+    try:
+        import pwd
+        uname = pwd.getpwuid(uid)[0]
+    except (ImportError, KeyError):
+        pass
+    try:
+        import grp
+        gname = grp.getgrgid(gid)[0]
+    except (ImportError, KeyError):
+        pass
+    return uname, gname
+
+
+def manifest_tarinfo(tar, entry):
+    """根据清单中的stat结果生成TarInfo（与tar.gettarinfo的结果相同，但不再stat文件）"""
+    st = entry.stat
+    tarinfo = tar.tarinfo(entry.arcname.replace(os.sep, "/").lstrip("/"))
+    tarinfo.tarfile = tar
+    tarinfo.size = 0
+    if entry.kind == "f":
+        inode = (st.st_ino, st.st_dev)
+        if st.st_nlink > 1 and inode in tar.inodes and tarinfo.name != tar.inodes[inode]:
+            # 已归档过的硬链接只记录链接目标
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = tar.inodes[inode]
+        else:
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = entry.size
+            if inode[0]:
+                tar.inodes[inode] = tarinfo.name
+    elif entry.kind == "d":
+        tarinfo.type = tarfile.DIRTYPE
+    else:
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = entry.link
+    tarinfo.mode = st.st_mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.mtime = st.st_mtime
+    tarinfo.uname, tarinfo.gname = owner_names(st.st_uid, st.st_gid)
+    return tarinfo
+
+
+def manifest_zipinfo(entry, arcname=None):
+    """根据清单中的stat结果生成ZipInfo（与ZipInfo.from_file的结果相同，但不再stat文件）"""
+    import zipfile
+    
+    st = entry.stat
+    arcname = os.path.normpath(arcname or entry.arcname).lstrip(os.sep)
+    if entry.kind == "d":
+        arcname += "/"
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    if entry.kind == "d":
+        zinfo.file_size = 0
+        zinfo.external_attr |= 0x10
+    else:
+        zinfo.file_size = entry.size
+    return zinfo
+
+
+class ContentDefinedChunker:
+    """FastCDC风格的内容定义分块（归一化分块：平均大小之前切分条件更严格，之后更宽松）
+
+    每个字节位置的滚动哈希为最近WINDOW个字节各自查表后的异或值（8位），
+    切分条件为"连续若干个位置的哈希值的高若干位等于固定值"，严格/宽松条件分别比较log2(平均块大小)±2位，
+    用预编译的正则表达式（定长字节与字节区间）查找。
+    查表用bytes.translate、错位异或用大整数运算、查找用正则表达式，全部在C层完成，避免逐字节的Python循环
+    """
+
+    SEED = b"webdav-backup-cdc"
+    WINDOW = 8
+    # 严格/宽松切分条件比平均块大小对应的位数多/少的位数
+    NORMALIZATION_BITS = 2
+
+    def __init__(self, min_size, avg_size, max_size):
+        self.min_size = max(min_size, 64)
+        self.avg_size = max(avg_size, self.min_size + 1)
+        self.max_size = max(max_size, self.avg_size + 1)
+        
+        self.tables = [
+            bytes(hashlib.sha256(self.SEED + bytes([k, b])).digest()[0] for b in range(256))
+            for k in range(self.WINDOW)
+        ]
+        
+        bits = self.avg_size.bit_length() - 1
+        self.strict_pattern = self.compile_pattern(bits + self.NORMALIZATION_BITS)
+        self.loose_pattern = self.compile_pattern(max(1, bits - self.NORMALIZATION_BITS))
+
+    def compile_pattern(self, bits):
+        """生成匹配概率为2^-bits的切分条件：位数平均分配到至少两个连续位置，每个位置比较哈希值的高若干位"""
+        values = hashlib.sha256(self.SEED + b"-pattern").digest()
+        count = max(2, -(-bits // 8))
+        parts = []
+        previous = None
+        for i in range(count):
+            width = bits // count + (1 if i < bits % count else 0)
+            value = values[i]
+            # 相邻位置的取值区间互不相交，内容恒定的数据（如全零）不会产生切分点
+            if previous is not None:
+                common = min(width, previous[1])
+                if value >> (8 - common) == previous[0] >> (8 - common):
+                    value ^= 0x80
+            low = value >> (8 - width) << (8 - width)
+            high = low + (1 << (8 - width)) - 1
+            parts.append(b"\\x%02x" % low if low == high else b"[\\x%02x-\\x%02x]" % (low, high))
+            previous = (value, width)
+        return re.compile(b"".join(parts))
+
+    def map_hashes(self, data):
+        """计算每个字节位置的滚动哈希值（每个位置一个字节），结果与data等长"""
+        size = len(data)
+        result = int.from_bytes(data.translate(self.tables[0]), 'big')
+        for k in range(1, self.WINDOW):
+            # 大端整数右移8k位，相当于把序列整体后移k个字节
+            result ^= int.from_bytes(data.translate(self.tables[k]), 'big') >> (8 * k)
+        return result.to_bytes(size, 'big')
+
+    def find_cut(self, mapped, start, end):
+        """返回从start开始的下一个切分点，调用方需保证end-start不小于最大块大小或已到数据末尾"""
+        if end - start <= self.min_size:
+            return end
+        normal_end = min(start + self.avg_size, end)
+        limit = min(start + self.max_size, end)
+        
+        # 第一阶段：[最小块, 平均块] 区间内使用更严格的切分条件
+        match = self.strict_pattern.search(mapped, start + self.min_size, normal_end)
+        if match:
+            return match.end()
+        
+        # 第二阶段：(平均块, 最大块] 区间内使用更宽松的切分条件
+        match = self.loose_pattern.search(mapped, normal_end, limit)
+        if match:
+            return match.end()
+        return limit
+
+
+class DedupChunkWriter:
+    """把数据流切分为内容定义的数据块，按SHA-256寻址，只上传远程存储中尚不存在的块"""
+
+    def __init__(self, backup, chunks_url, chunker, workers, limiter=None):
+        self._backup = backup
+        self._limiter = limiter
+        self._chunks_url = chunks_url
+        self._chunker = chunker
+        self._workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._futures = deque()
+        self._buffer = bytearray()
+        self._remote_chunks = {}
+        self._uploaded = {}
+        self.chunks = []
+        self.total_bytes = 0
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self.upload_bytes = 0
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._chunker.max_size * 4:
+            self._process(final=False)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _process(self, final):
+        data = bytes(self._buffer)
+        mapped = self._chunker.map_hashes(data)
+        start = 0
+        # 非末尾数据至少保留一个最大块的长度，保证切分点只取决于内容本身
+        while start < len(data) and (final or len(data) - start >= self._chunker.max_size):
+            cut = self._chunker.find_cut(mapped, start, len(data))
+            self._emit(data[start:cut])
+            start = cut
+        del self._buffer[:start]
+
+    def _known_chunks(self, prefix):
+        """获取远程某个前缀目录下已存在的块（每个目录只发送一次PROPFIND）"""
+        if prefix not in self._remote_chunks:
+            dir_url = f"{self._chunks_url}/{prefix}/"
+            entries = self._backup.webdav_propfind(dir_url, depth=1)
+            if entries is None:
+                self._backup.webdav_mkcol(dir_url)
+                self._remote_chunks[prefix] = set()
+            else:
+                self._remote_chunks[prefix] = {entry["name"] for entry in entries if not entry["is_collection"]}
+        return self._remote_chunks[prefix]
+
+    def _emit(self, chunk):
+        digest = hashlib.sha256(chunk).hexdigest()
+        self.chunks.append([digest, len(chunk)])
+        self.total_bytes += len(chunk)
+        if digest in self._uploaded or digest in self._known_chunks(digest[:2]):
+            return
+        self._uploaded[digest] = None
+        self.new_chunks += 1
+        self.new_bytes += len(chunk)
+        self._futures.append((digest, self._pool.submit(self._upload_chunk, digest, chunk)))
+        while len(self._futures) > self._workers * 2:
+            self._wait_next()
+
+    def _upload_chunk(self, digest, chunk):
+        data = zlib.compress(chunk, 6)
+        url = f"{self._chunks_url}/{digest[:2]}/{digest}"
+        if self._limiter is not None:
+            self._limiter.consume(len(data))
+        response = self._backup.session.put(url, data=data, timeout=(CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME))
+        if response.status_code not in [200, 201, 204]:
+            raise IOError(f"上传数据块 {digest} 失败 (HTTP状态码: {response.status_code})")
+        return len(data)
+
+    def _wait_next(self):
+        digest, future = self._futures.popleft()
+        size = future.result()
+        self._uploaded[digest] = size
+        self.upload_bytes += size
+
+    def close(self):
+        try:
+            self._process(final=True)
+            while self._futures:
+                self._wait_next()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def verify_uploaded(self):
+        """批量列出本次写入过的前缀目录，核对新上传数据块在远程的大小"""
+        by_prefix = {}
+        for digest, size in self._uploaded.items():
+            by_prefix.setdefault(digest[:2], {})[digest] = size
+        for prefix, expected in by_prefix.items():
+            entries = self._backup.webdav_propfind(f"{self._chunks_url}/{prefix}/", depth=1) or []
+            remote_sizes = {entry["name"]: entry["size"] for entry in entries}
+            for digest, size in expected.items():
+                if remote_sizes.get(digest) != size:
+                    raise IOError(f"数据块 {digest} 校验失败：本地 {size} 字节，远程 {remote_sizes.get(digest)} 字节")
+
+
+class DedupChunkReader:
+    """按快照清单的顺序下载去重存储中的数据块，解压并校验SHA-256后依次返回（并发预取后续的块）"""
+
+    def __init__(self, backup, chunks_url, chunks, workers):
+        self._backup = backup
+        self._chunks_url = chunks_url
+        self._chunks = chunks
+        self._workers = workers
+        self.downloaded = 0
+
+    def _download_chunk(self, digest, size):
+        url = f"{self._chunks_url}/{digest[:2]}/{digest}"
+        response = self._backup.session.get(url, timeout=(CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME))
+        if response.status_code != 200:
+            raise IOError(f"下载数据块 {digest} 失败 (HTTP状态码: {response.status_code})")
+        data = zlib.decompress(response.content)
+        if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+            raise IOError(f"数据块 {digest} 校验失败：内容与快照清单不一致")
+        return data, len(response.content)
+
+    def __iter__(self):
+        pool = ThreadPoolExecutor(max_workers=self._workers)
+        futures = deque()
+        try:
+            for digest, size in self._chunks:
+                futures.append(pool.submit(self._download_chunk, digest, size))
+                # 限制预取的块数量，避免内存无限增长
+                while len(futures) > self._workers * 2:
+                    yield self._take(futures.popleft())
+            while futures:
+                yield self._take(futures.popleft())
+        finally:
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+    def _take(self, future):
+        data, size = future.result()
+        self.downloaded += size
+        return data
+
+
+class CountingSink:
+    """只统计写入字节数的输出端，用于压缩性能测试"""
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+# PROPFIND请求体：除基本属性外同时请求服务器提供的内容校验和
+PROPFIND_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+                 '<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns"><d:prop>'
+                 '<d:resourcetype/><d:getcontentlength/><d:getlastmodified/><d:getetag/>'
+                 '<d:getcontentchecksum/><oc:checksums/>'
+                 '</d:prop></d:propfind>').encode('utf-8')
+
+# 获取剩余配额（RFC 4331）的PROPFIND请求体，只在预检时对单个目录发送
+PROPFIND_QUOTA_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+                       '<d:propfind xmlns:d="DAV:"><d:prop>'
+                       '<d:resourcetype/><d:quota-available-bytes/><d:quota-used-bytes/>'
+                       '</d:prop></d:propfind>').encode('utf-8')
+
+
+class PropfindParser:
+    """增量解析PROPFIND的multistatus响应：数据边到达边解析，每解析完一个条目即释放对应的XML元素，
+    目录中有大量文件时内存占用不随响应大小增长"""
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('end',))
+        self._error = None
+        self.entries = []
+
+    def feed(self, data):
+        if self._error is not None:
+            return
+        try:
+            self._parser.feed(data)
+            self._collect()
+        except ET.ParseError as e:
+            # 非207响应（如404错误页）的响应体不是XML，错误推迟到close时再报告
+            self._error = e
+
+    def close(self):
+        """结束解析并返回条目列表"""
+        if self._error is None:
+            try:
+                self._parser.close()
+                self._collect()
+            except ET.ParseError as e:
+                self._error = e
+        if self._error is not None:
+            raise self._error
+        return self.entries
+
+    def _collect(self):
+        for event, node in self._parser.read_events():
+            if node.tag == '{DAV:}response':
+                self.entries.append(self._parse_entry(node))
+                node.clear()
+
+    @staticmethod
+    def _parse_entry(node):
+        href = unquote(node.findtext('{DAV:}href', default=''))
+        entry = {
+            "href": href,
+            "name": href.rstrip('/').rsplit('/', 1)[-1],
+            "is_collection": False,
+            "size": None,
+            "mtime": None,
+            "etag": None,
+            "checksums": {},
+            "quota_available": None,
+        }
+        for propstat in node.iter('{DAV:}propstat'):
+            if ' 200 ' not in (propstat.findtext('{DAV:}status', default='') + ' '):
+                continue
+            prop = propstat.find('{DAV:}prop')
+            if prop is None:
+                continue
+            resourcetype = prop.find('{DAV:}resourcetype')
+            if resourcetype is not None and resourcetype.find('{DAV:}collection') is not None:
+                entry["is_collection"] = True
+            size = prop.findtext('{DAV:}getcontentlength')
+            if size:
+                entry["size"] = int(size)
+            entry["mtime"] = prop.findtext('{DAV:}getlastmodified') or entry["mtime"]
+            entry["etag"] = prop.findtext('{DAV:}getetag') or entry["etag"]
+            quota = prop.findtext('{DAV:}quota-available-bytes')
+            if quota and quota.strip().lstrip('-').isdigit():
+                entry["quota_available"] = int(quota)
+            # 服务器提供的内容校验和（Nextcloud/ownCloud的oc:checksums，或getcontentchecksum属性）
+            for node_prop in prop.iter():
+                if node_prop.tag.rsplit('}', 1)[-1] in ("checksum", "getcontentchecksum") and node_prop.text:
+                    entry["checksums"].update(parse_checksum_header(node_prop.text))
+        return entry
+
+
+class AsyncResponse:
+    """异步客户端的响应，属性与requests.Response的常用部分一致"""
+
+    def __init__(self, status_code, reason, headers, content=b""):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+
+def create_ssl_context(verify=True):
+    """按requests的verify参数创建SSL上下文：True使用系统证书，False不校验证书，字符串为CA证书文件或目录"""
+    if isinstance(verify, str):
+        if os.path.isdir(verify):
+            return ssl.create_default_context(capath=verify)
+        return ssl.create_default_context(cafile=verify)
+    context = ssl.create_default_context()
+    if verify is False:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class AsyncHTTP11Transport:
+    """基于asyncio的HTTP/1.1传输层：按服务器维护keep-alive连接池，并限制每个服务器的并发连接数"""
+
+    # 每次读取响应数据的大小范围：在此范围内按缓冲区内存上限和并发连接数分配
+    MIN_READ_SIZE = 64 * 1024
+    MAX_READ_SIZE = 1024 * 1024
+    # 可以重试的传输错误（连接失败/重置、读取到不完整的响应）
+    RETRYABLE_ERRORS = (OSError, asyncio.IncompleteReadError)
+
+    def __init__(self, max_connections, ssl_context=None):
+        self._max_connections = max_connections
+        share = int(IO_BUFFER_MEMORY_MB * 1024 * 1024) // (2 * max(1, max_connections))
+        self._read_size = max(self.MIN_READ_SIZE, min(self.MAX_READ_SIZE, share))
+        self._idle = {}
+        self._slots = {}
+        self._ssl_context = ssl_context or create_ssl_context()
+
+    async def request(self, method, url, headers, body=b"", on_chunk=None, timeout=None):
+        """发送请求，timeout为 (连接超时, 读取超时)：读取超时限制的是每次读取的等待时间，而不是整个请求的耗时"""
+        connect_timeout, read_timeout = timeout or (None, None)
+        parsed = urlparse(url)
+        secure = parsed.scheme == 'https'
+        port = parsed.port or (443 if secure else 80)
+        key = (parsed.scheme, parsed.hostname, port)
+        path = (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else '')
+        host = parsed.hostname if parsed.port is None else f"{parsed.hostname}:{parsed.port}"
+        
+        lines = [f"{method} {quote(path, safe='/%?=&:@!$()*+,;~')} HTTP/1.1", f"Host: {host}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        lines.append(f"Content-Length: {len(body)}")
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode('utf-8')
+        
+        if key not in self._slots:
+            self._slots[key] = asyncio.Semaphore(self._max_connections)
+            self._idle[key] = []
+        async with self._slots[key]:
+            # 复用的空闲连接可能已被服务器关闭：收到状态行之前出错时换新连接重发，
+            # 之后出错则直接抛出（响应体可能已部分交给on_chunk，不能重复交付）
+            while True:
+                idle = self._idle[key]
+                reused = bool(idle)
+                if reused:
+                    reader, writer = idle.pop()
+                else:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                        parsed.hostname, port, ssl=self._ssl_context if secure else None,
+                        limit=self._read_size), connect_timeout)
+                    sock = writer.get_extra_info('socket')
+                    if TCP_KEEPALIVE and sock is not None:
+                        with contextlib.suppress(OSError):
+                            for level, option, value in keepalive_socket_options():
+                                sock.setsockopt(level, option, value)
+                try:
+                    writer.write(head + body)
+                    await asyncio.wait_for(writer.drain(), read_timeout)
+                    status_head = await self._read_head(reader, read_timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                try:
+                    response, keep_alive = await self._read_body(reader, method, status_head, on_chunk, read_timeout)
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+                return response
+
+    async def _read_head(self, reader, read_timeout=None):
+        """读取状态行和响应头（跳过100 Continue等临时响应），返回 (协议版本, 状态码, 原因, 响应头)"""
+        async def readline():
+            return await asyncio.wait_for(reader.readline(), read_timeout)
+        
+        while True:
+            status_line = await readline()
+            if not status_line:
+                raise ConnectionResetError("服务器关闭了连接")
+            version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+            status = int(status)
+            headers = CaseInsensitiveDict()
+            while True:
+                line = (await readline()).decode('latin-1').rstrip('\r\n')
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip()] = value.strip()
+            # 跳过100 Continue等临时响应
+            if status >= 200 or status == 101:
+                return version, status, reason, headers
+    
+    async def _read_body(self, reader, method, status_head, on_chunk, read_timeout=None):
+        """读取响应体，返回 (响应, 连接是否可以复用)"""
+        async def readline():
+            return await asyncio.wait_for(reader.readline(), read_timeout)
+        
+        async def read_some(size):
+            # 读取已到达的数据（最多size字节），超时只限制没有数据到达的等待时间
+            data = await asyncio.wait_for(reader.read(size), read_timeout)
+            if not data:
+                raise asyncio.IncompleteReadError(b"", size)
+            return data
+        
+        version, status, reason, headers = status_head
+        keep_alive = version == 'HTTP/1.1' and headers.get('Connection', '').lower() != 'close'
+        chunks = []
+
+        async def deliver(data):
+            # 错误响应的响应体保存在content中，不交给on_chunk（出错重试时on_chunk不会收到错误页面）
+            if on_chunk is None or not 200 <= status < 300:
+                chunks.append(data)
+                return
+            result = on_chunk(data)
+            if inspect.isawaitable(result):
+                await result
+        
+        if method == 'HEAD' or status in (204, 304):
+            pass
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    # 跳过尾部字段直到空行
+                    while (await readline()).strip():
+                        pass
+                    break
+                while size:
+                    data = await read_some(min(size, self._read_size))
+                    size -= len(data)
+                    await deliver(data)
+                await asyncio.wait_for(reader.readexactly(2), read_timeout)
+        elif 'Content-Length' in headers:
+            remaining = int(headers['Content-Length'])
+            while remaining:
+                data = await read_some(min(remaining, self._read_size))
+                remaining -= len(data)
+                await deliver(data)
+        else:
+            # 既没有长度也没有分块编码：读到连接关闭为止
+            keep_alive = False
+            while True:
+                data = await asyncio.wait_for(reader.read(self._read_size), read_timeout)
+                if not data:
+                    break
+                await deliver(data)
+        return AsyncResponse(status, reason, headers, b"".join(chunks)), keep_alive
+
+    async def close(self):
+        for idle in self._idle.values():
+            for reader, writer in idle:
+                writer.close()
+            idle.clear()
+
+
+class HttpxTransport:
+    """基于httpx的传输层（支持HTTP/2），需要安装httpx和h2"""
+
+    def __init__(self, max_connections, http2=True, ssl_context=None):
+        import httpx
+        self.RETRYABLE_ERRORS = (httpx.TransportError,)
+        self._client = httpx.AsyncClient(http2=http2, timeout=None, verify=ssl_context or create_ssl_context(),
+                                         limits=httpx.Limits(max_connections=max_connections))
+
+    async def request(self, method, url, headers, body=b"", on_chunk=None, timeout=None):
+        import httpx
+        connect_timeout, read_timeout = timeout or (None, None)
+        timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        async with self._client.stream(method, url, headers=headers, content=body, timeout=timeout) as response:
+            chunks = []
+            async for data in response.aiter_bytes():
+                if on_chunk is None or not 200 <= response.status_code < 300:
+                    chunks.append(data)
+                    continue
+                result = on_chunk(data)
+                if inspect.isawaitable(result):
+                    await result
+            return AsyncResponse(response.status_code, response.reason_phrase,
+                                 CaseInsensitiveDict(response.headers), b"".join(chunks))
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class SessionTransport:
+    """通过同步会话（requests）在线程中发送请求的传输层，用于异步传输层不支持的配置（代理、客户端证书、非Basic认证）；
+    会话的传输适配器已按重试策略重发，异步客户端不再重试"""
+
+    RETRYABLE_ERRORS = ()
+
+    def __init__(self, session):
+        self._session = session
+
+    async def request(self, method, url, headers, body=b"", on_chunk=None, timeout=None):
+        """headers中的Authorization只表示需要认证，实际使用会话的认证方式；重定向由异步客户端处理"""
+        headers = dict(headers)
+        auth = None if headers.pop('Authorization', None) else (lambda request: request)
+        response = await asyncio.to_thread(self._session.request, method, url, headers=headers, data=body or None,
+                                           auth=auth, stream=True, timeout=timeout, allow_redirects=False)
+        try:
+            chunks = []
+            iterator = response.iter_content(1024 * 1024)
+            while True:
+                data = await asyncio.to_thread(next, iterator, None)
+                if data is None:
+                    break
+                if on_chunk is None or not 200 <= response.status_code < 300:
+                    chunks.append(data)
+                    continue
+                result = on_chunk(data)
+                if inspect.isawaitable(result):
+                    await result
+            return AsyncResponse(response.status_code, response.reason, response.headers, b"".join(chunks))
+        finally:
+            response.close()
+
+    async def close(self):
+        pass
+
+
+class AsyncWebDAVClient:
+    """异步WebDAV客户端：提供与同步会话相同的操作，相互独立的请求可以并发执行；
+    传入同步会话时使用与其相同的证书校验设置，需经代理等异步传输层不支持的请求改由同步会话发送"""
+
+    # 自动跟随重定向的状态码和请求方法（与requests相同，跨主机或降级为http时不再发送认证信息）
+    REDIRECT_STATUSES = (301, 302, 307, 308)
+    REDIRECT_METHODS = ('GET', 'HEAD', 'PROPFIND')
+
+    def __init__(self, user, password, max_connections=None, http2=None, session=None):
+        credentials = base64.b64encode(f"{user}:{password}".encode('utf-8')).decode('ascii')
+        self._headers = {
+            'Authorization': f"Basic {credentials}",
+            'User-Agent': 'WebDAV-Backup-Script-Python/1.0',
+            'Connection': 'keep-alive',
+        }
+        self._session = session
+        self._session_transport = SessionTransport(session) if session is not None else None
+        self._routes = {}
+        verify = True
+        if session is not None:
+            # 与requests相同：会话未指定CA证书时使用REQUESTS_CA_BUNDLE/CURL_CA_BUNDLE环境变量
+            verify = session.verify
+            if session.trust_env and verify is True:
+                verify = os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE') or True
+        ssl_context = create_ssl_context(verify)
+        max_connections = max_connections or ASYNC_MAX_CONNECTIONS
+        http2 = ASYNC_HTTP2 if http2 is None else http2
+        self.transport = None
+        if http2:
+            try:
+                self.transport = HttpxTransport(max_connections, http2=True, ssl_context=ssl_context)
+            except ImportError:
+                print("警告：未安装httpx[http2]，异步客户端使用HTTP/1.1")
+        if self.transport is None:
+            self.transport = AsyncHTTP11Transport(max_connections, ssl_context)
+        self.retry_policy = RetryPolicy()
+
+    def _transport_for(self, url):
+        """选择发送请求的传输层：需经代理（会话或HTTP(S)_PROXY等环境变量）、使用客户端证书或非Basic认证时使用同步会话"""
+        if self._session_transport is None:
+            return self.transport
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        if key not in self._routes:
+            session = self._session
+            proxies = session.merge_environment_settings(url, {}, None, None, None)["proxies"]
+            self._routes[key] = (requests.utils.select_proxy(url, proxies) is not None or session.cert is not None
+                                 or not (session.auth is None or isinstance(session.auth, tuple)))
+        return self._session_transport if self._routes[key] else self.transport
+
+    @staticmethod
+    def _keeps_auth(old_url, new_url):
+        """重定向后是否继续发送认证信息：同一主机且没有从https降级为http"""
+        old, new = urlparse(old_url), urlparse(new_url)
+        return old.hostname == new.hostname and old.port == new.port and not (old.scheme == 'https' and new.scheme == 'http')
+
+    async def request(self, method, url, headers=None, data=b"", on_chunk=None, timeout=None):
+        """发送请求，on_chunk不为空时响应体按块交给on_chunk处理（可为协程函数），不在内存中保留；
+        timeout与requests相同：单个数值或 (连接超时, 读取超时)，读取超时按每次读取计算，大文件下载不会因总耗时超时；
+        临时错误按重试策略重发，已有响应体交给on_chunk处理后出错则不再重发"""
+        request_headers = dict(self._headers)
+        request_headers.update(headers or {})
+        origin = url
+        redirects = 0
+        if timeout is None:
+            timeout = (CONNECT_TIMEOUT, INTEGRITY_CHECK_TIMEOUT)
+        elif not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        policy = self.retry_policy
+        delivered = False
+        
+        async def deliver(data):
+            nonlocal delivered
+            delivered = True
+            result = on_chunk(data)
+            if inspect.isawaitable(result):
+                await result
+        
+        attempt = 0
+        while True:
+            transport = self._transport_for(url)
+            retryable = policy.allows(method) and transport is not self._session_transport
+            try:
+                response = await transport.request(
+                    method, url, request_headers, data or b"", deliver if on_chunk is not None else None, timeout)
+            except (asyncio.TimeoutError,) + transport.RETRYABLE_ERRORS as e:
+                if (delivered or not retryable or attempt >= policy.max_retries
+                        or isinstance(e, ssl.SSLCertVerificationError)):
+                    raise
+                reason = type(e).__name__
+                delay = policy.delay(attempt)
+            else:
+                location = response.headers.get('Location')
+                if response.status_code in self.REDIRECT_STATUSES and method in self.REDIRECT_METHODS and location:
+                    redirects += 1
+                    if redirects > requests.models.DEFAULT_REDIRECT_LIMIT:
+                        raise IOError(f"重定向次数过多: {origin}")
+                    location = urljoin(url, location)
+                    if not self._keeps_auth(url, location):
+                        request_headers.pop('Authorization', None)
+                    url = location
+                    continue
+                if not retryable or attempt >= policy.max_retries or response.status_code not in policy.statuses:
+                    return response
+                reason = f"HTTP状态码: {response.status_code}"
+                delay = policy.delay(attempt, response.headers.get("Retry-After"))
+            attempt += 1
+            policy.announce(method, url, attempt, delay, reason)
+            await asyncio.sleep(delay)
+
+    async def mkcol(self, url):
+        return (await self.request('MKCOL', url, timeout=CONNECT_TIMEOUT)).status_code
+
+    async def put(self, url, data, timeout=None):
+        return (await self.request('PUT', url, data=data, timeout=timeout)).status_code
+
+    async def head(self, url):
+        return await self.request('HEAD', url)
+
+    async def get(self, url, headers=None, on_chunk=None, timeout=None):
+        return await self.request('GET', url, headers=headers, on_chunk=on_chunk, timeout=timeout)
+
+    async def delete(self, url):
+        return (await self.request('DELETE', url, timeout=CONNECT_TIMEOUT)).status_code
+
+    async def propfind(self, url, depth=1, body=None):
+        """发送PROPFIND请求，返回条目列表（响应体边接收边解析）；目标不存在时返回None"""
+        parser = PropfindParser()
+        response = await self.request('PROPFIND', url, data=body or PROPFIND_BODY, on_chunk=parser.feed, headers={
+            'Depth': str(depth), 'Content-Type': 'application/xml; charset="utf-8"'})
+        if response.status_code == 404:
+            return None
+        if response.status_code != 207:
+            raise IOError(f"PROPFIND {url} 失败 (HTTP状态码: {response.status_code})")
+        return parser.close()
+
+    async def close(self):
+        await self.transport.close()
+        if self._session_transport is not None:
+            await self._session_transport.close()
+
+
+class AsyncLoopThread:
+    """在后台线程中运行的asyncio事件循环，同步代码可向其提交协程，等待结果的同时其他线程（如压缩）照常运行"""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="webdav-async", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def get(cls):
+        """获取进程内共享的事件循环线程"""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def submit(self, coro):
+        """提交协程，返回concurrent.futures.Future；协程继承提交线程的上下文变量"""
+        return asyncio.run_coroutine_threadsafe(self._run_in_context(coro, contextvars.copy_context()), self.loop)
+
+    @staticmethod
+    async def _run_in_context(coro, context):
+        for var, value in context.items():
+            var.set(value)
+        return await coro
+
+    def run(self, coro):
+        """提交协程并等待结果"""
+        return self.submit(coro).result()
+
+
+# 备份任务中可单独配置的项及对应的全局配置
+JOB_SETTINGS = {
+    "source_dir": "SOURCE_DIR",
+    "webdav_base_url": "WEBDAV_BASE_URL",
+    "webdav_upload_dir": "WEBDAV_UPLOAD_DIR",
+    "webdav_user": "WEBDAV_USER",
+    "webdav_pass": "WEBDAV_PASS",
+    "local_backup_dir": "LOCAL_BACKUP_DIR",
+    "backup_prefix": "BACKUP_PREFIX",
+    "max_remote_backups": "MAX_REMOTE_BACKUPS",
+    "max_local_backups": "MAX_LOCAL_BACKUPS",
+    "retention_policy": "RETENTION_POLICY",
+    "local_retention_policy": "LOCAL_RETENTION_POLICY",
+    "backup_format": "BACKUP_FORMAT",
+    "backup_mode": "BACKUP_MODE",
+    "compression_workers": "COMPRESSION_WORKERS",
+    "compression_level": "COMPRESSION_LEVEL",
+    "exclude_patterns": "EXCLUDE_PATTERNS",
+}
+
+
+class RunMetrics:
+    """记录一次备份运行中各阶段的耗时、数据量、重试次数和HTTP状态码，可输出为JSON运行记录、Prometheus文本格式和邮件摘要"""
+    
+    # 当前正在执行的阶段 (RunMetrics, 阶段名称)，请求重试时计入该阶段（提交到异步事件循环的协程也能继承）
+    current_stage = contextvars.ContextVar("current_stage", default=None)
+    
+    # 阶段名称及在邮件摘要中的显示名称（按备份流程的顺序）
+    STAGE_LABELS = {
+        "scan": "扫描源目录",
+        "preflight": "预检",
+        "snapshot": "一致性快照",
+        "compress": "创建压缩包",
+        "mkdir": "创建WebDAV目录",
+        "stream": "流式压缩上传",
+        "dedup": "去重存储上传",
+        "upload": "上传",
+        "integrity": "完整性检测",
+        "clean_remote": "清理WebDAV旧备份",
+        "clean_local": "清理本地旧备份",
+    }
+    
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        # 运行结果：success（成功）、unchanged（源目录没有变化，跳过）、failure（失败，默认）
+        self.status = "failure"
+        self.backup_file = None
+        self.archive_bytes = None
+        self.stages = {}
+        self._lock = threading.Lock()
+    
+    def _stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"seconds": 0.0, "bytes": None, "retries": 0, "http_status": None}
+        return stage
+    
+    @contextlib.contextmanager
+    def measure(self, name):
+        """统计with块的耗时（同一阶段多次执行时累加），返回该阶段的记录，可在块内写入bytes、http_status等"""
+        with self._lock:
+            stage = self._stage(name)
+        token = self.current_stage.set((self, name))
+        start_time = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            self.current_stage.reset(token)
+            with self._lock:
+                stage["seconds"] += time.perf_counter() - start_time
+    
+    def record(self, name, seconds=None, **values):
+        """记录阶段的耗时（累加）及其他数据（bytes、http_status等，覆盖原值）"""
+        with self._lock:
+            stage = self._stage(name)
+            if seconds is not None:
+                stage["seconds"] += seconds
+            stage.update(values)
+    
+    def add_retry(self, name, count=1):
+        """记录阶段内的重试次数（可在多个线程中调用）"""
+        with self._lock:
+            self._stage(name)["retries"] += count
+    
+    @classmethod
+    def note_retry(cls):
+        """把一次请求重试计入当前阶段（不在任何阶段中时忽略）"""
+        current = cls.current_stage.get()
+        if current is not None:
+            current[0].add_retry(current[1])
+    
+    def finish(self, status=None):
+        if status is not None:
+            self.status = status
+        self.finished = time.time()
+    
+    def stage_records(self):
+        """返回各阶段的记录（按备份流程的顺序），附带吞吐量（字节/秒）"""
+        order = list(self.STAGE_LABELS)
+        records = {}
+        with self._lock:
+            for name in sorted(self.stages, key=lambda name: order.index(name) if name in order else len(order)):
+                stage = dict(self.stages[name])
+                stage["seconds"] = round(stage["seconds"], 3)
+                stage["throughput_bytes_per_second"] = (
+                    round(stage["bytes"] / stage["seconds"]) if stage["bytes"] and stage["seconds"] > 0 else None)
+                records[name] = stage
+        return records
+    
+    def to_record(self):
+        """生成JSON运行记录"""
+        finished = self.finished or time.time()
+        return {
+            "started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "finished": datetime.datetime.fromtimestamp(finished).isoformat(timespec="seconds"),
+            "duration_seconds": round(finished - self.started, 3),
+            "status": self.status,
+            "backup_file": self.backup_file,
+            "archive_bytes": self.archive_bytes,
+            "stages": self.stage_records(),
+        }
+    
+    def format_summary(self):
+        """生成邮件中的各阶段耗时摘要，没有记录任何阶段时返回空字符串"""
+        stages = self.stage_records()
+        if not stages:
+            return ""
+        lines = [f"各阶段耗时（总计 {(self.finished or time.time()) - self.started:.2f} 秒）:"]
+        for name, stage in stages.items():
+            line = f"  {self.STAGE_LABELS.get(name, name)}: {stage['seconds']:.2f} 秒"
+            if stage["bytes"] is not None:
+                line += f"，{stage['bytes'] / 1024 / 1024:.2f} MB"
+            if stage["throughput_bytes_per_second"]:
+                line += f"，{stage['throughput_bytes_per_second'] / 1024 / 1024:.2f} MB/s"
+            if stage["retries"]:
+                line += f"，重试 {stage['retries']} 次"
+            if stage["http_status"] is not None:
+                line += f"，HTTP状态码 {stage['http_status']}"
+            lines.append(line)
+        return "\n".join(lines)
+    
+    def format_prometheus(self, backup_name, last_success=None):
+        """生成Prometheus文本格式（node_exporter textfile收集器），所有指标带backup标签"""
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        
+        label = f'backup="{escape(backup_name)}"'
+        lines = []
+        
+        def metric(name, help_text, samples):
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                return
+            lines.append(f"# HELP webdav_backup_{name} {help_text}")
+            lines.append(f"# TYPE webdav_backup_{name} gauge")
+            for labels, value in samples:
+                lines.append(f"webdav_backup_{name}{{{labels}}} {value}")
+        
+        finished = self.finished or time.time()
+        stages = self.stage_records()
+        metric("last_run_timestamp_seconds", "最近一次备份运行结束的时间", [(label, round(finished, 3))])
+        metric("last_run_success", "最近一次备份是否成功（源目录没有变化而跳过也视为成功）",
+               [(label, 0 if self.status == "failure" else 1)])
+        metric("last_run_duration_seconds", "最近一次备份的总耗时", [(label, round(finished - self.started, 3))])
+        metric("last_success_timestamp_seconds", "最近一次成功备份的时间", [(label, last_success)])
+        metric("last_archive_bytes", "最近一次备份文件的大小", [(label, self.archive_bytes)])
+        for key, name, help_text in (
+                ("seconds", "stage_duration_seconds", "最近一次备份各阶段的耗时"),
+                ("bytes", "stage_bytes", "最近一次备份各阶段处理的数据量"),
+                ("throughput_bytes_per_second", "stage_throughput_bytes_per_second", "最近一次备份各阶段的吞吐量"),
+                ("retries", "stage_retries", "最近一次备份各阶段的重试次数"),
+                ("http_status", "stage_http_status", "最近一次备份各阶段最后一个请求的HTTP状态码")):
+            metric(name, help_text, [(f'{label},stage="{stage_name}"', stage[key]) for stage_name, stage in stages.items()])
+        return "\n".join(lines) + "\n"
+
+
+class BackupExit(Exception):
+    """结束本次备份流程，code为退出码：单次运行时作为进程退出码，守护进程模式下只结束本次备份，进程继续运行"""
+
+    def __init__(self, code=1):
+        super().__init__(code)
+        self.code = code
+
+
+class BlockDownloadError(IOError):
+    """抽样校验时下载数据块失败（服务器返回了206/200以外的状态码），视为校验失败"""
+
+
+class WebDAVBackup:
+    def __init__(self, job=None, session=None, async_client=None):
+        # 初始化配置
+        self.source_dir = SOURCE_DIR
+        self.webdav_base_url = WEBDAV_BASE_URL.rstrip('/')
+        self.webdav_upload_dir = WEBDAV_UPLOAD_DIR
+        self.webdav_user = WEBDAV_USER
+        self.webdav_pass = WEBDAV_PASS
+        self.local_backup_dir = LOCAL_BACKUP_DIR
+        self.backup_prefix = BACKUP_PREFIX
+        self.max_remote_backups = MAX_REMOTE_BACKUPS
+        self.max_local_backups = MAX_LOCAL_BACKUPS
+        self.retention_policy = RETENTION_POLICY
+        self.local_retention_policy = LOCAL_RETENTION_POLICY
+        self.backup_format = BACKUP_FORMAT
+        self.compression_workers = COMPRESSION_WORKERS
+        self.compression_level = COMPRESSION_LEVEL
+        self.exclude_patterns = EXCLUDE_PATTERNS
+        self.backup_mode = BACKUP_MODE
+        # 是否流式上传及是否保留本地副本（预检发现本地空间不足时可能改为流式上传且不保留本地副本）
+        self.streaming_upload = ENABLE_STREAMING_UPLOAD
+        self.streaming_keep_local_copy = STREAMING_KEEP_LOCAL_COPY
+        
+        # 多任务模式：用任务中的配置覆盖全局配置
+        self.job_name = None
+        if job is not None:
+            self.job_name = job["name"]
+            self.backup_prefix = job["name"]
+            for key, value in job.items():
+                if key == "name":
+                    continue
+                if key not in JOB_SETTINGS:
+                    raise ValueError(f"备份任务 {self.job_name} 中包含不支持的配置项: {key}")
+                setattr(self, key, value)
+            self.webdav_base_url = self.webdav_base_url.rstrip('/')
+        self.state_dir = os.path.join(self.local_backup_dir, STATE_DIR_NAME)
+        
+        # 本次备份计划（增量/差异模式下由plan_backup生成）
+        self.backup_plan = None
+        
+        # 源目录文件清单（每次运行只扫描一次），键为是否跟随指向文件的符号链接
+        self.source_manifests = {}
+        
+        # 一致性快照：快照目录（创建快照后归档时从这里读取文件）以及是否已执行暂停写入命令
+        self.snapshot_root = None
+        self.source_quiesced = False
+        
+        # 各阶段的并发限制（多任务调度时由调度器设置），键为阶段名称，值为信号量
+        self.stage_slots = {}
+        
+        # 本次运行各阶段的耗时、数据量等指标，运行结束时写入运行记录和Prometheus文本文件
+        self.metrics = RunMetrics()
+        
+        # 阶段重试（重新上传、重新创建目录）的退避策略，与单个请求的重试使用相同的参数
+        self.retry_policy = RetryPolicy()
+        
+        if session is not None:
+            # 多任务模式：与连接到同一服务器的其他任务共享会话和连接池
+            self.session = session
+        else:
+            # 创建会话，用于保持连接
+            self.session = requests.Session()
+            self.session.auth = (self.webdav_user, self.webdav_pass)
+            self.session.headers.update({'User-Agent': 'WebDAV-Backup-Script-Python/1.0'})
+            # 连接池需容纳并发上传的线程数，否则多出的连接用完即关闭，无法复用
+            pool_size = HTTP_POOL_SIZE or max(10, MULTIPART_CONCURRENCY, DEDUP_UPLOAD_WORKERS)
+            adapter = RetryingHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        
+        # 异步客户端：目录创建、列表、删除、校验等相互独立的小请求在后台事件循环中并发执行
+        self.async_client = async_client
+        if self.async_client is None:
+            self.async_client = AsyncLoopThread.get().run(self._create_async_client())
+        
+        # 以manifest方式分片上传（服务器端未合并）的远程文件地址
+        self.manifest_uploads = set()
+        
+        # 最近一次写出的压缩包的随机访问索引（tar格式且开启WRITE_RESTORE_INDEX时），以及已上传的索引文件名
+        self.archive_index = None
+        self.uploaded_indexes = set()
         
-        # 创建会话，用于保持连接
-        self.session = requests.Session()
-        self.session.auth = (self.webdav_user, self.webdav_pass)
-        self.session.headers.update({'User-Agent': 'WebDAV-Backup-Script-Python/1.0'})
+        # 加密主密钥（启用加密或恢复加密备份时读取）
+        self.encryption_key = None
         
         # 邮箱通知参数
         self.enable_email_notification = ENABLE_EMAIL_NOTIFICATION
@@ -107,13 +3444,44 @@ class WebDAVBackup:
         self.email_to = EMAIL_TO
         self.email_subject_prefix = EMAIL_SUBJECT_PREFIX
     
+    @contextlib.contextmanager
+    def stage(self, name):
+        """进入备份阶段（compress/upload），多任务调度时在此等待该阶段的空闲名额"""
+        slot = self.stage_slots.get(name)
+        if slot is None:
+            yield
+            return
+        with slot:
+            yield
+    
+    async def _create_async_client(self):
+        """在事件循环线程中创建异步客户端（连接池等对象须属于该事件循环）"""
+        return AsyncWebDAVClient(self.webdav_user, self.webdav_pass, session=self.session)
+    
+    def run_async(self, coro):
+        """在后台事件循环中执行协程并等待结果"""
+        return AsyncLoopThread.get().run(coro)
+    
+    def run_async_all(self, coros, return_exceptions=False, limit=None):
+        """在后台事件循环中并发执行一组协程，按顺序返回结果（并发连接数由异步客户端的连接池限制，limit可进一步限制同时执行的协程数）"""
+        async def gather():
+            if limit:
+                slots = asyncio.Semaphore(limit)
+                
+                async def bounded(coro):
+                    async with slots:
+                        return await coro
+                return await asyncio.gather(*(bounded(coro) for coro in coros), return_exceptions=return_exceptions)
+            return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+        return self.run_async(gather())
+    
     def check_source_dir(self):
         """检查源目录是否存在"""
         if not os.path.isdir(self.source_dir):
             error_msg = f"错误：源目录 {self.source_dir} 不存在！"
             print(error_msg)
             self.send_notification_email("WebDAV备份失败 - 源目录不存在", error_msg)
-            sys.exit(1)
+            raise BackupExit(1)
     
     def create_local_backup_dir(self):
         """创建本地备份目录（如果不存在）"""
@@ -121,131 +3489,1218 @@ class WebDAVBackup:
             os.makedirs(self.local_backup_dir, exist_ok=True)
         except Exception as e:
             print(f"错误：无法创建本地备份目录 {self.local_backup_dir}！")
-            print(f"详细错误：{str(e)}")
-            sys.exit(1)
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            raise BackupExit(1)
     
     def generate_backup_filename(self):
-        """生成备份文件名（包含日期时间）"""
+        """生成备份文件名（包含日期时间，增量/差异模式下附带备份类型标记）"""
         timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_filename = f"{self.backup_prefix}_{timestamp}.{self.backup_format}"
+        kind_tag = ""
+        if self.backup_plan is not None:
+            kind_tag = f"_{BACKUP_KIND_TAGS[self.backup_plan['kind']]}"
+        backup_filename = f"{self.backup_prefix}_{timestamp}{kind_tag}.{self.backup_format}"
+        if ENABLE_ENCRYPTION:
+            backup_filename += ENCRYPTED_SUFFIX
         local_backup_path = os.path.join(self.local_backup_dir, backup_filename)
         return backup_filename, local_backup_path
     
+    def get_index_path(self, name):
+        """获取增量索引文件路径（name为last或full）"""
+        return os.path.join(self.state_dir, f"{self.backup_prefix}_index_{name}.json.gz")
+    
+    def load_file_index(self, name):
+        """读取增量索引，不存在或与当前配置不匹配时返回None"""
+        index_path = self.get_index_path(name)
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with gzip.open(index_path, 'rt', encoding='utf-8') as f:
+                index = json.load(f)
+        except Exception as e:
+            print(f"警告：读取增量索引 {index_path} 失败，将执行全量备份: {str(e)}")
+            return None
+        if index.get("source_dir") != self.source_dir or index.get("format") != self.backup_format:
+            print("注意：源目录或备份格式已变更，将执行全量备份")
+            return None
+        return index
+    
+    def save_file_index(self, name, index):
+        """写入增量索引（先写临时文件再替换，避免中断时损坏索引）"""
+        os.makedirs(self.state_dir, exist_ok=True)
+        index_path = self.get_index_path(name)
+        tmp_path = index_path + ".tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, index_path)
+    
+    def get_source_manifest(self, follow_file_links=None):
+        """获取源目录文件清单（按排除规则过滤并排序），每次运行只扫描一次；zip格式跟随指向文件的符号链接"""
+        if follow_file_links is None:
+            follow_file_links = self.backup_format == "zip"
+        if follow_file_links not in self.source_manifests:
+            rules = ExcludeRules.from_config(self.exclude_patterns, EXCLUDE_FROM_FILE)
+            scanner = SourceScanner(self.source_dir, rules, SCAN_WORKERS, follow_file_links)
+            start_time = time.perf_counter()
+            manifest = scanner.scan()
+            seconds = time.perf_counter() - start_time
+            files = [entry for entry in manifest if entry.kind == "f"]
+            total_size = sum(entry.size for entry in files)
+            self.metrics.record("scan", seconds, files=len(files))
+            message = (f"扫描源目录完成: {len(files)} 个文件，{len(manifest) - len(files)} 个目录和链接，"
+                       f"共 {total_size / 1024 / 1024:.2f} MB，耗时 {seconds:.2f} 秒")
+            if scanner.excluded:
+                message += f"，按排除规则跳过 {scanner.excluded} 项"
+            print(message)
+            self.source_manifests[follow_file_links] = manifest
+        return self.source_manifests[follow_file_links]
+    
+    def scan_source_tree(self):
+        """由源目录文件清单生成文件状态，返回 {压缩包内路径: [类型, 大小, 修改时间(ns), inode, 内容哈希]}"""
+        return {entry.arcname: [entry.kind, entry.size, entry.mtime_ns, entry.stat.st_ino, entry.link]
+                for entry in self.get_source_manifest()}
+    
+    def get_archived_source_size(self):
+        """本次归档的源文件总大小（增量/差异模式下只计算需要归档的文件）"""
+        manifest = self.get_source_manifest()
+        if self.backup_plan is not None:
+            needed = set(self.backup_plan["entries"])
+            return sum(entry.size for entry in manifest if entry.kind == "f" and entry.arcname in needed)
+        return sum(entry.size for entry in manifest if entry.kind == "f")
+    
+    def get_archive_source_parent(self):
+        """归档时读取文件的根目录：创建了快照时为快照目录，否则为源目录的上级目录"""
+        return self.snapshot_root or os.path.dirname(self.source_dir)
+    
+    def quiesce_source(self):
+        """执行QUIESCE_COMMAND暂停源目录的写入，命令返回非0时抛出异常"""
+        if not QUIESCE_COMMAND or self.source_quiesced:
+            return
+        print(f"正在执行暂停写入命令: {QUIESCE_COMMAND}")
+        # 命令执行失败时也可能已经部分生效，同样需要执行恢复命令
+        self.source_quiesced = True
+        result = subprocess.run(QUIESCE_COMMAND, shell=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"暂停写入命令执行失败（返回值 {result.returncode}）")
+    
+    def resume_source(self):
+        """执行RESUME_COMMAND恢复源目录的写入（只在执行过暂停命令后执行一次）"""
+        if not self.source_quiesced:
+            return
+        self.source_quiesced = False
+        if not RESUME_COMMAND:
+            return
+        print(f"正在执行恢复写入命令: {RESUME_COMMAND}")
+        try:
+            result = subprocess.run(RESUME_COMMAND, shell=True)
+            if result.returncode != 0:
+                print(f"警告：恢复写入命令执行失败（返回值 {result.returncode}）")
+        except OSError as e:
+            print(f"警告：恢复写入命令执行失败: {str(e)}")
+    
+    def create_source_snapshot(self):
+        """copy模式下把需要归档的文件复制到快照目录，复制前后大小或修改时间不同的文件在重试次数和数据量预算内重新复制"""
+        if SNAPSHOT_MODE == "none":
+            return
+        if SNAPSHOT_MODE != "copy":
+            raise ValueError(f"不支持的快照模式: {SNAPSHOT_MODE}，请使用 'none' 或 'copy'")
+        
+        manifest = self.get_source_manifest()
+        plan = self.backup_plan
+        snapshot_root = os.path.join(SNAPSHOT_DIR or self.state_dir, f"{self.backup_prefix}_snapshot")
+        shutil.rmtree(snapshot_root, ignore_errors=True)
+        print(f"正在创建源目录快照: {snapshot_root}")
+        
+        source_dir_parent = os.path.dirname(self.source_dir)
+        cloner = FileCloner()
+        budget = int(SNAPSHOT_RETRY_BUDGET_MB * 1024 * 1024)
+        copied_files = 0
+        copied_bytes = 0
+        retried_bytes = 0
+        retries = 0
+        created_dirs = set()
+        start_time = time.perf_counter()
+        # 增量/差异模式下只复制本次需要归档的文件，快照的开销与变化的数据量成正比
+        needed = set(plan["entries"]) if plan is not None else None
+        for index, entry in enumerate(manifest):
+            if entry.kind != "f" or (needed is not None and entry.arcname not in needed):
+                continue
+            src_path = os.path.join(source_dir_parent, entry.arcname)
+            dst_path = os.path.join(snapshot_root, entry.arcname)
+            dst_dir = os.path.dirname(dst_path)
+            if dst_dir not in created_dirs:
+                os.makedirs(dst_dir, exist_ok=True)
+                created_dirs.add(dst_dir)
+            
+            attempts = 0
+            while True:
+                try:
+                    before = os.stat(src_path)
+                    size = cloner.copy(src_path, dst_path)
+                    after = os.stat(src_path)
+                except OSError as e:
+                    # 快照中没有的文件在归档时会被跳过并给出警告
+                    print(f"警告：无法复制文件 {src_path} 到快照，错误: {str(e)}")
+                    with contextlib.suppress(OSError):
+                        os.remove(dst_path)
+                    break
+                copied_bytes += size
+                stable = before.st_size == after.st_size == size and before.st_mtime_ns == after.st_mtime_ns
+                if not stable and attempts < SNAPSHOT_RETRIES and retried_bytes + after.st_size <= budget:
+                    attempts += 1
+                    retries += 1
+                    retried_bytes += after.st_size
+                    continue
+                copied_files += 1
+                # 归档使用快照中文件的实际大小，其他属性取复制后源文件的stat结果
+                manifest[index] = entry._replace(size=size, mtime_ns=after.st_mtime_ns, mode=after.st_mode, stat=after)
+                if plan is not None:
+                    if stable:
+                        plan["files"][entry.arcname][1:3] = [size, after.st_mtime_ns]
+                    else:
+                        # 内容可能不完整，不记入索引，下次备份时重新归档
+                        plan["files"].pop(entry.arcname, None)
+                if not stable:
+                    print(f"警告：文件 {src_path} 在复制期间持续变化，快照中使用最后一次复制的内容")
+                break
+        
+        self.snapshot_root = snapshot_root
+        seconds = time.perf_counter() - start_time
+        self.metrics.record("snapshot", seconds, bytes=copied_bytes, retries=retries, files=copied_files)
+        methods = "，".join(f"{name} {count} 次" for name, count in cloner.counts.items())
+        print(f"快照完成: {copied_files} 个文件（{methods or '无需复制'}），复制 {copied_bytes / 1024 / 1024:.2f} MB，"
+              f"重新复制 {retries} 次，耗时 {seconds:.2f} 秒")
+    
+    def remove_source_snapshot(self):
+        """删除快照目录"""
+        if self.snapshot_root is None:
+            return
+        shutil.rmtree(self.snapshot_root, ignore_errors=True)
+        self.snapshot_root = None
+    
+    def calculate_content_hash(self, file_path):
+        """计算文件内容的SHA-256哈希"""
+        hash_sha256 = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hash_sha256.update(chunk)
+        return hash_sha256.hexdigest()
+    
+    def plan_backup(self):
+        """增量/差异模式下比对文件状态索引，确定本次备份类型及需要归档的文件"""
+        if self.backup_mode == "full":
+            self.backup_plan = None
+            return
+        if self.backup_mode not in BACKUP_KIND_TAGS:
+            raise ValueError(f"不支持的备份模式: {self.backup_mode}，请使用 'full'、'incremental' 或 'differential'")
+        
+        print("正在扫描源目录并比对文件状态索引...")
+        current = self.scan_source_tree()
+        last_index = self.load_file_index("last")
+        
+        kind = self.backup_mode
+        base_index = None
+        if last_index is not None:
+            base_index = last_index if kind == "incremental" else self.load_file_index("full")
+        
+        since_full = last_index["since_full"] + 1 if last_index else 0
+        if base_index is None:
+            kind = "full"
+        elif FULL_BACKUP_INTERVAL > 0 and since_full >= FULL_BACKUP_INTERVAL:
+            print(f"距上次全量备份已有 {since_full} 次备份，本次执行全量备份")
+            kind = "full"
+        
+        source_dir_parent = os.path.dirname(self.source_dir)
+        base_files = base_index["files"] if kind != "full" else {}
+        changed = []
+        for arcname, state in current.items():
+            old_state = base_files.get(arcname)
+            if old_state is not None and old_state[0] == state[0] and old_state[1] == state[1]:
+                if state[0] == "d":
+                    continue
+                if state[0] == "l":
+                    if old_state[4] == state[4]:
+                        continue
+                elif old_state[2] == state[2] and old_state[3] == state[3]:
+                    # 元数据完全一致，沿用上次的内容哈希
+                    state[4] = old_state[4]
+                    continue
+                elif INCREMENTAL_HASH_CHECK and old_state[4]:
+                    # 仅时间戳或inode变化时通过内容哈希确认
+                    try:
+                        content_hash = self.calculate_content_hash(os.path.join(source_dir_parent, arcname))
+                    except OSError:
+                        content_hash = None
+                    if content_hash == old_state[4]:
+                        state[4] = content_hash
+                        continue
+            changed.append(arcname)
+        
+        deleted = sorted(arcname for arcname in base_files if arcname not in current)
+        changed.sort()
+        
+        if kind == "full":
+            base_backup = None
+            full_backup = None
+            since_full = 0
+        else:
+            base_backup = base_index["backup"]
+            full_backup = base_index["full_backup"]
+        
+        self.backup_plan = {
+            "kind": kind,
+            "entries": changed,
+            "deleted": deleted,
+            "files": current,
+            "base_backup": base_backup,
+            "full_backup": full_backup,
+            "since_full": since_full,
+        }
+        print(f"备份类型: {kind}，需要归档 {len(changed)} 项，已删除 {len(deleted)} 项")
+    
+    def build_plan_index(self, backup_filename):
+        """根据本次备份计划生成文件状态索引"""
+        plan = self.backup_plan
+        return {
+            "version": 1,
+            "source_dir": self.source_dir,
+            "format": self.backup_format,
+            "backup": backup_filename,
+            "full_backup": plan["full_backup"] or backup_filename,
+            "since_full": plan["since_full"],
+            "files": plan["files"],
+        }
+    
+    def commit_backup_plan(self, backup_filename):
+        """备份上传并校验成功后更新文件状态索引，使下一次增量备份以本次为基准"""
+        if self.backup_plan is None:
+            return
+        try:
+            index = self.build_plan_index(backup_filename)
+            self.save_file_index("last", index)
+            if self.backup_plan["kind"] == "full":
+                self.save_file_index("full", index)
+        except Exception as e:
+            print(f"警告：保存增量索引失败，下次备份将仍以上一次的索引为基准: {str(e)}")
+    
+    def get_pending_plan_path(self, backup_filename):
+        """获取分片上传未完成的备份的待提交索引文件路径（与分片上传日志放在一起）"""
+        return os.path.join(self.state_dir, UPLOAD_JOURNAL_DIR_NAME, f"{backup_filename}.plan.json.gz")
+    
+    def save_pending_plan(self, backup_filename):
+        """分片上传中断时保存本次的文件状态索引，继续上传完成后再提交"""
+        if self.backup_plan is None:
+            return
+        last = self.load_file_index("last")
+        pending = {
+            "previous": last and last["backup"],
+            "kind": self.backup_plan["kind"],
+            "index": self.build_plan_index(backup_filename),
+        }
+        pending_path = self.get_pending_plan_path(backup_filename)
+        try:
+            with gzip.open(pending_path + ".tmp", 'wt', encoding='utf-8') as f:
+                json.dump(pending, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(pending_path + ".tmp", pending_path)
+        except OSError as e:
+            print(f"警告：保存待提交的增量索引失败，继续上传完成后下次备份将仍以上一次的索引为基准: {str(e)}")
+    
+    def commit_pending_plan(self, backup_filename):
+        """继续上传完成后提交保存的文件状态索引（之后已有其他备份更新了索引时不再提交，避免索引倒退）"""
+        pending_path = self.get_pending_plan_path(backup_filename)
+        if not os.path.exists(pending_path):
+            return
+        try:
+            with gzip.open(pending_path, 'rt', encoding='utf-8') as f:
+                pending = json.load(f)
+            last = self.load_file_index("last")
+            if (last and last["backup"]) != pending["previous"]:
+                print(f"注意：{backup_filename} 中断后已有新的备份更新了增量索引，不再以它为增量基准")
+            else:
+                self.save_file_index("last", pending["index"])
+                if pending["kind"] == "full":
+                    self.save_file_index("full", pending["index"])
+            os.remove(pending_path)
+        except Exception as e:
+            print(f"警告：提交 {backup_filename} 的增量索引失败，下次备份将仍以上一次的索引为基准: {str(e)}")
+    
+    def finish_uploaded_backup(self, backup_filename, remote_listing=None, resumed=False):
+        """备份上传并校验成功后的收尾：更新增量索引、上传随机访问索引、清理WebDAV上的旧备份（resumed表示继续上传完成的备份）"""
+        # 上传并校验成功后才更新增量索引
+        if resumed:
+            self.commit_pending_plan(backup_filename)
+        else:
+            self.commit_backup_plan(backup_filename)
+        
+        # 上传随机访问索引，恢复单个文件时使用（继续上传时读取备份文件旁保存的索引）
+        if resumed:
+            index_path = os.path.join(self.local_backup_dir, backup_filename) + ARCHIVE_INDEX_SUFFIX
+            if os.path.exists(index_path):
+                with open(index_path, 'rb') as f:
+                    self.upload_archive_index(backup_filename, f.read())
+        else:
+            self.upload_archive_index(backup_filename)
+        
+        # 清理WebDAV上的旧备份
+        with self.metrics.measure("clean_remote"):
+            self.clean_remote_backups(backup_filename, remote_listing)
+    
     def create_backup_file(self, local_backup_path):
-        """创建压缩包"""
+        """创建压缩包，返回写入时同步计算的哈希（使用shutil.make_archive时返回None）"""
         print(f"正在创建备份文件: {local_backup_path}")
         try:
-            source_dir_parent = os.path.dirname(self.source_dir)
-            source_dir_name = os.path.basename(self.source_dir)
-            
-            if self.backup_format == "tar.gz":
-                with tarfile.open(local_backup_path, "w:gz") as tar:
-                    tar.add(os.path.join(source_dir_parent, source_dir_name), 
-                            arcname=source_dir_name)
-            elif self.backup_format == "zip":
-                import zipfile
-                import sys
-                import shutil
-                
+            if (self.backup_format == "zip" and sys.platform == 'win32' and self.backup_plan is None
+                    and not self.exclude_patterns and not EXCLUDE_FROM_FILE and not ENABLE_ENCRYPTION):
                 # 针对Windows平台特殊处理
-                if sys.platform == 'win32':
-                    # 使用shutil.make_archive替代zipfile，它能更好地处理Windows上的编码问题
-                    try:
-                        # 尝试使用shutil.make_archive创建zip文件
-                        base_name = local_backup_path[:-4]  # 去掉.zip后缀
-                        shutil.make_archive(base_name, 'zip', source_dir_parent, source_dir_name)
-                    except Exception as e:
-                        # 如果shutil方法失败，回退到zipfile方法但增强编码处理
-                        print(f"警告：使用shutil创建zip文件失败，尝试使用替代方法: {str(e)}")
-                        
-                        with zipfile.ZipFile(local_backup_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-                            # 遍历源目录中的所有文件和子目录
-                            for root, dirs, files in os.walk(os.path.join(source_dir_parent, source_dir_name)):
-                                for file in files:
-                                    file_path = os.path.join(root, file)
-                                    
-                                    # 使用bytes路径处理特殊字符
-                                    try:
-                                        # 计算相对路径
-                                        rel_path = os.path.relpath(file_path, source_dir_parent)
-                                        
-                                        # 尝试不同的编码策略
-                                        try:
-                                            # 策略1: 直接写入
-                                            zipf.write(file_path, rel_path)
-                                        except UnicodeEncodeError:
-                                            # 策略2: 使用surrogateescape处理
-                                            try:
-                                                arcname_bytes = rel_path.encode('utf-8', 'surrogateescape')
-                                                zipf.write(file_path, arcname_bytes)
-                                            except Exception:
-                                                # 策略3: 使用原始文件名作为arcname
-                                                zipf.write(file_path)
-                                    except Exception as inner_e:
-                                        print(f"警告：无法添加文件 {file_path} 到备份，错误: {str(inner_e)}")
-                                        # 继续处理其他文件
-                                        continue
-                else:
-                    # 非Windows平台使用标准方式，但增强编码处理
-                    with zipfile.ZipFile(local_backup_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-                        # 遍历源目录中的所有文件和子目录
-                        for root, dirs, files in os.walk(os.path.join(source_dir_parent, source_dir_name)):
-                            for file in files:
-                                try:
-                                    file_path = os.path.join(root, file)
-                                    arcname = os.path.relpath(file_path, source_dir_parent)
-                                    
-                                    try:
-                                        zipf.write(file_path, arcname)
-                                    except UnicodeEncodeError:
-                                        # 在非Windows平台上也可能遇到编码问题
-                                        arcname_safe = arcname.encode('utf-8', 'replace').decode('utf-8')
-                                        zipf.write(file_path, arcname_safe)
-                                except Exception as inner_e:
-                                    print(f"警告：无法添加文件 {file} 到备份，错误: {str(inner_e)}")
-                                    # 继续处理其他文件
-                                    continue
-            else:
-                raise ValueError(f"不支持的备份格式: {self.backup_format}，请使用 'tar.gz' 或 'zip'")
+                # 使用shutil.make_archive替代zipfile，它能更好地处理Windows上的编码问题
+                try:
+                    # 尝试使用shutil.make_archive创建zip文件
+                    base_name = local_backup_path[:-4]  # 去掉.zip后缀
+                    shutil.make_archive(base_name, 'zip', os.path.dirname(self.source_dir),
+                                        os.path.basename(self.source_dir))
+                    return None
+                except Exception as e:
+                    # 如果shutil方法失败，回退到zipfile方法但增强编码处理
+                    print(f"警告：使用shutil创建zip文件失败，尝试使用替代方法: {str(e)}")
+            
+            # 加密时哈希针对写入文件的密文计算，完整性检测校验的即是上传的数据
+            hasher = ArchiveHasher()
+            with open(local_backup_path, 'wb') as f:
+                output = HashingWriter(f, hasher)
+                encryptor = self.encrypt_output(output)
+                self.write_archive(encryptor or output)
+                if encryptor is not None:
+                    encryptor.close()
+            self.save_archive_index(local_backup_path)
+            return hasher.finish()
             
         except Exception as e:
             print(f"错误：创建备份文件失败！")
-            print(f"详细错误：{str(e)}")
-            sys.exit(1)
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            raise BackupExit(1)
     
-    def create_webdav_directories(self):
-        """逐级创建WebDAV目录"""
-        dir_parts = self.webdav_upload_dir.split('/')
-        current_path = ""
+    def save_archive_index(self, local_backup_path):
+        """把随机访问索引写入备份文件旁（备份文件名加ARCHIVE_INDEX_SUFFIX）"""
+        if self.archive_index is None:
+            return
+        index_path = local_backup_path + ARCHIVE_INDEX_SUFFIX
+        try:
+            data = self.encode_archive_index()
+            with open(index_path + ".tmp", 'wb') as f:
+                f.write(data)
+            os.replace(index_path + ".tmp", index_path)
+        except OSError as e:
+            print(f"警告：保存随机访问索引失败，恢复单个文件时需要下载整个备份: {str(e)}")
+    
+    def encode_archive_index(self):
+        """序列化随机访问索引（gzip压缩的JSON，加密备份的索引同样加密）"""
+        data = gzip.compress(json.dumps(self.archive_index, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        if ENABLE_ENCRYPTION:
+            data = encrypt_bytes(self.get_encryption_key(), data)
+        return data
+    
+    def get_encryption_key(self):
+        """读取加密主密钥（只读取一次）"""
+        if self.encryption_key is None:
+            self.encryption_key = EncryptionKey.from_config()
+        return self.encryption_key
+    
+    def check_encryption(self):
+        """启用加密时在压缩前检查密钥和加密库，避免压缩完成后才发现配置错误"""
+        if not ENABLE_ENCRYPTION:
+            return
+        if ENABLE_DEDUP_STORE:
+            print("错误：去重存储模式不支持加密，请关闭ENABLE_DEDUP_STORE或ENABLE_ENCRYPTION")
+            raise BackupExit(1)
+        try:
+            load_aead(ENCRYPTION_ALGORITHM)
+            self.get_encryption_key()
+        except (ImportError, ValueError, OSError) as e:
+            print(f"错误：加密配置无效！")
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            raise BackupExit(1)
+    
+    def encrypt_output(self, fileobj):
+        """启用加密时返回把数据分块加密后写入fileobj的写入端（写完后需调用close写出末块），否则返回None"""
+        if not ENABLE_ENCRYPTION:
+            return None
+        cipher = ChunkCipher.create(self.get_encryption_key())
+        print(f"加密算法: {cipher.algorithm}（每块 {cipher.chunk_size // 1024} KB）")
+        return EncryptingWriter(fileobj, cipher)
+    
+    def upload_archive_index(self, backup_filename, data=None):
+        """把随机访问索引上传到备份文件旁（data为已序列化的索引，为空时使用本次生成的索引），失败时只给出警告"""
+        if data is None:
+            if self.archive_index is None:
+                return
+            data = self.encode_archive_index()
+        index_name = f"{backup_filename}{ARCHIVE_INDEX_SUFFIX}"
+        try:
+            response = self.session.put(f"{self.webdav_base_url}/{self.webdav_upload_dir}/{index_name}",
+                                        data=data, timeout=(CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME))
+            if response.status_code not in [200, 201, 204]:
+                raise IOError(f"HTTP状态码: {response.status_code}")
+            self.uploaded_indexes.add(index_name)
+            print(f"已上传随机访问索引: {index_name}（{len(data) / 1024:.1f} KB）")
+        except Exception as e:
+            print(f"警告：上传随机访问索引失败，恢复单个文件时需要下载整个备份: {str(e)}")
+    
+    def write_archive(self, fileobj, raw_tar=False):
+        """将源目录打包压缩并写入文件对象（支持不可回退的流式输出，raw_tar为True时输出不压缩的tar流）"""
+        self.archive_index = None
+        if raw_tar:
+            with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+                self._add_manifest_entries(tar=tar)
+            return
+        
+        workers = resolve_worker_count(self.compression_workers)
+        block_size = int(COMPRESSION_BLOCK_SIZE_MB * 1024 * 1024)
+        
+        if self.backup_format in TAR_CODECS:
+            # tar流本身不压缩，交由所选格式的压缩写入端压缩（多核时按块并行或使用格式自带的多线程）
+            codec = TAR_CODECS[self.backup_format]
+            codec.load()
+            level = self.resolve_compression_level(codec, workers)
+            # 已压缩的文件切换为存储级别，需要支持按文件切换级别的分块写入端
+            store_filter = None
+            if TAR_STORE_INCOMPRESSIBLE and codec.store_level is not None:
+                store_filter = CompressibilityFilter()
+            # 写入随机访问索引时压缩流需由独立压缩块组成，恢复时可从文件所在块的起点开始解压
+            indexed = WRITE_RESTORE_INDEX and codec.restartable
+            if indexed:
+                block_size = min(block_size, int(RESTORE_INDEX_BLOCK_KB * 1024))
+            compressor = codec.open(fileobj, level, workers, block_size, switchable=store_filter is not None, blocks=indexed)
+            if store_filter is not None:
+                store_filter.attach_tar(compressor, level, codec.store_level)
+            try:
+                # 使用流式模式（w|），输出端无需支持seek
+                with (IndexedTarFile if indexed else tarfile.TarFile).open(fileobj=compressor, mode="w|") as tar:
+                    if self.backup_plan is not None:
+                        self._add_planned_entries(tar=tar, store_filter=store_filter)
+                        self._write_backup_manifest(tar=tar)
+                    else:
+                        self._add_manifest_entries(tar=tar, store_filter=store_filter)
+            finally:
+                compressor.close()
+            if indexed:
+                self.archive_index = {
+                    "version": 1,
+                    "format": self.backup_format,
+                    "size": compressor.bytes_out,
+                    "restart_points": compressor.restart_points,
+                    "members": tar.index_members,
+                }
+            if store_filter is not None:
+                store_filter.report(lambda data: codec.compress(data, level),
+                                    lambda data: codec.compress(data, codec.store_level))
+        elif self.backup_format == "zip":
+            import zipfile
+            
+            # 已压缩的文件（图片、视频、压缩包等）以ZIP_STORED方式只存储，不再压缩
+            store_filter = CompressibilityFilter() if SKIP_INCOMPRESSIBLE else None
+            
+            # 输出端不支持seek时，zipfile会自动改用数据描述符记录校验和与大小；并行压缩时由ParallelZipWriter写出整个zip文件
+            if workers > 1:
+                archive = ParallelZipWriter(fileobj, workers, block_size)
+            else:
+                archive = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED)
+            with archive as zipf:
+                deflater = zipf if workers > 1 else None
+                if self.backup_plan is not None:
+                    self._add_planned_entries(zipf=zipf, deflater=deflater, store_filter=store_filter)
+                    self._write_backup_manifest(zipf=zipf)
+                else:
+                    self._add_manifest_entries(zipf=zipf, deflater=deflater, store_filter=store_filter)
+            if store_filter is not None:
+                store_filter.report(zlib.compress)
+        else:
+            raise ValueError(f"不支持的备份格式: {self.backup_format}，请使用 {', '.join(repr(name) for name in BACKUP_FORMATS)}")
+    
+    def resolve_compression_level(self, codec, workers):
+        """确定本次使用的压缩级别（auto模式下只在首次调用时抽样测试）"""
+        if self.compression_level is None:
+            return codec.default_level
+        if self.compression_level != "auto":
+            return int(self.compression_level)
+        selected = getattr(self, "_auto_levels", {})
+        if codec.name not in selected:
+            selected[codec.name] = self.select_compression_level(codec, workers)
+            self._auto_levels = selected
+        return selected[codec.name]
+    
+    def list_archive_files(self):
+        """本次需要归档的普通文件 [(路径, 大小)]（增量/差异模式下只包含新增和修改的文件）"""
+        source_dir_parent = self.get_archive_source_parent()
+        if self.backup_plan is not None:
+            return [(os.path.join(source_dir_parent, arcname), self.backup_plan["files"][arcname][1])
+                    for arcname in self.backup_plan["entries"] if self.backup_plan["files"][arcname][0] == "f"]
+        return [(os.path.join(source_dir_parent, entry.arcname), entry.size)
+                for entry in self.get_source_manifest() if entry.kind == "f"]
+    
+    def read_compression_sample(self, sample_bytes, piece_bytes=1024 * 1024):
+        """从待备份的文件中均匀抽取若干片段作为压缩测试样本，返回 (样本数据, 待备份数据总量)"""
+        files = self.list_archive_files()
+        total = sum(size for path, size in files)
+        
+        # 每隔interval字节取一个片段，使样本覆盖各类文件
+        interval = max(piece_bytes, total // max(1, sample_bytes // piece_bytes))
+        sample = bytearray()
+        position = 0
+        next_point = 0
+        for file_path, size in files:
+            if len(sample) >= sample_bytes:
+                break
+            if position + size > next_point:
+                try:
+                    with open(file_path, 'rb') as f:
+                        sample += f.read(min(piece_bytes, sample_bytes - len(sample)))
+                except OSError:
+                    pass
+                next_point = position + size + interval
+            position += size
+        return bytes(sample), total
+    
+    def estimate_upload_bandwidth(self, archive_bytes):
+        """估计上传带宽（字节/秒）：历史上传速度或UPLOAD_BANDWIDTH_ESTIMATE，设置了速度限制时取较小值"""
+        bandwidth = self.load_run_stats().get("upload_bytes_per_second") or parse_rate_limit(UPLOAD_BANDWIDTH_ESTIMATE)
+        limiter = self.create_rate_limiter(self.select_rate_limit(archive_bytes / 1024 / 1024))
+        limit = limiter.current_rate() if limiter is not None else None
+        if limit and (not bandwidth or limit < bandwidth):
+            bandwidth = limit
+        return bandwidth
+    
+    def select_compression_level(self, codec, workers):
+        """抽样测试各压缩级别的速度和压缩率，选择预计总耗时（压缩+上传，流式上传时取两者中较大值）最短的级别"""
+        sample, total = self.read_compression_sample(int(AUTO_LEVEL_SAMPLE_MB * 1024 * 1024))
+        if not sample:
+            return codec.default_level
+        
+        print(f"正在自动选择{codec.name}压缩级别（抽样 {len(sample) / 1024 / 1024:.2f} MB，待备份 {total / 1024 / 1024:.2f} MB）...")
+        best_level, best_time, bandwidth = codec.default_level, None, None
+        for level in codec.auto_levels:
+            start_time = time.perf_counter()
+            compressed_size = len(codec.compress(sample, level))
+            # 并行压缩的吞吐量按线程数线性估计
+            throughput = len(sample) / max(time.perf_counter() - start_time, 1e-6) * workers
+            ratio = compressed_size / len(sample)
+            if bandwidth is None:
+                bandwidth = self.estimate_upload_bandwidth(total * ratio)
+            compress_time = total / throughput
+            upload_time = total * ratio / bandwidth if bandwidth else 0
+            estimated = max(compress_time, upload_time) if self.streaming_upload else compress_time + upload_time
+            print(f"  级别 {level:>2}: 压缩 {throughput / 1024 / 1024:8.2f} MB/s，压缩后 {ratio * 100:5.1f}%，"
+                  f"预计总耗时 {estimated:.1f} 秒")
+            if best_time is None or estimated < best_time:
+                best_level, best_time = level, estimated
+        print(f"选择压缩级别 {best_level}（上传带宽按 {bandwidth / 1024 / 1024:.2f} MB/s 估计）" if bandwidth
+              else f"选择压缩级别 {best_level}")
+        return best_level
+    
+    def get_run_stats_path(self):
+        """获取运行统计文件路径"""
+        return os.path.join(self.state_dir, f"{self.backup_prefix}_{RUN_STATS_NAME}")
+    
+    def load_run_stats(self):
+        """读取运行统计，不存在或已损坏时返回空字典"""
+        try:
+            with open(self.get_run_stats_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def save_run_stats(self, stats):
+        """写入运行统计（先写临时文件再替换）"""
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            tmp_path = self.get_run_stats_path() + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, self.get_run_stats_path())
+        except OSError as e:
+            print(f"警告：保存运行统计失败: {str(e)}")
+    
+    def record_throughput(self, name, size, seconds):
+        """记录一次传输/压缩的速度（字节/秒），与历史值做指数平滑，避免单次波动影响过大"""
+        if size <= 0 or seconds <= 0:
+            return
+        stats = self.load_run_stats()
+        key = f"{name}_bytes_per_second"
+        speed = size / seconds
+        stats[key] = speed if not stats.get(key) else stats[key] * 0.5 + speed * 0.5
+        self.save_run_stats(stats)
+
+    def estimate_archive(self, sample_bytes, piece_bytes=256 * 1024):
+        """分层抽样压缩估计压缩包：按文件大小数量级和是否为已压缩格式分层，每层按数据量分配样本并均匀抽取文件，
+        返回 (待归档数据量, 估计的压缩包大小, 估计的单线程压缩耗时, 抽样数据量)"""
+        files = self.list_archive_files()
+        total = sum(size for path, size in files)
+
+        if self.backup_format in TAR_CODECS:
+            codec = TAR_CODECS[self.backup_format]
+            codec.load()
+            level = self.resolve_compression_level(codec, resolve_worker_count(self.compression_workers))
+            store_level = codec.store_level if TAR_STORE_INCOMPRESSIBLE else None
+            compress = lambda data, store: codec.compress(data, store_level if store and store_level is not None else level)
+            # tar条目头（512字节）与数据一起压缩
+            entry_overhead, overhead_compressed = tarfile.BLOCKSIZE, True
+        else:
+            compress = lambda data, store: data if store and SKIP_INCOMPRESSIBLE else zlib.compress(data)
+            # zip的本地文件头、数据描述符和中央目录条目不压缩
+            entry_overhead, overhead_compressed = 128, False
+
+        strata = {}
+        for file_path, size in files:
+            key = (bisect.bisect_right((4096, 65536, 1024 * 1024, 16 * 1024 * 1024), size),
+                   file_path.lower().endswith(INCOMPRESSIBLE_EXTENSIONS))
+            strata.setdefault(key, []).append((file_path, size))
+
+        archive_size = 0.0
+        compress_seconds = 0.0
+        sampled = 0
+        for (size_class, incompressible), members in strata.items():
+            stratum_bytes = sum(size for file_path, size in members)
+            # 每层至少抽取一个片段，其余按该层数据量占比分配；文件数少于片段数时从每个文件的不同位置读取多个片段
+            budget = max(piece_bytes, sample_bytes * stratum_bytes // max(total, 1))
+            pieces = max(1, budget // piece_bytes)
+            picked = min(len(members), pieces)
+            pieces_per_file = -(-pieces // picked)
+            raw = compressed = 0
+            seconds = 0.0
+            for i in range(picked):
+                file_path, size = members[i * len(members) // picked]
+                try:
+                    with open(file_path, 'rb') as f:
+                        for j in range(pieces_per_file if size > piece_bytes else 1):
+                            f.seek(size * j // pieces_per_file)
+                            data = f.read(piece_bytes)
+                            if not data:
+                                break
+                            start_time = time.perf_counter()
+                            compressed += len(compress(data, incompressible))
+                            seconds += time.perf_counter() - start_time
+                            raw += len(data)
+                except OSError:
+                    continue
+            ratio = compressed / raw if raw else 1.0
+            overhead = len(members) * entry_overhead
+            archive_size += stratum_bytes * ratio + overhead * (ratio if overhead_compressed else 1)
+            if raw:
+                compress_seconds += stratum_bytes * seconds / raw
+            sampled += raw
+
+        if ENABLE_ENCRYPTION:
+            # 每个加密块附带认证标签
+            archive_size += ChunkCipher.HEADER.size + (archive_size // max(1, int(ENCRYPTION_CHUNK_KB * 1024)) + 1) * ChunkCipher.TAG_SIZE
+        return total, int(archive_size), compress_seconds, sampled
+
+    def get_remote_quota(self):
+        """通过PROPFIND（Depth: 0）获取上传目录的剩余配额（quota-available-bytes），目录尚不存在时依次查询上级目录，
+        服务器不提供配额时返回None"""
+        parts = [part for part in self.webdav_upload_dir.strip('/').split('/') if part]
+        for depth in range(len(parts), -1, -1):
+            url = f"{self.webdav_base_url}/{'/'.join(parts[:depth])}".rstrip('/') + '/'
+            try:
+                entries = self.run_async(self.async_client.propfind(url, depth=0, body=PROPFIND_QUOTA_BODY))
+            except Exception as e:
+                print(f"警告：获取WebDAV剩余配额失败: {str(e)}")
+                return None
+            if entries is None:
+                continue
+            quota = entries[0]["quota_available"] if entries else None
+            # 不限制或无法确定配额时服务器不返回该属性（Nextcloud以负数表示）
+            return quota if quota is not None and quota >= 0 else None
+        return None
+
+    def preflight_check(self):
+        """压缩前的预检：估计压缩包大小、压缩和上传耗时，检查本地剩余空间和WebDAV剩余配额；
+        本地空间不足时改用流式上传（PREFLIGHT_AUTO_STREAMING）或中止，WebDAV配额不足时中止"""
+        if not ENABLE_PREFLIGHT_CHECK:
+            return
+        print("正在执行预检...")
+        with self.metrics.measure("preflight") as preflight_stage:
+            total, archive_size, compress_seconds, sampled = self.estimate_archive(int(PREFLIGHT_SAMPLE_MB * 1024 * 1024))
+            required = int(archive_size * PREFLIGHT_SPACE_MARGIN)
+            local_free = free_disk_space(self.local_backup_dir)
+            remote_free = self.get_remote_quota()
+
+        # 压缩耗时优先使用历史压缩速度（包含读取文件的时间），否则按抽样测得的速度和线程数估计
+        stats = self.load_run_stats()
+        if stats.get("compress_bytes_per_second"):
+            compress_seconds = total / stats["compress_bytes_per_second"]
+        else:
+            compress_seconds /= resolve_worker_count(self.compression_workers)
+        bandwidth = self.estimate_upload_bandwidth(archive_size)
+        upload_seconds = archive_size / bandwidth if bandwidth else 0
+        preflight_stage.update(bytes=sampled, estimated_archive_bytes=archive_size,
+                               estimated_compress_seconds=round(compress_seconds, 1),
+                               estimated_upload_seconds=round(upload_seconds, 1))
+
+        print(f"预计压缩包大小: {archive_size / 1024 / 1024:.2f} MB（待归档 {total / 1024 / 1024:.2f} MB，"
+              f"抽样 {sampled / 1024 / 1024:.2f} MB），压缩约 {compress_seconds:.0f} 秒，"
+              + (f"上传约 {upload_seconds:.0f} 秒（{bandwidth / 1024 / 1024:.2f} MB/s）" if bandwidth else "上传耗时未知"))
+        if local_free is not None:
+            print(f"本地剩余空间: {local_free / 1024 / 1024:.2f} MB")
+        if remote_free is not None:
+            print(f"WebDAV剩余配额: {remote_free / 1024 / 1024:.2f} MB")
+
+        if remote_free is not None and required > remote_free:
+            error_msg = (f"错误：WebDAV剩余配额不足！需要约 {required / 1024 / 1024:.2f} MB，"
+                         f"剩余 {remote_free / 1024 / 1024:.2f} MB，请清理WebDAV空间或减小MAX_REMOTE_BACKUPS")
+            print(error_msg)
+            self.send_notification_email("WebDAV备份失败 - 预检未通过", error_msg)
+            raise BackupExit(1)
+
+        keeps_local_copy = not self.streaming_upload or self.streaming_keep_local_copy
+        if keeps_local_copy and local_free is not None and required > local_free:
+            if PREFLIGHT_AUTO_STREAMING:
+                print(f"警告：本地剩余空间不足（需要约 {required / 1024 / 1024:.2f} MB），本次改用流式上传且不保留本地备份文件")
+                self.streaming_upload = True
+                self.streaming_keep_local_copy = False
+            else:
+                error_msg = (f"错误：本地剩余空间不足！需要约 {required / 1024 / 1024:.2f} MB，"
+                             f"剩余 {local_free / 1024 / 1024:.2f} MB")
+                print(error_msg)
+                self.send_notification_email("WebDAV备份失败 - 预检未通过", error_msg)
+                raise BackupExit(1)
+
+        # 上传超时按与上传时相同的规则选择（分片上传时超时针对单个分片，不检查）
+        large = not self.streaming_upload and archive_size / 1024 / 1024 > LARGE_FILE_THRESHOLD
+        if USE_SEPARATE_FILE_PARAMS and not self.streaming_upload and not large:
+            max_time_name, max_time = "SMALL_FILE_MAX_TIME", SMALL_FILE_MAX_TIME
+        else:
+            max_time_name, max_time = "LARGE_FILE_MAX_TIME", LARGE_FILE_MAX_TIME
+        if upload_seconds > max_time and not (large and ENABLE_MULTIPART_UPLOAD):
+            print(f"警告：预计上传耗时 {upload_seconds:.0f} 秒，超过{max_time_name}（{max_time} 秒），上传可能超时")
+    
+    def _add_manifest_entries(self, tar=None, zipf=None, deflater=None, store_filter=None):
+        """全量归档源目录文件清单中的所有项，直接使用扫描时的stat结果（zip格式与原有方式一致，只归档文件）"""
+        import zipfile
+        
+        source_dir_parent = self.get_archive_source_parent()
+        for entry in self.get_source_manifest():
+            file_path = os.path.join(source_dir_parent, entry.arcname)
+            if tar is not None:
+                tarinfo = manifest_tarinfo(tar, entry)
+                if not tarinfo.isreg():
+                    tar.addfile(tarinfo)
+                    continue
+                try:
+                    f = open(file_path, 'rb')
+                except OSError as e:
+                    # 扫描后被删除或无权读取的文件跳过（写入条目头之后出错则无法跳过），同一文件的硬链接不能指向它
+                    print(f"警告：无法添加文件 {file_path} 到备份，错误: {str(e)}")
+                    tar.inodes.pop((entry.stat.st_ino, entry.stat.st_dev), None)
+                    continue
+                with f:
+                    if store_filter is not None:
+                        store_filter.prepare_tar_member(file_path, tarinfo.size)
+                    reader = _SizedReader(f, tarinfo.size)
+                    tar.addfile(tarinfo, reader)
+                    if reader.changed or (self.snapshot_root is None
+                                          and os.fstat(f.fileno()).st_mtime_ns != entry.mtime_ns):
+                        print(f"警告：文件 {file_path} 在归档期间发生变化，备份中的内容可能不完整")
+                continue
+            
+            if entry.kind != "f":
+                continue
+            try:
+                # 条目头中的文件名需要能以UTF-8编码，无法编码的字符替换掉
+                arcname = entry.arcname
+                try:
+                    arcname.encode('utf-8')
+                except UnicodeEncodeError:
+                    arcname = arcname.encode('utf-8', 'replace').decode('utf-8')
+                zinfo = manifest_zipinfo(entry, arcname)
+                store = store_filter is not None and store_filter.is_incompressible(file_path, entry.size)
+                if deflater:
+                    deflater.add_file(file_path, arcname, store=store, zinfo=zinfo)
+                    continue
+                zinfo.compress_type = zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED
+                with open(file_path, 'rb') as src, zipf.open(zinfo, 'w') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            except Exception as inner_e:
+                print(f"警告：无法添加文件 {file_path} 到备份，错误: {str(inner_e)}")
+                # 继续处理其他文件
+                continue
+    
+    def _add_planned_entries(self, tar=None, zipf=None, deflater=None, store_filter=None):
+        """按备份计划逐项归档，归档文件的同时计算内容哈希写入新索引（store_filter判断哪些文件只存储不压缩）"""
+        import zipfile
+        
+        plan = self.backup_plan
+        source_dir_parent = self.get_archive_source_parent()
+        manifest = {entry.arcname: entry for entry in self.get_source_manifest()}
+        
+        for arcname in plan["entries"]:
+            state = plan["files"][arcname]
+            entry = manifest[arcname]
+            file_path = os.path.join(source_dir_parent, arcname)
+            try:
+                if state[0] != "f":
+                    # 目录和符号链接不需要计算内容哈希
+                    if tar is not None:
+                        tar.addfile(manifest_tarinfo(tar, entry))
+                    elif state[0] == "d":
+                        zipf.writestr(manifest_zipinfo(entry), b"")
+                    continue
+                
+                if tar is not None:
+                    tarinfo = manifest_tarinfo(tar, entry)
+                    if store_filter is not None:
+                        store_filter.prepare_tar_member(file_path, tarinfo.size)
+                    with open(file_path, 'rb') as f:
+                        sized = _SizedReader(f, tarinfo.size)
+                        reader = _HashingReader(sized)
+                        tar.addfile(tarinfo, reader)
+                        if sized.changed or (self.snapshot_root is None
+                                             and os.fstat(f.fileno()).st_mtime_ns != entry.mtime_ns):
+                            # 内容可能不完整，不记入索引，下次备份时重新归档
+                            print(f"警告：文件 {file_path} 在归档期间发生变化，备份中的内容可能不完整")
+                            plan["files"].pop(arcname, None)
+                            continue
+                    content_hash = reader.hash
+                else:
+                    store = store_filter is not None and store_filter.is_incompressible(file_path, state[1])
+                    content_hash = hashlib.sha256()
+                    if deflater is not None:
+                        deflater.add_file(file_path, arcname, content_hash, store=store, zinfo=manifest_zipinfo(entry))
+                    else:
+                        zinfo = manifest_zipinfo(entry)
+                        zinfo.compress_type = zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED
+                        with open(file_path, 'rb') as src, zipf.open(zinfo, 'w') as dst:
+                            for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                                content_hash.update(chunk)
+                                dst.write(chunk)
+                state[4] = content_hash.hexdigest()
+            except Exception as e:
+                print(f"警告：无法添加文件 {file_path} 到备份，错误: {str(e)}")
+                # 未成功归档的文件不记入索引，下次备份时会重新归档
+                plan["files"].pop(arcname, None)
+    
+    def _write_backup_manifest(self, tar=None, zipf=None):
+        """在压缩包根目录写入备份清单（备份类型、基准备份、已删除文件列表）"""
+        plan = self.backup_plan
+        manifest = {
+            "kind": plan["kind"],
+            "base_backup": plan["base_backup"],
+            "full_backup": plan["full_backup"],
+            "created": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "deleted": plan["deleted"],
+        }
+        data = json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8')
+        if tar is not None:
+            tarinfo = tarfile.TarInfo(BACKUP_MANIFEST_NAME)
+            tarinfo.size = len(data)
+            tarinfo.mtime = int(time.time())
+            tar.addfile(tarinfo, io.BytesIO(data))
+        else:
+            zipf.writestr(BACKUP_MANIFEST_NAME, data)
+    
+    def benchmark_compression(self, workers=0):
+        """压缩性能测试：对比单线程与并行压缩的吞吐量（MB/s），不写入磁盘"""
+        source_bytes = sum(entry.size for entry in self.get_source_manifest(follow_file_links=True) if entry.kind == "f")
+        source_mb = source_bytes / 1024 / 1024
+        parallel_workers = resolve_worker_count(workers)
+        print(f"测试目录: {self.source_dir}（{source_mb:.2f} MB），并行线程数: {parallel_workers}")
         
-        for part in dir_parts:
+        original_format, original_workers = self.backup_format, self.compression_workers
+        results = {}
+        try:
+            for backup_format in BACKUP_FORMATS:
+                codec = TAR_CODECS.get(backup_format)
+                if codec is not None:
+                    try:
+                        codec.load()
+                    except ImportError as e:
+                        print(f"跳过 {backup_format}: {str(e)}")
+                        continue
+                for worker_count in sorted({1, parallel_workers}):
+                    self.backup_format = backup_format
+                    self.compression_workers = worker_count
+                    sink = CountingSink()
+                    start_time = time.time()
+                    self.write_archive(sink)
+                    elapsed = max(time.time() - start_time, 1e-6)
+                    results[(backup_format, worker_count)] = elapsed
+                    print(f"{backup_format:<7} 线程数 {worker_count:>3}: {source_mb / elapsed:8.2f} MB/s，"
+                          f"压缩后 {sink.bytes_written / 1024 / 1024:.2f} MB，耗时 {elapsed:.2f} 秒")
+                if parallel_workers > 1:
+                    speedup = results[(backup_format, 1)] / results[(backup_format, parallel_workers)]
+                    print(f"{backup_format:<7} 并行加速比: {speedup:.2f}x")
+        finally:
+            self.backup_format, self.compression_workers = original_format, original_workers
+        return results
+    
+    def create_webdav_directories(self, sub_dirs=()):
+        """逐级创建WebDAV目录（sub_dirs为上传目录下需要额外创建的子目录）"""
+        self.wait_webdav_directories(self.start_webdav_directories(sub_dirs), sub_dirs)
+    
+    def start_webdav_directories(self, sub_dirs=()):
+        """在后台开始创建WebDAV目录，返回Future，可与压缩同时进行"""
+        return AsyncLoopThread.get().submit(self.async_create_webdav_directories(sub_dirs))
+    
+    def wait_webdav_directories(self, future, sub_dirs=()):
+        """等待后台目录创建完成并输出过程信息；临时错误时重新创建（最多STAGE_RETRIES次），仍失败时退出"""
+        for attempt in range(STAGE_RETRIES + 1):
+            if attempt:
+                delay = self.retry_policy.delay(attempt - 1)
+                print(f"警告：创建WebDAV目录失败，{delay:.1f} 秒后重试（第 {attempt} 次）")
+                self.metrics.add_retry("mkdir")
+                time.sleep(delay)
+                future = self.start_webdav_directories(sub_dirs)
+            ok, messages = future.result()
+            for message in messages:
+                print(message)
+            if ok:
+                return
+            if ok is False:
+                break
+        raise BackupExit(1)
+    
+    def is_transient_status(self, status_code):
+        """是否为可重试的临时错误（408/500为本脚本用于表示超时和连接异常的状态码）"""
+        return status_code in (408, 500) or status_code in HTTP_RETRY_STATUSES
+    
+    async def async_create_webdav_directories(self, sub_dirs=()):
+        """创建上传目录（父目录必须先于子目录创建）及其下的各子目录（并发创建），
+        返回 (结果, 输出信息)，结果为True表示成功，False表示失败，None表示临时错误导致失败（可以重试）"""
+        dir_paths = []
+        current_path = ""
+        for part in self.webdav_upload_dir.split('/'):
             if part:
                 current_path = f"{current_path}/{part}" if current_path else part
-                webdav_url = f"{self.webdav_base_url}/{current_path}"
-                
-                print(f"检查/创建WebDAV目录: {webdav_url}")
-                
+                dir_paths.append(current_path)
+        sub_paths = [f"{current_path}/{sub_dir}" if current_path else sub_dir for sub_dir in sub_dirs]
+        
+        # 输出信息先收集起来，由等待结果的线程统一输出，避免与同时进行的压缩输出交错
+        messages = []
+        with self.metrics.measure("mkdir"):
+            existing, present_subs = 0, set()
+            if CACHE_WEBDAV_COLLECTIONS and dir_paths:
                 try:
-                    # 尝试创建目录（MKCOL是WebDAV创建目录的方法）
-                    response = self.session.request(
-                        method='MKCOL',
-                        url=webdav_url,
-                        timeout=CONNECT_TIMEOUT
-                    )
-                    
-                    # 201=创建成功，405=目录已存在（正常情况），301=重定向
-                    if response.status_code not in [201, 405, 301]:
-                        print(f"错误：无法创建WebDAV目录 {webdav_url} (HTTP状态码: {response.status_code})")
-                        print("可能的原因：权限不足、路径错误或WebDAV服务器不支持目录创建")
-                        sys.exit(1)
-                    
-                    # 如果是301重定向，我们假设目录已存在，继续执行
-                    if response.status_code == 301:
-                        print("注意：WebDAV目录可能已存在（收到301重定向），继续执行...")
+                    existing, present_subs = await self._async_existing_collections(dir_paths, sub_paths, messages)
                 except Exception as e:
-                    print(f"错误：创建WebDAV目录时发生异常！")
-                    print(f"详细错误：{str(e)}")
-                    sys.exit(1)
+                    # 服务器不支持PROPFIND等情况下逐级创建
+                    messages.append(f"警告：无法通过PROPFIND确认WebDAV目录，逐级创建: {str(e) or type(e).__name__}")
+            for dir_path in dir_paths[existing:]:
+                result = await self._async_mkcol_checked(dir_path, messages)
+                if not result:
+                    return result, messages
+            results = await asyncio.gather(
+                *[self._async_mkcol_checked(sub_path, messages) for sub_path in sub_paths if sub_path not in present_subs])
+        if all(results):
+            if CACHE_WEBDAV_COLLECTIONS:
+                self.save_collection_cache(dir_paths + sub_paths)
+            return True, messages
+        return (False if False in results else None), messages
+    
+    def get_collection_cache_path(self):
+        """获取已确认存在的WebDAV目录缓存的路径"""
+        return os.path.join(self.state_dir, f"{self.backup_prefix}_{COLLECTION_CACHE_NAME}")
+    
+    def load_collection_cache(self):
+        """读取本服务器上已确认存在的WebDAV目录（缓存按基础地址区分），不存在或已损坏时返回空集合"""
+        try:
+            with open(self.get_collection_cache_path(), 'r', encoding='utf-8') as f:
+                return set(json.load(f).get(self.webdav_base_url, []))
+        except (OSError, ValueError, AttributeError):
+            return set()
+    
+    def save_collection_cache(self, paths):
+        """记录本服务器上已确认存在的WebDAV目录（paths为空时清除本服务器的记录）"""
+        cache_path = self.get_collection_cache_path()
+        try:
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+            if sorted(cache.get(self.webdav_base_url, [])) == sorted(paths):
+                return
+            cache[self.webdav_base_url] = sorted(paths)
+            os.makedirs(self.state_dir, exist_ok=True)
+            with open(cache_path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError as e:
+            print(f"警告：保存WebDAV目录缓存失败: {str(e)}")
+    
+    async def _async_collection_exists(self, dir_path, depth=0):
+        """通过PROPFIND确认目录是否存在，存在时返回条目列表，不存在时返回None"""
+        return await self.async_client.propfind(f"{self.webdav_base_url}/{dir_path}/", depth=depth)
+    
+    async def _async_existing_collections(self, dir_paths, sub_paths, messages):
+        """确认上传路径中已存在的部分，返回 (已存在的层数, 已存在的子目录)
+        
+        缓存中记录过上传目录时只对其发送一个PROPFIND（有子目录时用Depth: 1同时确认子目录）；
+        上传目录不存在或没有缓存记录时，按路径深度二分查找已存在的最深一级（某一级存在时其上各级必然存在）
+        """
+        leaf_path = dir_paths[-1]
+        low, high = 0, len(dir_paths) + 1
+        if leaf_path in self.load_collection_cache():
+            entries = await self._async_collection_exists(leaf_path, depth=1 if sub_paths else 0)
+            if entries is not None:
+                names = {entry["name"] for entry in entries if entry["is_collection"]}
+                present_subs = {sub_path for sub_path in sub_paths if sub_path.rsplit('/', 1)[-1] in names}
+                messages.append(f"WebDAV目录已存在: {self.webdav_base_url}/{leaf_path}")
+                return len(dir_paths), present_subs
+            # 缓存已过期（目录被删除），清除记录
+            self.save_collection_cache([])
+            high = len(dir_paths)
+        
+        # 不变量：前low级已存在（0表示基础地址），前high级不存在
+        while high - low > 1:
+            mid = (low + high) // 2
+            if await self._async_collection_exists(dir_paths[mid - 1]) is not None:
+                low = mid
+            else:
+                high = mid
+        if low:
+            messages.append(f"WebDAV目录已存在: {self.webdav_base_url}/{dir_paths[low - 1]}")
+        return low, set()
+    
+    async def _async_mkcol_checked(self, current_path, messages):
+        """创建单个WebDAV目录，成功时返回True，失败时记录原因并返回False（临时错误时返回None）"""
+        webdav_url = f"{self.webdav_base_url}/{current_path}"
+        
+        messages.append(f"检查/创建WebDAV目录: {webdav_url}")
+        
+        try:
+            # 尝试创建目录（MKCOL是WebDAV创建目录的方法）
+            status_code = await self.async_client.mkcol(webdav_url)
+        except Exception as e:
+            self.metrics.record("mkdir", http_status=500)
+            messages.append(f"错误：创建WebDAV目录时发生异常！")
+            messages.append(f"详细错误：{str(e) or type(e).__name__}")
+            return None
+        
+        self.metrics.record("mkdir", http_status=status_code)
+        
+        # 201=创建成功，405=目录已存在（正常情况），301=重定向
+        if status_code not in [201, 405, 301]:
+            messages.append(f"错误：无法创建WebDAV目录 {webdav_url} (HTTP状态码: {status_code})")
+            if self.is_transient_status(status_code):
+                return None
+            messages.append("可能的原因：权限不足、路径错误或WebDAV服务器不支持目录创建")
+            return False
+        
+        # 如果是301重定向，我们假设目录已存在，继续执行
+        if status_code == 301:
+            messages.append("注意：WebDAV目录可能已存在（收到301重定向），继续执行...")
+        return True
+    
+    def webdav_propfind(self, url, depth=1):
+        """发送PROPFIND请求并解析multistatus响应，返回条目列表；目标不存在时返回None"""
+        return self.run_async(self.async_client.propfind(url, depth))
+    
+    def webdav_mkcol(self, url):
+        """创建单个WebDAV目录（已存在视为成功）"""
+        status_code = self.run_async(self.async_client.mkcol(url))
+        if status_code not in [201, 405, 301]:
+            raise IOError(f"无法创建WebDAV目录 {url} (HTTP状态码: {status_code})")
+    
+    def run_dedup_backup(self):
+        """去重存储模式：对tar流做内容定义分块，只上传新数据块，最后写入本次快照清单"""
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        snapshot_name = f"{self.backup_prefix}_{timestamp}.json.gz"
+        upload_url = f"{self.webdav_base_url}/{self.webdav_upload_dir}"
+        snapshot_url = f"{upload_url}/snapshots/{snapshot_name}"
+        
+        print("正在以去重存储模式备份（只上传远程不存在的数据块）...")
+        chunker = ContentDefinedChunker(DEDUP_MIN_CHUNK_KB * 1024, DEDUP_AVG_CHUNK_KB * 1024,
+                                        DEDUP_MAX_CHUNK_KB * 1024)
+        writer = DedupChunkWriter(self, f"{upload_url}/chunks", chunker, DEDUP_UPLOAD_WORKERS,
+                                  self.create_rate_limiter(LARGE_FILE_RATE_LIMIT))
+        try:
+            self.write_archive(writer, raw_tar=True)
+        finally:
+            writer.close()
+        
+        if ENABLE_INTEGRITY_CHECK:
+            print("正在校验新上传的数据块...")
+            writer.verify_uploaded()
+        
+        manifest = {
+            "version": 1,
+            "created": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "source_dir": self.source_dir,
+            "format": "tar",
+            "chunk_params": [DEDUP_MIN_CHUNK_KB, DEDUP_AVG_CHUNK_KB, DEDUP_MAX_CHUNK_KB],
+            "total_size": writer.total_bytes,
+            "chunks": writer.chunks,
+        }
+        data = gzip.compress(json.dumps(manifest, separators=(',', ':')).encode('utf-8'))
+        response = self.session.put(snapshot_url, data=data, timeout=(CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME))
+        if response.status_code not in [200, 201, 204]:
+            raise IOError(f"上传快照清单失败 (HTTP状态码: {response.status_code})")
+        
+        total_mb = writer.total_bytes / 1024 / 1024
+        ratio = writer.new_bytes / writer.total_bytes * 100 if writer.total_bytes else 0
+        print(f"数据总量: {total_mb:.2f} MB，共 {len(writer.chunks)} 个数据块，"
+              f"其中新数据块 {writer.new_chunks} 个（{writer.new_bytes / 1024 / 1024:.2f} MB，占 {ratio:.1f}%），"
+              f"实际上传 {writer.upload_bytes / 1024 / 1024:.2f} MB")
+        return snapshot_url
+    
+    def clean_dedup_store(self):
+        """清理去重存储：按保留策略删除旧的快照清单，再删除不再被任何快照引用的数据块"""
+        print("正在清理去重存储中的旧快照...")
+        upload_url = f"{self.webdav_base_url}/{self.webdav_upload_dir}"
+        try:
+            entries = self.webdav_propfind(f"{upload_url}/snapshots/", depth=1) or []
+            pattern = re.compile(f"^{self.backup_prefix}_\\d{{8}}_\\d{{6}}\\.json\\.gz$")
+            all_snapshots = sorted(e["name"] for e in entries if not e["is_collection"] and e["name"].endswith(".json.gz"))
+            own_snapshots = [(name, name[len(self.backup_prefix) + 1:-len(".json.gz")], None)
+                             for name in all_snapshots if pattern.match(name)]
+            expired = plan_retention(own_snapshots, self.max_remote_backups, self.retention_policy)
+            if not expired:
+                if RETENTION_DRY_RUN:
+                    print("试运行：按保留策略没有需要删除的快照")
+                return
+            if not RETENTION_DRY_RUN:
+                for name in expired:
+                    print(f"删除WebDAV上的旧快照: {name}")
+                self.run_async_all([self.async_client.delete(f"{upload_url}/snapshots/{name}") for name in expired],
+                                   limit=RETENTION_DELETE_CONCURRENCY)
+            
+            # 标记：收集所有保留快照（包括其他前缀的快照）引用的数据块
+            expired_names = set(expired)
+            kept = [name for name in all_snapshots if name not in expired_names]
+            responses = self.run_async_all([self.async_client.get(f"{upload_url}/snapshots/{name}") for name in kept])
+            referenced = set()
+            for name, response in zip(kept, responses):
+                if response.status_code != 200:
+                    raise IOError(f"读取快照清单 {name} 失败 (HTTP状态码: {response.status_code})，为安全起见跳过数据块清理")
+                referenced.update(digest for digest, size in json.loads(gzip.decompress(response.content))["chunks"])
+            
+            # 清除：删除未被引用的数据块；最近一天内写入的块可能属于正在进行的备份，暂不删除
+            grace_deadline = time.time() - 86400
+            prefix_urls = [f"{upload_url}/chunks/{entry['name']}"
+                           for entry in self.webdav_propfind(f"{upload_url}/chunks/", depth=1) or []
+                           if entry["is_collection"] and len(entry["name"]) == 2]
+            listings = self.run_async_all(
+                [self.async_client.propfind(f"{prefix_url}/", depth=1) for prefix_url in prefix_urls])
+            unreferenced = []
+            for prefix_url, entries in zip(prefix_urls, listings):
+                for entry in entries or []:
+                    if entry["is_collection"] or entry["name"] in referenced:
+                        continue
+                    if entry["mtime"]:
+                        modified = parsedate_to_datetime(entry["mtime"]).timestamp()
+                        if modified > grace_deadline:
+                            continue
+                    unreferenced.append((f"{prefix_url}/{entry['name']}", entry["size"]))
+            
+            if RETENTION_DRY_RUN:
+                reclaimed = sum(size or 0 for url, size in unreferenced)
+                for name in expired:
+                    print(f"  将删除快照: {name}")
+                print(f"试运行：将删除 {len(expired)} 个旧快照及 {len(unreferenced)} 个不再被引用的数据块，"
+                      f"可释放 {reclaimed / 1024 / 1024:.2f} MB，未实际删除")
+                return
+            self.run_async_all([self.async_client.delete(url) for url, size in unreferenced],
+                               limit=RETENTION_DELETE_CONCURRENCY)
+            print(f"已删除 {len(unreferenced)} 个不再被引用的数据块")
+        except Exception as e:
+            print(f"警告：清理去重存储时发生错误: {str(e)}")
     
     def get_file_size(self, file_path):
         """获取文件大小（字节）"""
@@ -255,8 +4710,8 @@ class WebDAVBackup:
         """获取文件大小（MB）"""
         return self.get_file_size(file_path) / 1024 / 1024
     
-    def upload_to_webdav(self, local_backup_path, backup_filename):
-        """上传到WebDAV服务器"""
+    def upload_to_webdav(self, local_backup_path, backup_filename, hasher=None):
+        """上传到WebDAV服务器，返回 (状态码, 远程地址, 哈希)；未传入创建时计算的哈希时在上传过程中同步计算"""
         print("正在上传到WebDAV服务器...")
         
         # 构建完整的WebDAV URL
@@ -286,60 +4741,374 @@ class WebDAVBackup:
             max_time = LARGE_FILE_MAX_TIME
             limit_rate = LARGE_FILE_RATE_LIMIT
         
-        # 准备请求头和参数
-        headers = {}
+        # 准备请求头和参数
+        headers = {}
+        
+        # 处理速度限制（令牌桶限速，按读取的数据块扣除令牌）
+        limiter = self.create_rate_limiter(limit_rate)
+        if limiter is not None:
+            print(f"上传速度限制: {limiter.describe()}")
+        
+        # 设置请求超时
+        request_timeout = (timeout, max_time if max_time else 3600)  # (connect timeout, read timeout)
+        
+        # 大文件分片并发上传，支持断点续传
+        if ENABLE_MULTIPART_UPLOAD and file_size_mb > LARGE_FILE_THRESHOLD:
+            status_code, webdav_full_url = self.upload_multipart(local_backup_path, webdav_full_url, request_timeout, limiter)
+            return status_code, webdav_full_url, hasher
+        
+        # 创建压缩包时已计算过哈希则上传时不再重复计算
+        upload_hasher = ArchiveHasher() if hasher is None else ArchiveHasher((), with_tree=False)
+        reader = HashingFileReader(local_backup_path, upload_hasher, limiter)
+        try:
+            try:
+                response = self.session.put(
+                    url=webdav_full_url,
+                    data=reader,
+                    headers=headers,
+                    timeout=request_timeout
+                )
+            finally:
+                reader.close()
+            
+            # 提取状态码
+            status_code = response.status_code
+            
+            # 处理可能的HTML响应
+            if not str(status_code).isdigit():
+                # 尝试从响应中提取数字状态码
+                match = re.search(r'^HTTP/\d+\.\d+\s+(\d{3})', response.text)
+                if match:
+                    status_code = int(match.group(1))
+                else:
+                    status_code = 400
+            
+            # 只有完整读取过文件，上传过程中计算的哈希才可用于完整性检测
+            if hasher is None and upload_hasher.size == file_size:
+                hasher = upload_hasher.finish()
+            return status_code, webdav_full_url, hasher
+            
+        except requests.exceptions.Timeout:
+            print("错误：上传超时！")
+            return 408, webdav_full_url, hasher  # 408 Request Timeout
+        except requests.exceptions.RequestException as e:
+            print(f"错误：上传过程中发生异常！")
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            return 500, webdav_full_url, hasher  # 500 Internal Server Error
+    
+    def select_rate_limit(self, file_size_mb):
+        """根据文件大小选择速度限制参数（与上传参数的选择规则一致）"""
+        if USE_SEPARATE_FILE_PARAMS and file_size_mb <= LARGE_FILE_THRESHOLD:
+            return SMALL_FILE_RATE_LIMIT
+        return LARGE_FILE_RATE_LIMIT
+    
+    def create_rate_limiter(self, limit_rate):
+        """创建令牌桶限速器，未设置速度限制和限速时间表时返回None"""
+        if not limit_rate and not RATE_LIMIT_SCHEDULE:
+            return None
+        return RateLimiter(limit_rate, RATE_LIMIT_SCHEDULE)
+    
+    def resolve_multipart_assembly(self, webdav_full_url):
+        """确定分片合并方式，返回 (方式, Nextcloud分片上传目录地址)"""
+        assembly = MULTIPART_ASSEMBLY
+        match = re.match(r'^(.*)/remote\.php/dav/files/([^/]+)/', webdav_full_url)
+        if assembly == "auto":
+            assembly = "nextcloud" if match else "manifest"
+        if assembly not in ("nextcloud", "content-range", "manifest"):
+            raise ValueError(f"不支持的分片合并方式: {assembly}，请使用 'auto'、'nextcloud'、'content-range' 或 'manifest'")
+        if assembly == "nextcloud":
+            if not match:
+                raise ValueError("nextcloud分片合并方式要求WebDAV地址形如 https://域名/remote.php/dav/files/用户名/")
+            return assembly, f"{match.group(1)}/remote.php/dav/uploads/{match.group(2)}"
+        return assembly, None
+    
+    def get_upload_journal_path(self, backup_filename):
+        """获取分片上传日志文件路径"""
+        return os.path.join(self.state_dir, UPLOAD_JOURNAL_DIR_NAME, f"{backup_filename}.json")
+    
+    def load_upload_journal(self, journal_path):
+        """读取分片上传日志，不存在或已损坏时返回None"""
+        if not os.path.exists(journal_path):
+            return None
+        try:
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"警告：读取分片上传日志 {journal_path} 失败，将重新上传全部分片: {str(e)}")
+            return None
+    
+    def save_upload_journal(self, journal_path, journal):
+        """写入分片上传日志（先写临时文件再替换，避免中断时损坏日志）"""
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        tmp_path = journal_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(journal, f, ensure_ascii=False)
+        os.replace(tmp_path, journal_path)
+    
+    def _remote_part_sizes(self, parts_url):
+        """列出远程分片目录中已存在的分片及其大小，目录不存在时返回None"""
+        entries = self.webdav_propfind(f"{parts_url}/", depth=1)
+        if entries is None:
+            return None
+        return {e["name"]: e["size"] for e in entries if not e["is_collection"]}
+    
+    def _upload_part(self, url, local_backup_path, offset, length, headers, request_timeout, limiter=None):
+        """上传单个分片，失败时按指数退避重试，返回最终的HTTP状态码"""
+        status_code = 500
+        for attempt in range(MULTIPART_MAX_RETRIES + 1):
+            if attempt:
+                self.metrics.add_retry("upload")
+                time.sleep(self.retry_policy.delay(attempt - 1))
+            reader = FileRangeReader(local_backup_path, offset, length, limiter)
+            try:
+                response = self.session.put(url, data=reader, headers=headers, timeout=request_timeout)
+                status_code = response.status_code
+                if status_code in [200, 201, 204]:
+                    return status_code
+                print(f"警告：分片上传失败 (HTTP状态码: {status_code})，第 {attempt + 1} 次尝试")
+            except requests.exceptions.RequestException as e:
+                status_code = 408 if isinstance(e, requests.exceptions.Timeout) else 500
+                print(f"警告：分片上传异常，第 {attempt + 1} 次尝试: {str(e)}")
+            finally:
+                reader.close()
+        return status_code
+    
+    def upload_multipart(self, local_backup_path, webdav_full_url, request_timeout, limiter=None):
+        """将文件切分为固定大小的分片并发上传（所有分片共享同一个限速器），已完成的分片记录在本地日志中，重新运行时只上传缺失的分片"""
+        backup_filename = os.path.basename(local_backup_path)
+        file_stat = os.stat(local_backup_path)
+        file_size = file_stat.st_size
+        
+        try:
+            assembly, uploads_url = self.resolve_multipart_assembly(webdav_full_url)
+            part_size = MULTIPART_PART_SIZE_MB * 1024 * 1024
+            if assembly == "nextcloud":
+                part_size = max(part_size, NEXTCLOUD_MIN_PART_SIZE)
+            part_count = max(1, -(-file_size // part_size))
+            
+            # 日志与当前文件和配置一致时沿用其中的上传ID和已完成分片
+            journal_path = self.get_upload_journal_path(backup_filename)
+            journal = self.load_upload_journal(journal_path)
+            if journal is None or [journal.get("url"), journal.get("size"), journal.get("mtime_ns"),
+                                   journal.get("part_size"), journal.get("assembly")] != \
+                    [webdav_full_url, file_size, file_stat.st_mtime_ns, part_size, assembly]:
+                journal = {
+                    "url": webdav_full_url,
+                    "local_path": os.path.abspath(local_backup_path),
+                    "size": file_size,
+                    "mtime_ns": file_stat.st_mtime_ns,
+                    "part_size": part_size,
+                    "assembly": assembly,
+                    "upload_id": f"webdav-backup-{uuid.uuid4().hex}",
+                    "done": [],
+                }
+            done = set(journal["done"])
+            
+            def part_range(index):
+                offset = index * part_size
+                return offset, min(part_size, file_size - offset)
+            
+            # 以服务器上实际存在的分片为准，日志记录过但远程已丢失（如上传目录过期）的分片重新上传
+            headers = {}
+            if assembly == "nextcloud":
+                parts_url = f"{uploads_url}/{journal['upload_id']}"
+                headers = {'Destination': webdav_full_url, 'OC-Total-Length': str(file_size)}
+                remote_parts = self._remote_part_sizes(parts_url)
+                if remote_parts is None:
+                    response = self.session.request('MKCOL', parts_url, headers=headers, timeout=CONNECT_TIMEOUT)
+                    if response.status_code not in [201, 405]:
+                        raise IOError(f"无法创建Nextcloud分片上传目录 {parts_url} (HTTP状态码: {response.status_code})")
+                    remote_parts = {}
+            elif assembly == "manifest":
+                parts_url = f"{webdav_full_url}.parts"
+                remote_parts = self._remote_part_sizes(parts_url)
+                if remote_parts is None:
+                    self.webdav_mkcol(parts_url)
+                    remote_parts = {}
+            else:
+                parts_url = None
+                remote_parts = None
+                if done and self.webdav_propfind(webdav_full_url, depth=0) is None:
+                    done = set()
+            if remote_parts is not None:
+                done = {i for i in done if remote_parts.get(f"{i + 1:05d}") == part_range(i)[1]}
+            
+            pending = [i for i in range(part_count) if i not in done]
+            journal["done"] = sorted(done)
+            self.save_upload_journal(journal_path, journal)
+            print(f"分片上传（合并方式: {assembly}）：共 {part_count} 个分片，每片 {part_size / 1024 / 1024:.0f} MB，"
+                  f"已完成 {len(done)} 个，待上传 {len(pending)} 个")
+            
+            journal_lock = threading.Lock()
+            
+            def upload_part(index):
+                offset, length = part_range(index)
+                if parts_url:
+                    url = f"{parts_url}/{index + 1:05d}"
+                    part_headers = headers
+                else:
+                    url = webdav_full_url
+                    part_headers = {'Content-Range': f"bytes {offset}-{offset + length - 1}/{file_size}"}
+                status_code = self._upload_part(url, local_backup_path, offset, length, part_headers,
+                                                request_timeout, limiter)
+                if status_code in [200, 201, 204]:
+                    with journal_lock:
+                        done.add(index)
+                        journal["done"] = sorted(done)
+                        self.save_upload_journal(journal_path, journal)
+                        print(f"分片 {index + 1}/{part_count} 上传完成（已完成 {len(done)}/{part_count}）")
+                return status_code
+            
+            # content-range方式先单独上传一个分片在服务器上创建文件，其余分片再并发写入
+            if assembly == "content-range" and pending and not done:
+                status_code = upload_part(pending.pop(0))
+                if status_code not in [200, 201, 204]:
+                    return status_code, webdav_full_url
+            
+            failed_status = None
+            with ThreadPoolExecutor(max_workers=max(1, MULTIPART_CONCURRENCY)) as pool:
+                for status_code in pool.map(upload_part, pending):
+                    if status_code not in [200, 201, 204]:
+                        failed_status = status_code
+            if failed_status is not None:
+                print(f"错误：有 {part_count - len(done)} 个分片上传失败，重新运行脚本将只上传缺失的分片")
+                return failed_status, webdav_full_url
+            
+            # 合并分片
+            if assembly == "nextcloud":
+                print("所有分片上传完成，正在由服务器合并分片...")
+                response = self.session.request('MOVE', f"{parts_url}/.file", headers=headers,
+                                                 timeout=(CONNECT_TIMEOUT, request_timeout[1]))
+                if response.status_code not in [200, 201, 204]:
+                    print(f"错误：服务器合并分片失败 (HTTP状态码: {response.status_code})")
+                    return response.status_code, webdav_full_url
+                status_code = response.status_code
+            elif assembly == "manifest":
+                manifest = {
+                    "version": 1,
+                    "filename": backup_filename,
+                    "size": file_size,
+                    "part_size": part_size,
+                    "parts": [[f"{i + 1:05d}", part_range(i)[1]] for i in range(part_count)],
+                }
+                response = self.session.put(f"{parts_url}/manifest.json",
+                                            data=json.dumps(manifest, ensure_ascii=False).encode('utf-8'),
+                                            timeout=(CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME))
+                if response.status_code not in [200, 201, 204]:
+                    print(f"错误：上传分片清单失败 (HTTP状态码: {response.status_code})")
+                    return response.status_code, webdav_full_url
+                status_code = response.status_code
+                self.manifest_uploads.add(webdav_full_url)
+                print(f"服务器不合并分片，备份以分片形式保存在: {parts_url}/ (按清单顺序拼接即为完整备份文件)")
+            else:
+                status_code = 204
+            
+            os.remove(journal_path)
+            return status_code, webdav_full_url
+        
+        except requests.exceptions.RequestException as e:
+            print(f"错误：分片上传过程中发生异常！")
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            return 500, webdav_full_url
+        except (IOError, ValueError) as e:
+            print(f"错误：{str(e)}")
+            return 500, webdav_full_url
+    
+    def resume_pending_uploads(self):
+        """继续上传之前中断的分片上传任务（只上传缺失的分片）"""
+        journal_dir = os.path.join(self.state_dir, UPLOAD_JOURNAL_DIR_NAME)
+        if not os.path.isdir(journal_dir):
+            return
+        upload_url = f"{self.webdav_base_url}/{self.webdav_upload_dir}/"
+        for name in sorted(os.listdir(journal_dir)):
+            if not name.endswith(".json"):
+                continue
+            journal_path = os.path.join(journal_dir, name)
+            journal = self.load_upload_journal(journal_path)
+            local_path = journal and journal.get("local_path")
+            if not local_path or not os.path.exists(local_path) or not journal.get("url", "").startswith(upload_url):
+                # 本地文件已被清理或上传目标已变更，日志失效
+                os.remove(journal_path)
+                pending_path = self.get_pending_plan_path(name[:-len(".json")])
+                if os.path.exists(pending_path):
+                    os.remove(pending_path)
+                continue
+            print(f"发现未完成的分片上传任务，继续上传: {os.path.basename(local_path)}")
+            request_timeout = (CONNECT_TIMEOUT, LARGE_FILE_MAX_TIME)
+            limiter = self.create_rate_limiter(LARGE_FILE_RATE_LIMIT)
+            status_code, webdav_full_url = self.upload_multipart(local_path, journal["url"], request_timeout, limiter)
+            if status_code in [200, 201, 204] and self.check_integrity(local_path, webdav_full_url):
+                print(f"之前中断的备份已上传完成: {webdav_full_url}")
+                self.finish_uploaded_backup(name[:-len(".json")], resumed=True)
+            else:
+                print(f"警告：继续上传 {os.path.basename(local_path)} 失败 (HTTP状态码: {status_code})，将在下次运行时重试")
+    
+    def stream_backup_to_webdav(self, local_backup_path, backup_filename):
+        """边压缩边上传：压缩线程写入有界缓冲区，同时以分块传输编码上传"""
+        print("正在以流式模式创建备份并上传到WebDAV服务器...")
+        
+        webdav_full_url = f"{self.webdav_base_url}/{self.webdav_upload_dir}/{backup_filename}"
         
-        # 处理速度限制（Python requests库不直接支持限速，这里可以考虑使用第三方库如requests-toolbelt的StreamingIterator）
-        if limit_rate:
-            print(f"注意：Python版本暂不支持上传速度限制，参数 {limit_rate} 被忽略")
+        tee_path = local_backup_path if self.streaming_keep_local_copy else None
+        if tee_path:
+            print(f"同时保存本地备份文件: {local_backup_path}")
+        pipe = StreamingPipe(STREAMING_BUFFER_SIZE_MB * 1024 * 1024, tee_path)
         
-        # 设置请求超时
-        request_timeout = (timeout, max_time if max_time else 3600)  # (connect timeout, read timeout)
+        def produce():
+            try:
+                encryptor = self.encrypt_output(pipe)
+                self.write_archive(encryptor or pipe)
+                if encryptor is not None:
+                    encryptor.close()
+                pipe.close()
+            except BaseException as e:
+                pipe.fail(e)
+        
+        producer = threading.Thread(target=produce, name="backup-archiver", daemon=True)
+        producer.start()
+        
+        # 压缩包大小未知，统一使用大文件的超时和速度限制参数
+        request_timeout = (CONNECT_TIMEOUT, LARGE_FILE_MAX_TIME)
+        limiter = self.create_rate_limiter(LARGE_FILE_RATE_LIMIT)
+        if limiter is not None:
+            print(f"上传速度限制: {limiter.describe()}")
         
         try:
-            # 断点续传上传
-            resume_header = {'Range': 'bytes=0-'}
-            
-            with open(local_backup_path, 'rb') as f:
-                response = self.session.put(
-                    url=webdav_full_url,
-                    data=f,
-                    headers=resume_header,
-                    timeout=request_timeout
-                )
-            
-            # 提取状态码
+            response = self.session.put(
+                url=webdav_full_url,
+                data=rate_limited_iter(pipe, limiter),
+                timeout=request_timeout
+            )
             status_code = response.status_code
-            
-            # 处理可能的HTML响应
-            if not str(status_code).isdigit():
-                # 尝试从响应中提取数字状态码
-                match = re.search(r'^HTTP/\d+\.\d+\s+(\d{3})', response.text)
-                if match:
-                    status_code = int(match.group(1))
-                else:
-                    status_code = 400
-            
-            return status_code, webdav_full_url
-            
         except requests.exceptions.Timeout:
             print("错误：上传超时！")
-            return 408, webdav_full_url  # 408 Request Timeout
-        except requests.exceptions.RequestException as e:
+            status_code = 408
+        except Exception as e:
             print(f"错误：上传过程中发生异常！")
-            print(f"详细错误：{str(e)}")
-            return 500, webdav_full_url  # 500 Internal Server Error
-    
-    def calculate_file_md5(self, file_path):
-        """计算文件的MD5校验和"""
-        hash_md5 = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            status_code = 500
+        finally:
+            # 上传结束（无论成功与否）后断开消费端，确保压缩线程不会阻塞
+            pipe.detach_consumer()
+            producer.join()
+        
+        if pipe.error is not None:
+            print(f"错误：创建备份文件失败！")
+            print(f"详细错误：{str(pipe.error) or type(pipe.error).__name__}")
+            if tee_path and os.path.exists(tee_path):
+                os.remove(tee_path)
+            if status_code in [200, 201, 204]:
+                # 服务器已接受不完整的数据，删除远程文件
+                self.delete_remote_file(webdav_full_url)
+            raise BackupExit(1)
+        
+        print(f"备份数据大小: {pipe.bytes_written / 1024 / 1024:.2f} MB")
+        if tee_path:
+            self.save_archive_index(tee_path)
+        return status_code, webdav_full_url, pipe.hasher
     
-    def check_integrity(self, local_backup_path, webdav_full_url):
-        """执行文件完整性检测"""
+    def check_integrity(self, local_backup_path, webdav_full_url, hasher=None):
+        """执行文件完整性检测（传入创建或上传过程中同步计算的哈希时无需再读取本地文件）"""
         if not ENABLE_INTEGRITY_CHECK:
             return True
         
@@ -347,18 +5116,18 @@ class WebDAVBackup:
         
         try:
             # 获取本地文件大小
-            local_size = self.get_file_size(local_backup_path)
-            local_size_mb = local_size / 1024 / 1024
+            if hasher is not None:
+                local_size = hasher.size
+            else:
+                local_size = self.get_file_size(local_backup_path)
             
-            # 设置检测超时
-            check_timeout = (CONNECT_TIMEOUT, INTEGRITY_CHECK_TIMEOUT)
+            if webdav_full_url in self.manifest_uploads:
+                return self.check_parts_integrity(local_backup_path, webdav_full_url, local_size)
             
-            # 获取远程文件大小
+            # 获取远程文件大小；需要服务器校验和时同时发送PROPFIND，两个请求并发执行
             print("验证文件大小...")
-            head_response = self.session.head(
-                url=webdav_full_url,
-                timeout=check_timeout
-            )
+            want_checksums = ENABLE_MD5_VERIFICATION and INTEGRITY_VERIFICATION_MODE in ("auto", "checksum")
+            head_response, entries = self.run_async(self._async_head_with_props(webdav_full_url, want_checksums))
             
             if 'Content-Length' in head_response.headers:
                 remote_size = int(head_response.headers['Content-Length'])
@@ -373,97 +5142,750 @@ class WebDAVBackup:
                 self.send_notification_email("WebDAV备份失败 - 文件大小验证失败", error_msg)
                 return False
             
-            # 根据配置和文件大小决定是否执行MD5验证
-            if ENABLE_MD5_VERIFICATION and (MD5_VERIFICATION_EXCLUDE_THRESHOLD <= 0 or local_size_mb <= MD5_VERIFICATION_EXCLUDE_THRESHOLD):
-                # 计算本地文件MD5
-                local_md5 = self.calculate_file_md5(local_backup_path)
-                
-                # 验证MD5校验和
-                print("验证文件MD5校验和...")
-                get_response = self.session.get(
-                    url=webdav_full_url,
-                    timeout=check_timeout,
-                    stream=True  # 流式下载，避免大文件占用过多内存
-                )
-                
-                # 计算远程文件的MD5
-                remote_hash_md5 = hashlib.md5()
-                for chunk in get_response.iter_content(chunk_size=4096):
-                    if chunk:
-                        remote_hash_md5.update(chunk)
-                remote_md5 = remote_hash_md5.hexdigest()
-                
-                if local_md5 != remote_md5:
-                    error_msg = f"错误：MD5校验和不匹配！本地:{local_md5} 远程:{remote_md5}"
+            # 根据配置决定是否校验文件内容（下载与上传使用相同的速度限制）
+            if ENABLE_MD5_VERIFICATION:
+                limiter = self.create_rate_limiter(self.select_rate_limit(local_size / 1024 / 1024))
+                verified, error_msg = self.verify_remote_content(
+                    local_backup_path, webdav_full_url, local_size, hasher, head_response, limiter, entries)
+                if verified is False:
                     print(error_msg)
                     self.delete_remote_file(webdav_full_url)
-                    self.send_notification_email("WebDAV备份失败 - MD5校验失败", error_msg)
+                    self.send_notification_email("WebDAV备份失败 - 校验和验证失败", error_msg)
                     return False
             else:
-                if not ENABLE_MD5_VERIFICATION:
-                    print("跳过MD5校验和验证（已禁用）")
-                else:
-                    print(f"跳过MD5校验和验证（文件大小 {local_size_mb:.2f} MB 超过阈值 {MD5_VERIFICATION_EXCLUDE_THRESHOLD} MB）")
+                print("跳过MD5校验和验证（已禁用）")
             
             print("文件完整性检测通过！")
             return True
             
         except Exception as e:
             print(f"错误：完整性检测过程中发生异常！")
-            print(f"详细错误：{str(e)}")
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            return False
+    
+    async def _async_head_with_props(self, webdav_full_url, with_props):
+        """并发发送HEAD和PROPFIND（Depth: 0），返回 (HEAD响应, PROPFIND条目列表)"""
+        async def propfind():
+            if not with_props:
+                return None
+            try:
+                return await self.async_client.propfind(webdav_full_url, depth=0) or []
+            except Exception as e:
+                print(f"警告：通过PROPFIND获取校验和失败: {str(e)}")
+                return []
+        return await asyncio.gather(self.async_client.head(webdav_full_url), propfind())
+    
+    def get_remote_checksums(self, webdav_full_url, head_response, entries=None):
+        """获取服务器提供的校验和：优先使用OC-Checksum响应头，其次使用PROPFIND返回的校验和属性"""
+        checksums = parse_checksum_header(head_response.headers.get('OC-Checksum'))
+        if not checksums:
+            if entries is None:
+                try:
+                    entries = self.webdav_propfind(webdav_full_url, depth=0) or []
+                except Exception as e:
+                    print(f"警告：通过PROPFIND获取校验和失败: {str(e)}")
+                    entries = []
+            for entry in entries:
+                checksums.update(entry["checksums"])
+        return checksums
+    
+    def verify_remote_content(self, local_backup_path, webdav_full_url, local_size, hasher, head_response, limiter=None,
+                              entries=None):
+        """校验远程文件内容，返回 (结果, 错误信息)，结果为None表示未能校验"""
+        mode = INTEGRITY_VERIFICATION_MODE
+        if mode not in ("auto", "checksum", "sample", "download"):
+            raise ValueError(f"不支持的内容校验方式: {mode}，请使用 'auto'、'checksum'、'sample' 或 'download'")
+        has_local_file = local_backup_path is not None and os.path.exists(local_backup_path)
+        local_size_mb = local_size / 1024 / 1024
+        within_threshold = MD5_VERIFICATION_EXCLUDE_THRESHOLD <= 0 or local_size_mb <= MD5_VERIFICATION_EXCLUDE_THRESHOLD
+        
+        def local_digest(algo):
+            # 优先使用创建/上传时同步计算的哈希，缺少所需算法时才读取一遍本地文件
+            nonlocal hasher
+            if hasher is not None and algo in hasher.hashes:
+                return hasher.hexdigest(algo)
+            if not has_local_file:
+                return None
+            hasher = ArchiveHasher.from_file(local_backup_path, set(INTEGRITY_HASH_ALGORITHMS) | {algo})
+            return hasher.hexdigest(algo)
+        
+        if mode in ("auto", "checksum"):
+            # 服务器提供的校验和：不一致即判定失败，无需下载任何数据
+            checksums = self.get_remote_checksums(webdav_full_url, head_response, entries)
+            for algo in sorted(checksums, key=lambda name: not (hasher is not None and name in hasher.hashes)):
+                remote_digest = checksums[algo]
+                local_value = local_digest(algo)
+                if local_value is None:
+                    continue
+                print(f"验证服务器提供的{algo.upper()}校验和...")
+                if local_value != remote_digest:
+                    return False, f"错误：{algo.upper()}校验和不匹配！本地:{local_value} 远程:{remote_digest}"
+                return True, None
+            
+            # 部分服务器的ETag即为文件MD5；ETag也可能是其他格式，因此只把一致视为校验通过
+            etag = head_response.headers.get('ETag', '')
+            etag_value = etag.strip('"').lower()
+            if not etag.startswith('W/') and re.match(r'^[0-9a-f]{32}$', etag_value):
+                if etag_value == local_digest("md5"):
+                    print("服务器ETag与本地MD5一致，校验通过")
+                    return True, None
+            
+            if mode == "checksum":
+                print("警告：服务器未提供可用的校验和，跳过内容校验")
+                return None, None
+        
+        if mode == "download" or (mode == "auto" and within_threshold):
+            if not within_threshold:
+                print(f"跳过MD5校验和验证（文件大小 {local_size_mb:.2f} MB 超过阈值 {MD5_VERIFICATION_EXCLUDE_THRESHOLD} MB）")
+                return None, None
+            
+            # 获取本地文件MD5
+            local_md5 = local_digest("md5")
+            if local_md5 is None:
+                print("警告：未计算本地MD5且未保留本地文件，跳过MD5校验和验证")
+                return None, None
+            
+            # 验证MD5校验和
+            print("验证文件MD5校验和...")
+            # 计算远程文件的MD5（流式下载，逐块计算，避免大文件占用过多内存）
+            remote_hash_md5 = hashlib.md5()
+            
+            async def on_chunk(chunk):
+                remote_hash_md5.update(chunk)
+                if limiter is not None:
+                    await limiter.consume_async(len(chunk))
+            
+            self.run_async(self.async_client.get(webdav_full_url, on_chunk=on_chunk))
+            remote_md5 = remote_hash_md5.hexdigest()
+            
+            if local_md5 != remote_md5:
+                return False, f"错误：MD5校验和不匹配！本地:{local_md5} 远程:{remote_md5}"
+            return True, None
+        
+        # 抽样校验：随机下载若干块，与创建压缩包时计算的哈希树比对
+        if hasher is None or hasher.tree is None:
+            if not has_local_file:
+                print("警告：缺少本地哈希树且未保留本地文件，跳过抽样校验")
+                return None, None
+            hasher = ArchiveHasher.from_file(local_backup_path)
+        return self.verify_sampled_blocks(webdav_full_url, hasher.tree, limiter)
+    
+    def verify_sampled_blocks(self, webdav_full_url, hash_tree, limiter=None):
+        """通过范围请求抽样下载若干块并与哈希树比对，返回 (结果, 错误信息)"""
+        block_count = len(hash_tree.leaves)
+        indexes = {0, block_count - 1} if block_count else set()
+        others = range(1, max(1, block_count - 1))
+        indexes.update(random.sample(others, min(len(others), max(0, INTEGRITY_SAMPLE_BLOCKS - 2))))
+        print(f"抽样校验 {len(indexes)}/{block_count} 个数据块（哈希树根: {hash_tree.root()[:16]}...）")
+        
+        results = self.run_async_all(
+            [self._async_verify_block(webdav_full_url, hash_tree, index, limiter) for index in sorted(indexes)],
+            return_exceptions=True)
+        for index, result in zip(sorted(indexes), results):
+            if isinstance(result, BlockDownloadError):
+                return False, f"错误：{str(result)}"
+            if isinstance(result, BaseException):
+                raise result
+            if result is None:
+                # 服务器忽略了范围请求，放弃抽样，避免下载整个文件
+                print("警告：服务器不支持范围请求，跳过抽样校验")
+                return None, None
+            if result is False:
+                start = index * hash_tree.block_size
+                end = min(start + hash_tree.block_size, hash_tree.size) - 1
+                return False, f"错误：第 {index + 1} 块（字节 {start}-{end}）的SHA-256校验和不匹配！"
+        return True, None
+    
+    async def _async_verify_block(self, webdav_full_url, hash_tree, index, limiter=None):
+        """下载并校验单个块，返回是否一致；服务器不支持范围请求（返回200及整个文件）时返回None，
+        其他状态码（如404、403、500）抛出BlockDownloadError"""
+        start = index * hash_tree.block_size
+        end = min(start + hash_tree.block_size, hash_tree.size) - 1
+        block_hash = hashlib.sha256()
+        received = 0
+        
+        async def on_chunk(chunk):
+            nonlocal received
+            received += len(chunk)
+            if received > end - start + 1:
+                # 服务器返回了整个文件，立即中断下载
+                raise ValueError("范围请求被忽略")
+            block_hash.update(chunk)
+            if limiter is not None:
+                await limiter.consume_async(len(chunk))
+        
+        try:
+            response = await self.async_client.get(
+                webdav_full_url, headers={'Range': f"bytes={start}-{end}"}, on_chunk=on_chunk)
+        except ValueError:
+            return None
+        if response.status_code == 200 and start > 0:
+            # 忽略范围请求时返回整个文件，数据却不超过本块的长度：远程文件比本地短
+            return False
+        if response.status_code not in (200, 206):
+            raise BlockDownloadError(f"下载第 {index + 1} 块（字节 {start}-{end}）失败 (HTTP状态码: {response.status_code})")
+        # 206，或整个文件只有一块时返回的200
+        return block_hash.hexdigest() == hash_tree.leaves[index]
+    
+    def check_parts_integrity(self, local_backup_path, webdav_full_url, local_size):
+        """校验以manifest方式保存的分片：逐个比对分片大小，并按配置比对每个分片的MD5"""
+        parts_url = f"{webdav_full_url}.parts"
+        response = self.session.get(f"{parts_url}/manifest.json", timeout=(CONNECT_TIMEOUT, INTEGRITY_CHECK_TIMEOUT))
+        if response.status_code != 200:
+            print(f"错误：无法读取分片清单 (HTTP状态码: {response.status_code})")
+            return False
+        manifest = response.json()
+        remote_parts = self._remote_part_sizes(parts_url) or {}
+        
+        print("验证分片大小...")
+        total = sum(size for name, size in manifest["parts"])
+        mismatched = [name for name, size in manifest["parts"] if remote_parts.get(name) != size]
+        if total != local_size or mismatched:
+            error_msg = f"错误：分片大小不匹配！本地:{local_size} 清单:{total} 异常分片:{', '.join(mismatched) or '无'}"
+            print(error_msg)
+            self.delete_remote_file(webdav_full_url)
+            self.send_notification_email("WebDAV备份失败 - 文件大小验证失败", error_msg)
             return False
+        
+        local_size_mb = local_size / 1024 / 1024
+        if ENABLE_MD5_VERIFICATION and (MD5_VERIFICATION_EXCLUDE_THRESHOLD <= 0 or local_size_mb <= MD5_VERIFICATION_EXCLUDE_THRESHOLD):
+            print("验证分片MD5校验和...")
+            limiter = self.create_rate_limiter(self.select_rate_limit(local_size_mb))
+            offset = 0
+            for name, size in manifest["parts"]:
+                local_hash_md5 = hashlib.md5()
+                reader = FileRangeReader(local_backup_path, offset, size)
+                try:
+                    for chunk in iter(reader.read, b""):
+                        local_hash_md5.update(chunk)
+                finally:
+                    reader.close()
+                remote_hash_md5 = hashlib.md5()
+                get_response = self.session.get(f"{parts_url}/{name}", timeout=(CONNECT_TIMEOUT, INTEGRITY_CHECK_TIMEOUT), stream=True)
+                for chunk in rate_limited_iter(get_response.iter_content(chunk_size=1024 * 1024), limiter):
+                    remote_hash_md5.update(chunk)
+                if local_hash_md5.hexdigest() != remote_hash_md5.hexdigest():
+                    error_msg = f"错误：分片 {name} 的MD5校验和不匹配！本地:{local_hash_md5.hexdigest()} 远程:{remote_hash_md5.hexdigest()}"
+                    print(error_msg)
+                    self.delete_remote_file(webdav_full_url)
+                    self.send_notification_email("WebDAV备份失败 - MD5校验失败", error_msg)
+                    return False
+                offset += size
+        else:
+            if not ENABLE_MD5_VERIFICATION:
+                print("跳过MD5校验和验证（已禁用）")
+            else:
+                print(f"跳过MD5校验和验证（文件大小 {local_size_mb:.2f} MB 超过阈值 {MD5_VERIFICATION_EXCLUDE_THRESHOLD} MB）")
+        
+        print("文件完整性检测通过！")
+        return True
     
     def delete_remote_file(self, webdav_file_url):
         """删除远程文件"""
         print("删除损坏的远程备份...")
         try:
-            self.session.delete(webdav_file_url, timeout=CONNECT_TIMEOUT)
+            if webdav_file_url in self.manifest_uploads:
+                # 以manifest方式上传的备份只存在分片目录
+                self.run_async(self.async_client.delete(f"{webdav_file_url}.parts/"))
+                self.manifest_uploads.discard(webdav_file_url)
+                return
+            self.run_async(self.async_client.delete(webdav_file_url))
         except Exception as e:
             print(f"警告：删除远程文件时发生错误: {str(e)}")
     
-    def clean_remote_backups(self, backup_filename):
-        """清理WebDAV上的旧备份"""
+    def get_remote_index_path(self):
+        """获取远程目录状态缓存的路径"""
+        return os.path.join(self.state_dir, f"{self.backup_prefix}_{REMOTE_INDEX_NAME}")
+    
+    def load_remote_index(self, dir_url):
+        """读取远程目录状态缓存，不存在、已损坏或属于其他目录时返回None"""
+        index_path = self.get_remote_index_path()
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if index.get("url") != dir_url:
+            return None
+        return index
+    
+    def save_remote_index(self, dir_url, validators, entries):
+        """写入远程目录状态缓存（先写临时文件再替换）"""
+        os.makedirs(self.state_dir, exist_ok=True)
+        index_path = self.get_remote_index_path()
+        tmp_path = index_path + ".tmp"
+        index = {
+            "url": dir_url,
+            "validators": list(validators),
+            "entries": {name: {key: entry[key] for key in ("is_collection", "size", "mtime", "etag")}
+                        for name, entry in entries.items()},
+        }
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, index_path)
+    
+    @staticmethod
+    def _collection_validators(entries, dir_url):
+        """从PROPFIND结果中找出目录自身的条目，返回其 (ETag, 修改时间)"""
+        dir_path = unquote(urlparse(dir_url).path).rstrip('/')
+        own = next((entry for entry in entries if urlparse(entry["href"]).path.rstrip('/') == dir_path), None)
+        if own is None:
+            return None, (None, None)
+        return own, (own["etag"], own["mtime"])
+    
+    async def async_list_remote_dir(self, dir_url):
+        """列出远程目录，返回 ({名称: 条目}, 是否来自缓存)；目录的ETag和修改时间与缓存一致时只需一个Depth: 0请求"""
+        cached = self.load_remote_index(dir_url)
+        if cached is not None and any(cached["validators"]):
+            entries = await self.async_client.propfind(dir_url, depth=0)
+            if entries is None:
+                return {}, False
+            own, validators = self._collection_validators(entries, dir_url)
+            if list(validators) == cached["validators"]:
+                return {name: dict(entry, name=name) for name, entry in cached["entries"].items()}, True
+        
+        entries = await self.async_client.propfind(dir_url, depth=1)
+        if entries is None:
+            return {}, False
+        own, validators = self._collection_validators(entries, dir_url)
+        listing = {entry["name"]: entry for entry in entries if entry is not own}
+        self.save_remote_index(dir_url, validators, listing)
+        return listing, False
+    
+    def start_remote_listing(self):
+        """在后台开始获取远程备份目录的文件列表，返回Future，可与压缩和上传同时进行"""
+        dir_url = f"{self.webdav_base_url}/{self.webdav_upload_dir}/"
+        return AsyncLoopThread.get().submit(self.async_list_remote_dir(dir_url))
+    
+    @staticmethod
+    def print_retention_report(location, sizes):
+        """试运行时输出按保留策略将要删除的备份及可释放的空间（sizes为 [(名称, 字节数或None)]）"""
+        if not sizes:
+            print(f"试运行：按保留策略没有需要删除的{location}备份")
+            return
+        for name, size in sizes:
+            print(f"  将删除: {name}（{f'{size / 1024 / 1024:.2f} MB' if size is not None else '大小未知'}）")
+        unknown = sum(1 for name, size in sizes if size is None)
+        reclaimed = sum(size for name, size in sizes if size is not None)
+        print(f"试运行：将删除{location}的 {len(sizes)} 个旧备份，可释放 {reclaimed / 1024 / 1024:.2f} MB"
+              + (f"（另有 {unknown} 个备份大小未知）" if unknown else "") + "，未实际删除")
+    
+    def clean_remote_backups(self, backup_filename, listing=None):
+        """清理WebDAV上的旧备份（listing为start_remote_listing返回的Future，为空时现在获取列表；backup_filename为None表示本次没有上传备份）"""
         print("正在清理WebDAV上的旧备份...")
         
         webdav_dir_url = f"{self.webdav_base_url}/{self.webdav_upload_dir}/"
         
         try:
-            # 获取远程文件列表
-            response = self.session.get(webdav_dir_url, timeout=CONNECT_TIMEOUT)
-            
-            # 提取符合命名规则的备份文件 - 支持tar.gz和zip格式
-            # 使用非捕获组确保返回完整文件名
-            pattern = f"{self.backup_prefix}_\d{{8}}_\d{{6}}\.(?:tar\.gz|zip)"
-            # 使用finditer获取完整匹配
-            remote_files = [match.group(0) for match in re.finditer(pattern, response.text)]
+            # 获取远程文件列表（PROPFIND Depth: 1，目录未变化时使用本地缓存）
+            if listing is None:
+                listing = self.start_remote_listing()
+            entries, from_cache = listing.result()
+            if from_cache:
+                print("远程目录自上次备份后没有变化，使用缓存的文件列表")
             
-            # 排序并去重
-            remote_files = sorted(list(set(remote_files)))
+            # 列表可能在本次上传之前获取，补上刚上传的文件
+            entries = dict(entries)
+            if backup_filename is None:
+                pass
+            elif f"{webdav_dir_url}{backup_filename}" in self.manifest_uploads:
+                entries.setdefault(f"{backup_filename}.parts", {
+                    "name": f"{backup_filename}.parts", "is_collection": True, "size": None, "mtime": None, "etag": None})
+            else:
+                entries.setdefault(backup_filename, {
+                    "name": backup_filename, "is_collection": False, "size": None, "mtime": None, "etag": None})
+            for name in self.uploaded_indexes:
+                entries.setdefault(name, {"name": name, "is_collection": False, "size": None, "mtime": None, "etag": None})
             
-            # 计算需要删除的文件数量
-            files_to_delete_count = len(remote_files) - self.max_remote_backups
+            # 备份文件，以及以manifest方式分片上传的备份（备份文件名.parts目录）
+            remote_files = {}
+            for name, entry in entries.items():
+                if entry["is_collection"] and name.endswith(".parts"):
+                    remote_files[name[:-len(".parts")]] = name
+                elif not entry["is_collection"]:
+                    remote_files[name] = name
             
-            if files_to_delete_count > 0:
-                # 获取需要删除的旧文件（保留最新的）
-                files_to_delete = remote_files[:files_to_delete_count]
-                
+            # 按保留策略计算需要删除的旧文件（保留最新的及各周期的备份，且不拆散增量备份链），跳过当前刚上传的文件
+            files_to_delete = [file for file in select_backups_to_delete(self.backup_prefix, remote_files,
+                                                                         self.max_remote_backups, self.retention_policy)
+                               if file != backup_filename]
+            if RETENTION_DRY_RUN:
+                # 可释放的空间取自列表中的文件大小（含随机访问索引）；以分片目录保存的备份大小未知
+                sizes = []
                 for file in files_to_delete:
-                    # 跳过当前刚上传的文件
-                    if file == backup_filename:
-                        continue
-                    
-                    file_url = f"{webdav_dir_url}{file}"
-                    print(f"删除WebDAV上的旧备份: {file}")
-                    
-                    try:
-                        self.session.delete(file_url, timeout=CONNECT_TIMEOUT)
-                    except Exception as e:
-                        print(f"警告：删除文件 {file} 时发生错误: {str(e)}")
-                        # 继续尝试删除其他文件
-                        continue
+                    entry = entries[remote_files[file]]
+                    size = None if entry["is_collection"] else entry.get("size")
+                    index_entry = entries.get(f"{file}{ARCHIVE_INDEX_SUFFIX}")
+                    if size is not None and index_entry is not None and index_entry.get("size") is not None:
+                        size += index_entry["size"]
+                    sizes.append((file, size))
+                self.print_retention_report("WebDAV上", sizes)
+                return
+            
+            async def delete(file):
+                print(f"删除WebDAV上的旧备份: {file}")
+                remote_name = remote_files[file]
+                file_url = f"{webdav_dir_url}{remote_name}" + ("/" if remote_name != file else "")
+                status_code = await self.async_client.delete(file_url)
+                if status_code not in [200, 204, 404]:
+                    raise IOError(f"HTTP状态码: {status_code}")
+                # 同时删除该备份的随机访问索引
+                index_name = f"{file}{ARCHIVE_INDEX_SUFFIX}"
+                if index_name in entries:
+                    status_code = await self.async_client.delete(f"{webdav_dir_url}{index_name}")
+                    if status_code in [200, 204, 404]:
+                        entries.pop(index_name, None)
+            
+            # 各文件的删除请求并发执行（最多RETENTION_DELETE_CONCURRENCY个），某个文件删除失败时继续删除其他文件
+            results = self.run_async_all([delete(file) for file in files_to_delete], return_exceptions=True,
+                                         limit=RETENTION_DELETE_CONCURRENCY)
+            for file, result in zip(files_to_delete, results):
+                if isinstance(result, Exception):
+                    print(f"警告：删除文件 {file} 时发生错误: {str(result) or type(result).__name__}")
+                else:
+                    entries.pop(remote_files[file], None)
+            
+            # 记录本次修改后的目录状态；下次运行时目录的ETag/修改时间未变化即可直接使用缓存的列表
+            own_entries = self.webdav_propfind(webdav_dir_url, depth=0) or []
+            own, validators = self._collection_validators(own_entries, webdav_dir_url)
+            self.save_remote_index(webdav_dir_url, validators, entries)
         except Exception as e:
             print(f"警告：清理WebDAV旧备份时发生错误: {str(e)}")
     
+    def restore(self, backup_name=None, paths=(), target_dir=".", list_only=False):
+        """列出或恢复远程备份中的文件/目录（zip读取中央目录，tar格式使用随机访问索引，只下载所需的数据范围），返回是否成功"""
+        if ENABLE_DEDUP_STORE or (backup_name or "").endswith(".json.gz"):
+            return self.restore_snapshot(backup_name, paths, target_dir, list_only)
+        source = None
+        remote_file = None
+        try:
+            dir_url = f"{self.webdav_base_url}/{self.webdav_upload_dir}/"
+            entries, from_cache = self.start_remote_listing().result()
+            pattern = re.compile(f"^{backup_filename_pattern(self.backup_prefix)}$")
+            if backup_name is None:
+                # 备份文件，以及以manifest方式分片上传的备份（备份文件名.parts目录）
+                backups = set()
+                for name, entry in entries.items():
+                    if entry["is_collection"] and name.endswith(".parts"):
+                        name = name[:-len(".parts")]
+                    elif entry["is_collection"]:
+                        continue
+                    if pattern.match(name):
+                        backups.add(name)
+                backups = sorted(backups)
+                if not backups:
+                    print(f"错误：WebDAV目录 {dir_url} 中没有找到备份文件")
+                    return False
+                backup_name = backups[-1]
+            parts = None
+            if backup_name not in entries:
+                if f"{backup_name}.parts" not in entries:
+                    print(f"错误：WebDAV目录 {dir_url} 中没有找到备份文件 {backup_name}")
+                    return False
+                response = self.session.get(f"{dir_url}{backup_name}.parts/manifest.json",
+                                            timeout=(CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME))
+                if response.status_code != 200:
+                    raise IOError(f"读取分片清单失败 (HTTP状态码: {response.status_code})")
+                parts = response.json()["parts"]
+            encrypted = backup_name.endswith(ENCRYPTED_SUFFIX)
+            plain_name = backup_name[:-len(ENCRYPTED_SUFFIX)] if encrypted else backup_name
+            backup_format = next((name for name in BACKUP_FORMATS if plain_name.endswith(f".{name}")), None)
+            if backup_format is None:
+                print(f"错误：无法识别备份文件 {backup_name} 的格式")
+                return False
+            print(f"备份文件: {backup_name}")
+            if re.search(r"_(incr|diff)\.", backup_name):
+                print("注意：增量/差异备份只包含变化的文件，完整恢复需依次恢复全量备份及之后的备份")
+            
+            # 本地仍保留同一备份时直接读取本地文件，否则按需以范围请求读取远程文件
+            size = entries[backup_name].get("size") if parts is None else sum(part[1] for part in parts)
+            local_path = os.path.join(self.local_backup_dir, backup_name)
+            if os.path.isfile(local_path) and (size is None or os.path.getsize(local_path) == size):
+                print(f"使用本地备份文件: {local_path}")
+                source = open(local_path, 'rb')
+                size = os.path.getsize(local_path)
+            elif parts is not None:
+                print(f"备份以分片方式保存（{len(parts)} 个分片），按清单读取各分片")
+                source = remote_file = RemotePartsFile(self.session, f"{dir_url}{backup_name}.parts", parts)
+            else:
+                if size is None:
+                    response = self.session.head(f"{dir_url}{backup_name}", timeout=(CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME))
+                    if response.status_code != 200:
+                        raise IOError(f"获取备份文件大小失败 (HTTP状态码: {response.status_code})")
+                    size = int(response.headers.get("Content-Length", 0))
+                source = remote_file = RemoteRangeFile(self.session, f"{dir_url}{backup_name}", size)
+            stored_size = size
+            if encrypted:
+                # 加密备份：按需读取并解密所需的加密块，之后的处理与未加密的备份相同
+                source = DecryptingReader(source, size, self.get_encryption_key())
+                print(f"加密算法: {source.cipher.algorithm}")
+                size = source.size
+            
+            selected = self._restore_selector(paths)
+            if not list_only:
+                os.makedirs(target_dir, exist_ok=True)
+            index_bytes = 0
+            if backup_format == "zip":
+                count, written = self._restore_zip(source, selected, target_dir, list_only)
+            else:
+                codec = TAR_CODECS[backup_format]
+                codec.load()
+                index, index_bytes = self.load_archive_index(backup_name, size, remote_file is not None)
+                if index is not None:
+                    count, written = self._restore_tar_indexed(source, codec, index, selected, target_dir, list_only)
+                else:
+                    print("注意：该备份没有可用的随机访问索引，需要按顺序下载并解压整个备份")
+                    chunks = iter_decompressed(iter_file_range(source, 0, size, 1024 * 1024), codec)
+                    count, written = self._restore_tar_stream(chunks, selected, target_dir, list_only)
+            
+            if list_only:
+                print(f"共 {count} 项")
+            else:
+                print(f"恢复完成: {count} 项，写入 {written / 1024 / 1024:.2f} MB，目标目录: {os.path.abspath(target_dir)}")
+            if remote_file is not None:
+                print(f"下载 {(remote_file.downloaded + index_bytes) / 1024:.1f} KB（{remote_file.requests} 个范围请求"
+                      + (f"，索引 {index_bytes / 1024:.1f} KB" if index_bytes else "")
+                      + f"），备份文件共 {stored_size / 1024 / 1024:.2f} MB")
+            return True
+        except Exception as e:
+            print(f"错误：恢复失败！")
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            return False
+        finally:
+            if source is not None:
+                source.close()
+    
+    def restore_snapshot(self, snapshot_name=None, paths=(), target_dir=".", list_only=False):
+        """列出或恢复去重存储中的快照：按快照清单依次下载并解压数据块，作为tar流按顺序恢复，返回是否成功"""
+        upload_url = f"{self.webdav_base_url}/{self.webdav_upload_dir}"
+        try:
+            if snapshot_name is None:
+                entries = self.webdav_propfind(f"{upload_url}/snapshots/", depth=1) or []
+                pattern = re.compile(f"^{self.backup_prefix}_\\d{{8}}_\\d{{6}}\\.json\\.gz$")
+                snapshots = sorted(e["name"] for e in entries if not e["is_collection"] and pattern.match(e["name"]))
+                if not snapshots:
+                    print(f"错误：WebDAV目录 {upload_url}/snapshots/ 中没有找到快照")
+                    return False
+                snapshot_name = snapshots[-1]
+            response = self.session.get(f"{upload_url}/snapshots/{snapshot_name}", timeout=(CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME))
+            if response.status_code == 404:
+                print(f"错误：WebDAV目录 {upload_url}/snapshots/ 中没有找到快照 {snapshot_name}")
+                return False
+            if response.status_code != 200:
+                raise IOError(f"读取快照清单失败 (HTTP状态码: {response.status_code})")
+            manifest = json.loads(gzip.decompress(response.content).decode('utf-8'))
+            if manifest.get("version") != 1 or manifest.get("format") != "tar":
+                print(f"错误：不支持的快照清单格式: {snapshot_name}")
+                return False
+            print(f"快照: {snapshot_name}（去重存储，{len(manifest['chunks'])} 个数据块，"
+                  f"共 {manifest['total_size'] / 1024 / 1024:.2f} MB）")
+            print("注意：快照需要按顺序下载并解压全部数据块")
+            
+            if not list_only:
+                os.makedirs(target_dir, exist_ok=True)
+            reader = DedupChunkReader(self, f"{upload_url}/chunks", manifest["chunks"], max(1, DEDUP_UPLOAD_WORKERS))
+            count, written = self._restore_tar_stream(reader, self._restore_selector(paths), target_dir, list_only)
+            if list_only:
+                print(f"共 {count} 项")
+            else:
+                print(f"恢复完成: {count} 项，写入 {written / 1024 / 1024:.2f} MB，目标目录: {os.path.abspath(target_dir)}")
+            print(f"下载 {(reader.downloaded + len(response.content)) / 1024:.1f} KB（快照清单 {len(response.content) / 1024:.1f} KB）")
+            return True
+        except Exception as e:
+            print(f"错误：恢复失败！")
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            return False
+    
+    @staticmethod
+    def _restore_selector(paths):
+        """返回判断压缩包内路径是否在要恢复的文件/目录中的函数，paths为空表示全部"""
+        prefixes = [path.strip("/") for path in paths if path.strip("/")]
+        
+        def selected(name):
+            name = name.rstrip("/")
+            return not prefixes or any(name == prefix or name.startswith(prefix + "/") for prefix in prefixes)
+        return selected
+    
+    def load_archive_index(self, backup_name, archive_size, remote):
+        """读取备份的随机访问索引（本地或远程），返回 (索引, 下载的字节数)，不存在或与备份文件不匹配时索引为None"""
+        data = None
+        downloaded = 0
+        local_path = os.path.join(self.local_backup_dir, backup_name + ARCHIVE_INDEX_SUFFIX)
+        if not remote and os.path.isfile(local_path):
+            with open(local_path, 'rb') as f:
+                data = f.read()
+        else:
+            response = self.session.get(f"{self.webdav_base_url}/{self.webdav_upload_dir}/{backup_name}{ARCHIVE_INDEX_SUFFIX}",
+                                        timeout=(CONNECT_TIMEOUT, SMALL_FILE_MAX_TIME))
+            if response.status_code == 200:
+                data = response.content
+                downloaded = len(data)
+        if data is None:
+            return None, downloaded
+        try:
+            if backup_name.endswith(ENCRYPTED_SUFFIX):
+                data = decrypt_bytes(self.get_encryption_key(), data)
+            index = json.loads(gzip.decompress(data).decode('utf-8'))
+        except (OSError, ValueError) as e:
+            print(f"警告：随机访问索引已损坏: {str(e)}")
+            return None, downloaded
+        if index.get("version") != 1 or index.get("size") != archive_size:
+            print("警告：随机访问索引与备份文件不匹配")
+            return None, downloaded
+        return index, downloaded
+    
+    def _restore_zip(self, source, selected, target_dir, list_only):
+        """按zip中央目录列出或恢复文件，每个文件只读取其所在的数据范围"""
+        import zipfile
+        
+        # 远程文件加一层缓冲，合并zipfile的小块读取，减少范围请求数
+        reader = io.BufferedReader(source, 64 * 1024) if isinstance(source, RemoteRangeFile) else source
+        count = 0
+        written = 0
+        with zipfile.ZipFile(reader) as zipf:
+            for info in zipf.infolist():
+                if not selected(info.filename):
+                    continue
+                count += 1
+                kind = "d" if info.is_dir() else "f"
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                if list_only:
+                    self._print_restore_entry(kind, info.file_size, mtime, info.filename)
+                    continue
+                with zipf.open(info) as f:
+                    written += self._write_restored_entry(target_dir, info.filename, kind, (info.external_attr >> 16) & 0o7777,
+                                                          mtime, None, iter(lambda: f.read(1024 * 1024), b""))
+        return count, written
+    
+    def _restore_tar_indexed(self, source, codec, index, selected, target_dir, list_only):
+        """按随机访问索引恢复：把需要的文件按所在压缩块分组，每组只下载并解压对应的压缩块"""
+        members = index["members"]
+        by_name = {member[0]: member for member in members}
+        points = index["restart_points"]
+        starts = [point[1] for point in points]
+        
+        count = 0
+        written = 0
+        jobs = []
+        for name, kind, size, offset, mtime, mode, link in members:
+            if not selected(name):
+                continue
+            count += 1
+            if kind == tarfile.LNKTYPE.decode() and link in by_name:
+                # 硬链接的数据保存在链接目标的条目中
+                kind, size, offset = "0", by_name[link][2], by_name[link][3]
+            kind = {"0": "f", "\0": "f", "7": "f", "5": "d", "2": "l"}.get(kind)
+            if kind is None:
+                continue
+            if list_only:
+                self._print_restore_entry(kind, size, mtime, name)
+            elif kind == "f" and size:
+                jobs.append((offset, size, name, mode, mtime))
+            else:
+                self._write_restored_entry(target_dir, name, kind, mode, mtime, link, ())
+        
+        # 数据所在的压缩块相邻或重叠的文件合并为一个范围请求
+        groups = []
+        for job in sorted(jobs):
+            offset, size = job[0], job[1]
+            first = bisect.bisect_right(starts, offset) - 1
+            last = bisect.bisect_right(starts, offset + size - 1) - 1
+            if groups and first <= groups[-1][1] + 1:
+                groups[-1][1] = max(groups[-1][1], last)
+                groups[-1][2].append(job)
+            else:
+                groups.append([first, last, [job]])
+        
+        restored = {}
+        for first, last, group_jobs in groups:
+            start = points[first][0]
+            end = points[last + 1][0] if last + 1 < len(points) else index["size"]
+            reader = _ChunkReader(iter_decompressed(iter_file_range(source, start, end - start), codec), points[first][1])
+            for offset, size, name, mode, mtime in group_jobs:
+                if offset in restored:
+                    # 同一数据的硬链接，复制已恢复的文件
+                    with open(restored[offset], 'rb') as f:
+                        written += self._write_restored_entry(target_dir, name, "f", mode, mtime, None,
+                                                              iter(lambda: f.read(1024 * 1024), b""))
+                    continue
+                for chunk in reader.iter_exact(offset - reader.position):
+                    pass
+                written += self._write_restored_entry(target_dir, name, "f", mode, mtime, None, reader.iter_exact(size))
+                restored[offset] = self._restore_path(target_dir, name)
+        return count, written
+    
+    def _restore_tar_stream(self, chunks, selected, target_dir, list_only):
+        """按顺序读取整个tar流（没有随机访问索引的备份、去重存储的快照），只写出选中的文件"""
+        reader = _ChunkReader(chunks)
+        count = 0
+        written = 0
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            for member in tar:
+                if not selected(member.name):
+                    continue
+                count += 1
+                kind = "f" if member.isreg() or member.islnk() else "d" if member.isdir() else "l" if member.issym() else None
+                if kind is None:
+                    continue
+                if list_only:
+                    self._print_restore_entry(kind, member.size, member.mtime, member.name)
+                    continue
+                if member.islnk():
+                    # 硬链接的目标已在前面恢复时复制该文件
+                    link_path = self._restore_path(target_dir, member.linkname)
+                    if link_path is None or not os.path.isfile(link_path):
+                        print(f"警告：硬链接 {member.name} 的目标 {member.linkname} 未被恢复，已跳过")
+                        continue
+                    with open(link_path, 'rb') as f:
+                        written += self._write_restored_entry(target_dir, member.name, kind, member.mode, member.mtime, None,
+                                                              iter(lambda: f.read(1024 * 1024), b""))
+                    continue
+                f = tar.extractfile(member) if kind == "f" else None
+                written += self._write_restored_entry(target_dir, member.name, kind, member.mode, member.mtime,
+                                                      member.linkname, iter(lambda: f.read(1024 * 1024), b"") if f else ())
+        return count, written
+    
+    @staticmethod
+    def _print_restore_entry(kind, size, mtime, name):
+        modified = datetime.datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{kind} {size:>12}  {modified}  {name}")
+    
+    @staticmethod
+    def _restore_path(target_dir, name):
+        """压缩包内路径对应的恢复路径，包含..等不安全的路径时返回None"""
+        parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+        if not parts or ".." in parts:
+            return None
+        return os.path.join(target_dir, *parts)
+    
+    def _write_restored_entry(self, target_dir, name, kind, mode, mtime, link, chunks):
+        """恢复一个目录、符号链接或文件，返回写入的字节数"""
+        path = self._restore_path(target_dir, name)
+        if path is None:
+            print(f"警告：跳过不安全的路径 {name}")
+            return 0
+        if kind == "d":
+            os.makedirs(path, exist_ok=True)
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 已存在的符号链接先删除，避免通过链接写到目标目录之外
+        if os.path.islink(path) or (kind == "l" and os.path.lexists(path)):
+            os.remove(path)
+        if kind == "l":
+            os.symlink(link, path)
+            return 0
+        written = 0
+        with open(path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                written += len(chunk)
+        if mode:
+            os.chmod(path, mode)
+        os.utime(path, (mtime, mtime))
+        return written
+    
     def send_notification_email(self, subject, body):
         """发送通知邮件"""
         if not self.enable_email_notification:
@@ -480,16 +5902,22 @@ class WebDAVBackup:
             print(f"失败通知邮件已禁用，跳过发送：{subject}")
             return
         
-        # 添加邮件主题前缀
+        # 添加邮件主题前缀（多任务模式下附带任务名称）
         original_subject = subject
         subject = f"[{self.email_subject_prefix}]{original_subject}"
+        if self.job_name:
+            subject = f"[{self.email_subject_prefix}][{self.job_name}]{original_subject}"
         
         print(f"正在发送邮件通知：{subject}")
         
         try:
             # 添加时间戳到邮件内容
             timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            full_body = f"{body}\n\n时间戳: {timestamp}"
+            full_body = body
+            stage_summary = self.metrics.format_summary()
+            if stage_summary:
+                full_body += f"\n\n{stage_summary}"
+            full_body += f"\n\n时间戳: {timestamp}"
             
             # 创建邮件对象
             message = MIMEText(full_body, 'plain', 'utf-8')
@@ -523,19 +5951,25 @@ class WebDAVBackup:
             
             for file in os.listdir(self.local_backup_dir):
                 # 支持tar.gz和zip格式的文件
-                if re.match(f"^{self.backup_prefix}_\\d{{8}}_\\d{{6}}\\.(tar\\.gz|zip)$", file):
+                if re.match(f"^{backup_filename_pattern(self.backup_prefix)}$", file):
                     local_files.append(file)
             
-            # 按文件名排序（文件名包含时间戳，排序后最新的在最后）
-            local_files.sort()
-            
-            # 计算需要删除的文件数量
-            files_to_delete_count = len(local_files) - self.max_local_backups
+            # 按保留策略计算需要删除的旧文件（时间戳取自文件名，保留最新的及各周期的备份，且不拆散增量备份链）
+            files_to_delete = select_backups_to_delete(self.backup_prefix, local_files, self.max_local_backups,
+                                                       self.local_retention_policy)
             
-            if files_to_delete_count > 0:
-                # 获取需要删除的旧文件（保留最新的）
-                files_to_delete = local_files[:files_to_delete_count]
-                
+            if RETENTION_DRY_RUN:
+                sizes = []
+                for file in files_to_delete:
+                    if file == backup_filename:
+                        continue
+                    file_path = os.path.join(self.local_backup_dir, file)
+                    size = os.path.getsize(file_path)
+                    if os.path.exists(file_path + ARCHIVE_INDEX_SUFFIX):
+                        size += os.path.getsize(file_path + ARCHIVE_INDEX_SUFFIX)
+                    sizes.append((file, size))
+                self.print_retention_report("本地", sizes)
+            elif files_to_delete:
                 for file in files_to_delete:
                     # 跳过当前刚创建的文件
                     if file == backup_filename:
@@ -547,6 +5981,8 @@ class WebDAVBackup:
                         print(f"删除本地旧备份: {file}")
                         
                         os.remove(file_path)
+                        if os.path.exists(file_path + ARCHIVE_INDEX_SUFFIX):
+                            os.remove(file_path + ARCHIVE_INDEX_SUFFIX)
                     except UnicodeEncodeError as e:
                         # 处理文件名编码错误
                         print(f"警告：文件名字符编码错误，尝试使用原始字节路径: {str(e)}")
@@ -572,8 +6008,97 @@ class WebDAVBackup:
         except Exception as e:
             print(f"警告：清理本地旧备份时发生错误: {str(e)}")
     
+    def get_metrics_textfile(self):
+        """获取Prometheus文本文件路径（多任务模式下文件名后加任务名称），未配置时返回None"""
+        if not METRICS_TEXTFILE:
+            return None
+        if not self.job_name:
+            return METRICS_TEXTFILE
+        root, ext = os.path.splitext(METRICS_TEXTFILE)
+        return f"{root}_{self.job_name}{ext}"
+    
+    def write_run_metrics(self):
+        """运行结束时保存JSON运行记录并写入Prometheus文本文件（失败时只给出警告，不影响备份结果）"""
+        metrics = self.metrics
+        metrics.finish()
+        stats = self.load_run_stats()
+        if metrics.status != "failure":
+            stats["last_success_timestamp"] = round(metrics.finished, 3)
+            self.save_run_stats(stats)
+        
+        if WRITE_RUN_RECORD:
+            try:
+                record_dir = os.path.join(self.state_dir, RUN_RECORD_DIR_NAME)
+                os.makedirs(record_dir, exist_ok=True)
+                stamp = datetime.datetime.fromtimestamp(metrics.started).strftime('%Y%m%d_%H%M%S')
+                record_path = os.path.join(record_dir, f"{self.backup_prefix}_{stamp}.json")
+                with open(record_path + ".tmp", 'w', encoding='utf-8') as f:
+                    json.dump(metrics.to_record(), f, ensure_ascii=False, indent=2)
+                os.replace(record_path + ".tmp", record_path)
+                # 只保留最新的MAX_RUN_RECORDS个记录（文件名包含时间戳，按文件名排序）
+                pattern = re.compile(rf"^{re.escape(self.backup_prefix)}_\d{{8}}_\d{{6}}\.json$")
+                records = sorted(name for name in os.listdir(record_dir) if pattern.match(name))
+                for name in records[:max(len(records) - MAX_RUN_RECORDS, 0)]:
+                    os.remove(os.path.join(record_dir, name))
+            except OSError as e:
+                print(f"警告：保存运行记录失败: {str(e)}")
+        
+        textfile = self.get_metrics_textfile()
+        if textfile:
+            # node_exporter可能随时读取该文件，先写临时文件再替换，避免读到不完整的内容
+            try:
+                tmp_path = f"{textfile}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(metrics.format_prometheus(self.job_name or self.backup_prefix,
+                                                      stats.get("last_success_timestamp")))
+                os.replace(tmp_path, textfile)
+            except OSError as e:
+                print(f"警告：写入Prometheus指标文件失败: {str(e)}")
+    
+    def upload_and_verify(self, local_backup_path, backup_filename, hasher=None, first_attempt=0):
+        """上传本地备份文件并执行完整性检测；临时错误或检测未通过时从本地文件重新上传（最多STAGE_RETRIES次，不重新压缩），
+        返回 (状态码, 远程地址, 哈希, 完整性检测是否通过)"""
+        for attempt in range(first_attempt, STAGE_RETRIES + 1):
+            if attempt:
+                delay = self.retry_policy.delay(attempt - 1)
+                print(f"警告：上传阶段失败，{delay:.1f} 秒后从本地备份文件重新上传（第 {attempt} 次）")
+                self.metrics.add_retry("upload")
+                time.sleep(delay)
+            
+            # 上传到WebDAV（记录上传速度，供自动选择压缩级别时估计带宽）
+            with self.metrics.measure("upload") as upload_stage:
+                status_code, webdav_full_url, hasher = self.upload_to_webdav(local_backup_path, backup_filename, hasher)
+            upload_stage.update(bytes=self.metrics.archive_bytes, http_status=status_code)
+            if status_code in [200, 201, 204]:
+                self.record_throughput("upload", self.metrics.archive_bytes, upload_stage["seconds"])
+            with self.metrics.measure("integrity") as integrity_stage:
+                integrity_ok = self.check_uploaded_backup(status_code, local_backup_path, webdav_full_url, hasher)
+            integrity_stage["bytes"] = self.metrics.archive_bytes
+            
+            # 上传成功但检测未通过（远程文件不完整或已被删除）时同样重新上传；权限不足等错误不再重试
+            if integrity_ok or not (status_code in [200, 201, 204] or self.is_transient_status(status_code)):
+                break
+        return status_code, webdav_full_url, hasher, integrity_ok
+    
+    def check_uploaded_backup(self, status_code, local_backup_path, webdav_full_url, hasher):
+        """上传成功时执行完整性检测，返回检测是否通过（上传失败时返回False）"""
+        if status_code not in [200, 201, 204]:
+            return False
+        print("WebDAV上传成功！")
+        
+        # 执行完整性检测
+        return self.check_integrity(local_backup_path, webdav_full_url, hasher)
+    
     def run(self):
-        """执行完整的备份流程"""
+        """执行完整的备份流程，结束时以退出码退出进程（定时任务方式运行）"""
+        try:
+            code = self.run_once()
+        except KeyboardInterrupt:
+            code = 1
+        sys.exit(code)
+    
+    def run_once(self):
+        """执行一次完整的备份流程，返回退出码（0表示成功或源目录没有变化）；出错时不退出进程，守护进程可以继续运行"""
         try:
             # 检查源目录
             self.check_source_dir()
@@ -581,52 +6106,565 @@ class WebDAVBackup:
             # 创建本地备份目录
             self.create_local_backup_dir()
             
-            # 生成备份文件名
-            backup_filename, local_backup_path = self.generate_backup_filename()
+            # 检查加密配置
+            self.check_encryption()
             
-            # 创建备份文件
-            self.create_backup_file(local_backup_path)
+            # 继续之前中断的分片上传
+            if ENABLE_MULTIPART_UPLOAD:
+                with self.stage("upload"):
+                    self.resume_pending_uploads()
             
-            # 创建WebDAV目录
-            self.create_webdav_directories()
+            if ENABLE_DEDUP_STORE:
+                # 去重存储模式：不生成完整压缩包，按数据块增量上传（分块与上传同时进行，同时占用两个阶段）
+                with self.stage("compress"), self.stage("upload"):
+                    self.create_webdav_directories(sub_dirs=("chunks", "snapshots"))
+                    self.quiesce_source()
+                    self.create_source_snapshot()
+                    if self.snapshot_root is not None:
+                        self.resume_source()
+                    with self.metrics.measure("dedup"):
+                        snapshot_url = self.run_dedup_backup()
+                    self.resume_source()
+                    self.remove_source_snapshot()
+                with self.metrics.measure("clean_remote"):
+                    self.clean_dedup_store()
+                self.metrics.status = "success"
+                self.metrics.backup_file = snapshot_url
+                success_msg = f"备份任务完成！\nWebDAV快照清单: {snapshot_url}"
+                print(success_msg)
+                self.send_notification_email("WebDAV备份成功完成", success_msg)
+                return 0
+            
+            # 在后台创建WebDAV目录并获取远程备份列表，与扫描和压缩同时进行
+            directories = self.start_webdav_directories()
+            remote_listing = self.start_remote_listing()
+            
+            # 压缩阶段（扫描源目录和压缩）与上传阶段（上传和校验）分别限制并发，多任务时不同任务的两个阶段可以重叠
+            with self.stage("compress"):
+                # 暂停源目录的写入（配置了QUIESCE_COMMAND时）
+                self.quiesce_source()
+                
+                # 增量/差异模式：比对文件状态索引，确定本次备份类型和需要归档的文件
+                self.plan_backup()
+                if (self.backup_plan is not None and self.backup_plan["kind"] != "full"
+                        and not self.backup_plan["entries"] and not self.backup_plan["deleted"]):
+                    print("源目录自上次备份以来没有变化，跳过本次备份")
+                    self.metrics.status = "unchanged"
+                    return 0
+                
+                # 预检：估计压缩包大小和耗时，检查本地空间和WebDAV配额，空间不足时在压缩前改用流式上传或中止
+                self.preflight_check()
+                
+                # 生成备份文件名
+                backup_filename, local_backup_path = self.generate_backup_filename()
+                self.metrics.backup_file = backup_filename
+                
+                # 一致性快照：复制需要归档的文件后即可恢复源目录的写入
+                self.create_source_snapshot()
+                if self.snapshot_root is not None:
+                    self.resume_source()
+                
+                # 创建或上传压缩包时同步计算的哈希，完整性检测时不再单独读取本地文件
+                hasher = None
+                
+                if not self.streaming_upload:
+                    # 创建备份文件
+                    with self.metrics.measure("compress") as compress_stage:
+                        hasher = self.create_backup_file(local_backup_path)
+                    compress_stage["bytes"] = self.get_archived_source_size()
+                    self.record_throughput("compress", compress_stage["bytes"], compress_stage["seconds"])
+                    self.metrics.archive_bytes = self.get_file_size(local_backup_path)
+                    self.resume_source()
+                    self.remove_source_snapshot()
             
-            # 上传到WebDAV
-            status_code, webdav_full_url = self.upload_to_webdav(local_backup_path, backup_filename)
+            if self.streaming_upload:
+                # 流式模式：先等待WebDAV目录创建完成，再边压缩边上传（同时占用压缩和上传两个阶段）
+                with self.stage("compress"), self.stage("upload"):
+                    self.wait_webdav_directories(directories)
+                    with self.metrics.measure("stream") as stream_stage:
+                        status_code, webdav_full_url, hasher = self.stream_backup_to_webdav(
+                            local_backup_path, backup_filename)
+                    stream_stage.update(bytes=self.get_archived_source_size(), http_status=status_code)
+                    self.metrics.archive_bytes = hasher.size
+                    self.resume_source()
+                    self.remove_source_snapshot()
+                    with self.metrics.measure("integrity") as integrity_stage:
+                        integrity_ok = self.check_uploaded_backup(status_code, local_backup_path, webdav_full_url, hasher)
+                    integrity_stage["bytes"] = hasher.size
+                    # 流式上传失败但保留了完整的本地副本时，从本地副本重新上传，不重新压缩
+                    if (not integrity_ok and STAGE_RETRIES > 0 and os.path.exists(local_backup_path)
+                            and (status_code in [200, 201, 204] or self.is_transient_status(status_code))):
+                        print("注意：流式上传失败，使用本地备份文件重新上传")
+                        status_code, webdav_full_url, hasher, integrity_ok = self.upload_and_verify(
+                            local_backup_path, backup_filename, hasher, first_attempt=1)
+            else:
+                with self.stage("upload"):
+                    # 等待WebDAV目录创建完成
+                    self.wait_webdav_directories(directories)
+                    
+                    # 上传并执行完整性检测，失败时从本地备份文件重新上传
+                    status_code, webdav_full_url, hasher, integrity_ok = self.upload_and_verify(
+                        local_backup_path, backup_filename, hasher)
             
             # 检查上传结果
             if status_code in [200, 201, 204]:
-                print("WebDAV上传成功！")
-                
-                # 执行完整性检测
-                if not self.check_integrity(local_backup_path, webdav_full_url):
+                # 完整性检测结果
+                if not integrity_ok:
                     print("备份任务失败！")
-                    sys.exit(1)
+                    return 1
                 
-                # 清理WebDAV上的旧备份
-                self.clean_remote_backups(backup_filename)
+                self.finish_uploaded_backup(backup_filename, remote_listing)
             else:
-                error_msg = f"错误：WebDAV上传失败 (HTTP状态码: {status_code})\n本地备份已保存，但上传到WebDAV服务器时出错"
+                if os.path.exists(self.get_upload_journal_path(backup_filename)):
+                    # 继续上传完成后再提交本次的增量索引
+                    self.save_pending_plan(backup_filename)
+                    error_msg = f"错误：WebDAV上传失败 (HTTP状态码: {status_code})\n本地备份已保存，已上传的分片已记录，重新运行脚本将只上传缺失的分片"
+                elif os.path.exists(local_backup_path):
+                    error_msg = f"错误：WebDAV上传失败 (HTTP状态码: {status_code})\n本地备份已保存，但上传到WebDAV服务器时出错"
+                else:
+                    error_msg = f"错误：WebDAV上传失败 (HTTP状态码: {status_code})\n流式上传未保留本地备份，本次备份未保存"
                 print(error_msg)
                 self.send_notification_email("WebDAV备份失败 - 上传失败", error_msg)
             
             # 清理本地旧备份
-            self.clean_local_backups(backup_filename)
+            with self.metrics.measure("clean_local"):
+                self.clean_local_backups(backup_filename)
             
+            # 上传失败时已发送失败通知，返回非零退出码（守护进程据此安排重试）
+            if status_code not in [200, 201, 204]:
+                print("备份任务失败！")
+                return 1
+            
+            if not os.path.exists(local_backup_path):
+                local_backup_path = "未保留（流式上传）"
+            self.metrics.status = "success"
             success_msg = f"备份任务完成！\n本地备份文件: {local_backup_path}\nWebDAV备份文件: {webdav_full_url}"
+            if hasher is not None and hasher.hashes:
+                success_msg += "\n校验和: " + ", ".join(f"{name.upper()}={hasher.hexdigest(name)}" for name in hasher.hashes)
             print(success_msg)
             self.send_notification_email("WebDAV备份成功完成", success_msg)
-            sys.exit(0)
+            return 0
             
+        except BackupExit as e:
+            return e.code
         except KeyboardInterrupt:
             print("\n备份任务被用户中断！")
-            sys.exit(1)
+            raise
         except Exception as e:
-            error_msg = f"错误：备份过程中发生未预期的异常！\n详细错误：{str(e)}"
+            error_msg = f"错误：备份过程中发生未预期的异常！\n详细错误：{str(e) or type(e).__name__}"
             print(error_msg)
             self.send_notification_email("WebDAV备份失败 - 系统错误", error_msg)
-            sys.exit(1)
+            return 1
+        finally:
+            # 出错或提前退出时同样恢复源目录的写入并删除快照
+            self.resume_source()
+            self.remove_source_snapshot()
+            self.write_run_metrics()
+
+
+class JobOutput:
+    """多任务模式下的标准输出包装：按线程缓存输出，整行写出并加上所属任务名称前缀，避免多个任务的输出交错"""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._job = contextvars.ContextVar("job", default=None)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def set_job(self, name):
+        # 任务名称保存在上下文变量中，提交到异步事件循环的协程也能继承
+        self._job.set(name)
+
+    def write(self, text):
+        name = self._job.get()
+        if name is None:
+            with self._lock:
+                return self._stream.write(text)
+        if not hasattr(self._local, "pending"):
+            self._local.pending = {}
+        lines = (self._local.pending.get(name, "") + text).split("\n")
+        self._local.pending[name] = lines.pop()
+        if lines:
+            with self._lock:
+                self._stream.write("".join(f"[{name}] {line}\n" for line in lines))
+        return len(text)
+
+    def flush(self):
+        self._stream.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._stream, attr)
+
+
+class BackupScheduler:
+    """在一个进程中执行多个备份任务：压缩阶段与上传阶段分别限制并发，连接到同一服务器的任务共享会话和连接池"""
+
+    def __init__(self, jobs, compression_concurrency=None, upload_concurrency=None, max_connections_per_host=None):
+        names = [job.get("name") for job in jobs]
+        if not all(names) or len(set(names)) != len(names):
+            raise ValueError("每个备份任务都必须设置唯一的name")
+        self.jobs = jobs
+        self.compression_concurrency = compression_concurrency or JOB_COMPRESSION_CONCURRENCY
+        self.upload_concurrency = upload_concurrency or JOB_UPLOAD_CONCURRENCY
+        self.max_connections_per_host = max_connections_per_host or MAX_CONNECTIONS_PER_HOST
+        # 同步会话（上传）与异步客户端（校验、列目录、删除）分别维护连接池，按比例分配同一个连接数上限（各至少1个）
+        self.async_connections_per_host = max(1, self.max_connections_per_host // 2)
+        self.session_connections_per_host = max(1, self.max_connections_per_host - self.async_connections_per_host)
+        self._stage_slots = {
+            "compress": threading.BoundedSemaphore(self.compression_concurrency),
+            "upload": threading.BoundedSemaphore(self.upload_concurrency),
+        }
+        self._sessions = {}
+        self._async_clients = {}
+        self._sessions_lock = threading.Lock()
+
+    def get_session(self, base_url, user, password):
+        """获取连接到指定服务器的共享会话（按协议、主机和用户区分）"""
+        parsed = urlparse(base_url)
+        key = (parsed.scheme, parsed.netloc, user)
+        with self._sessions_lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.auth = (user, password)
+                session.headers.update({'User-Agent': 'WebDAV-Backup-Script-Python/1.0'})
+                # pool_block=True：连接数达到上限时等待空闲连接，而不是新建连接，以此限制每个服务器的连接数
+                adapter = RetryingHTTPAdapter(pool_connections=1, pool_maxsize=self.session_connections_per_host,
+                                             pool_block=True)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[key] = session
+            return session
+
+    def get_async_client(self, base_url, user, password):
+        """获取连接到指定服务器的共享异步客户端（使用分配给异步客户端的连接数）"""
+        parsed = urlparse(base_url)
+        key = (parsed.scheme, parsed.netloc, user)
+        session = self.get_session(base_url, user, password)
+        with self._sessions_lock:
+            client = self._async_clients.get(key)
+            if client is None:
+                client = AsyncLoopThread.get().run(self._create_async_client(user, password, session))
+                self._async_clients[key] = client
+            return client
+
+    async def _create_async_client(self, user, password, session=None):
+        return AsyncWebDAVClient(user, password, max_connections=self.async_connections_per_host, session=session)
+
+    def run_job(self, job):
+        """执行单个备份任务，返回退出码"""
+        if isinstance(sys.stdout, JobOutput):
+            sys.stdout.set_job(job["name"])
+        settings = {key: job.get(key, globals()[name]) for key, name in JOB_SETTINGS.items()}
+        try:
+            server = (settings["webdav_base_url"], settings["webdav_user"], settings["webdav_pass"])
+            backup = WebDAVBackup(job, session=self.get_session(*server), async_client=self.get_async_client(*server))
+            backup.stage_slots = self._stage_slots
+            return backup.run_once()
+        except Exception as e:
+            print(f"错误：备份任务执行失败！")
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            return 1
+        finally:
+            sys.stdout.flush()
+
+    def run(self):
+        """并发执行全部备份任务，全部成功时返回0，否则返回1"""
+        print(f"共 {len(self.jobs)} 个备份任务（压缩并发: {self.compression_concurrency}，"
+              f"上传并发: {self.upload_concurrency}，每个服务器最多 {self.max_connections_per_host} 个连接：上传 {self.session_connections_per_host} 个，"
+              f"校验和清理 {self.async_connections_per_host} 个）")
+        original_stdout = sys.stdout
+        sys.stdout = JobOutput(original_stdout)
+        try:
+            with ThreadPoolExecutor(max_workers=len(self.jobs), thread_name_prefix="backup-job") as pool:
+                results = list(pool.map(self.run_job, self.jobs))
+        finally:
+            sys.stdout = original_stdout
+        
+        failed = [job["name"] for job, code in zip(self.jobs, results) if code != 0]
+        print(f"备份任务全部结束：成功 {len(self.jobs) - len(failed)} 个，失败 {len(failed)} 个")
+        if failed:
+            print(f"失败的任务: {', '.join(failed)}")
+            return 1
+        return 0
+
+
+class BackupDaemon:
+    """守护进程模式：常驻运行并监视各任务的源目录，检测到变化且经过防抖等待后执行备份；
+    会话和连接池在多次备份之间保持，备份失败时只记录错误并在稍后重试，进程不退出"""
+
+    def __init__(self, jobs=None):
+        self.jobs = list(jobs or [])
+        # 多任务模式由调度器执行备份（共享会话、限制各阶段并发）；单任务模式保留第一次备份创建的会话和异步客户端
+        self.scheduler = BackupScheduler(self.jobs) if self.jobs else None
+        self._session = None
+        self._async_client = None
+        self._stopping = False
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_write, False)
+
+    def job_settings(self, job):
+        """任务的配置（未填写的项使用全局配置），单任务模式下job为None"""
+        return {key: (job or {}).get(key, globals()[name]) for key, name in JOB_SETTINGS.items()}
+
+    def create_watcher(self, job):
+        """创建监视任务源目录的对象：inotify不可用（非Linux、达到监视数量上限等）时改用轮询"""
+        settings = self.job_settings(job)
+        source_dir = settings["source_dir"]
+        rules = ExcludeRules.from_config(settings["exclude_patterns"], EXCLUDE_FROM_FILE)
+        ignore = (settings["local_backup_dir"], SNAPSHOT_DIR)
+        if DAEMON_WATCH_MODE != "poll" and not os.path.isdir(source_dir):
+            print(f"注意：源目录 {source_dir} 不存在，每 {DAEMON_POLL_INTERVAL_SECONDS} 秒检查一次，出现后再监视其中的变化")
+        elif DAEMON_WATCH_MODE != "poll":
+            try:
+                watcher = InotifyWatcher(source_dir, rules, ignore)
+                print(f"使用inotify监视源目录 {source_dir}（{watcher.watch_count} 个目录）")
+                return watcher
+            except OSError as e:
+                if DAEMON_WATCH_MODE == "inotify":
+                    raise
+                print(f"注意：无法使用inotify监视源目录 {source_dir}（{str(e)}），改为每 {DAEMON_POLL_INTERVAL_SECONDS} 秒扫描一次")
+        else:
+            print(f"每 {DAEMON_POLL_INTERVAL_SECONDS} 秒扫描一次源目录 {source_dir}")
+        return PollingWatcher(source_dir, rules, ignore)
+    
+    def rewatch(self, state):
+        """监视失效（源目录被删除或移动）或出错时重新建立监视；源目录暂时不存在时以轮询方式等待其出现"""
+        state["watcher"].close()
+        settings = self.job_settings(state["job"])
+        state["source_missing"] = not os.path.isdir(settings["source_dir"])
+        try:
+            state["watcher"] = self.create_watcher(state["job"])
+        except OSError as e:
+            print(f"警告：无法使用inotify监视源目录（{str(e)}），改为每 {DAEMON_POLL_INTERVAL_SECONDS} 秒扫描一次")
+            state["watcher"] = PollingWatcher(settings["source_dir"],
+                                              ExcludeRules.from_config(settings["exclude_patterns"], EXCLUDE_FROM_FILE),
+                                              (settings["local_backup_dir"], SNAPSHOT_DIR))
+
+    def run_backup(self, job):
+        """执行一次备份，返回退出码；任何错误都不会结束守护进程"""
+        if job is not None:
+            return self.scheduler.run_job(job)
+        try:
+            backup = WebDAVBackup(session=self._session, async_client=self._async_client)
+            self._session, self._async_client = backup.session, backup.async_client
+            return backup.run_once()
+        except Exception as e:
+            print(f"错误：备份任务执行失败！")
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            return 1
+        finally:
+            sys.stdout.flush()
+
+    def stop(self, signum=None, frame=None):
+        """请求停止（信号处理函数）：正在执行的备份完成后退出，再次收到信号时立即中断"""
+        if self._stopping:
+            raise KeyboardInterrupt
+        self._stopping = True
+        with contextlib.suppress(OSError):
+            os.write(self._wakeup_write, b"\0")
+
+    def is_due(self, state, now):
+        """判断任务是否应开始备份：有待备份的变化、防抖等待已结束，且不在失败重试或最小间隔的等待中"""
+        if state["pending_since"] is None:
+            return False
+        if now < state["retry_at"] or now - state["last_backup"] < DAEMON_MIN_INTERVAL_SECONDS:
+            return False
+        return (now - state["last_change"] >= DAEMON_DEBOUNCE_SECONDS
+                or now - state["pending_since"] >= DAEMON_MAX_DELAY_SECONDS)
+
+    def next_deadline(self, state, now):
+        """返回距任务可能开始备份的秒数，不需要备份时返回None"""
+        if state["pending_since"] is None:
+            if DAEMON_MAX_INTERVAL_SECONDS:
+                return max(0.0, state["last_backup"] + DAEMON_MAX_INTERVAL_SECONDS - now)
+            return None
+        ready = min(state["last_change"] + DAEMON_DEBOUNCE_SECONDS, state["pending_since"] + DAEMON_MAX_DELAY_SECONDS)
+        ready = max(ready, state["retry_at"], state["last_backup"] + DAEMON_MIN_INTERVAL_SECONDS)
+        return max(0.0, ready - now)
+
+    def run(self):
+        """运行守护进程直到收到SIGTERM/SIGINT，返回退出码"""
+        jobs = self.jobs or [None]
+        # 输出中各任务的前缀（单任务模式下为空）
+        names = [f"[{job['name']}] " if job is not None else "" for job in jobs]
+        print(f"守护进程已启动，共 {len(jobs)} 个备份任务（防抖等待 {DAEMON_DEBOUNCE_SECONDS} 秒，"
+              f"最长等待 {DAEMON_MAX_DELAY_SECONDS} 秒，最小间隔 {DAEMON_MIN_INTERVAL_SECONDS} 秒）")
+        previous_handlers = {signum: signal.signal(signum, self.stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+        
+        original_stdout = sys.stdout
+        if self.jobs:
+            sys.stdout = JobOutput(original_stdout)
+        now = time.monotonic()
+        states = []
+        try:
+            for job in jobs:
+                if isinstance(sys.stdout, JobOutput):
+                    sys.stdout.set_job(job["name"])
+                states.append({
+                    "job": job,
+                    "watcher": self.create_watcher(job),
+                    "source_missing": not os.path.isdir(self.job_settings(job)["source_dir"]),
+                    # 第一次检测到尚未备份的变化的时间、最后一次变化的时间
+                    "pending_since": now if DAEMON_BACKUP_ON_START else None,
+                    "last_change": now - DAEMON_DEBOUNCE_SECONDS if DAEMON_BACKUP_ON_START else now,
+                    "last_backup": now - DAEMON_MIN_INTERVAL_SECONDS,
+                    "retry_at": now,
+                })
+            if isinstance(sys.stdout, JobOutput):
+                sys.stdout.set_job(None)
+            sys.stdout.flush()
+            
+            while not self._stopping:
+                now = time.monotonic()
+                due = [state for state in states if self.is_due(state, now)]
+                if due:
+                    self.run_due(due, names, states)
+                    continue
+                
+                # 等待监视事件、轮询时间或下一个备份时间
+                waits = [wait for state in states for wait in (self.next_deadline(state, now), state["watcher"].timeout())
+                         if wait is not None]
+                timeout = min(waits) if waits else None
+                fds = [state["watcher"].fileno() for state in states if state["watcher"].fileno() is not None]
+                readable, _, _ = select.select(fds + [self._wakeup_read], [], [], timeout)
+                if self._wakeup_read in readable:
+                    with contextlib.suppress(BlockingIOError):
+                        os.read(self._wakeup_read, 64)
+                
+                now = time.monotonic()
+                for state, name in zip(states, names):
+                    self.poll_changes(state, name, now)
+                    if (state["pending_since"] is None and DAEMON_MAX_INTERVAL_SECONDS
+                            and now - state["last_backup"] >= DAEMON_MAX_INTERVAL_SECONDS):
+                        print(f"{name}距上次备份已超过 {DAEMON_MAX_INTERVAL_SECONDS} 秒，执行定期备份")
+                        state["pending_since"] = state["last_change"] = now - DAEMON_DEBOUNCE_SECONDS
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+            for state in states:
+                state["watcher"].close()
+            sys.stdout = original_stdout
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
+        print("守护进程已停止")
+        return 0
+
+    def poll_changes(self, state, name, now):
+        """读取任务源目录的变化；监视失效或出错（如达到inotify监视数量上限）时重新建立监视，必要时改用轮询"""
+        try:
+            changed = state["watcher"].check()
+        except OSError as e:
+            print(f"{name}警告：监视源目录时发生错误（{str(e)}），重新建立监视")
+            self.rewatch(state)
+            changed = True
+        if not changed:
+            return
+        # 源目录不存在时以轮询方式等待，重新出现后恢复使用inotify
+        if state.get("source_missing") and os.path.isdir(self.job_settings(state["job"])["source_dir"]):
+            self.rewatch(state)
+        if state["pending_since"] is None:
+            state["pending_since"] = now
+            print(f"{name}检测到源目录变化，{DAEMON_DEBOUNCE_SECONDS} 秒内没有新的变化后开始备份")
+        state["last_change"] = now
+
+    def run_due(self, due, names, states):
+        """执行到期任务的备份（多个任务同时到期时并发执行），并更新各任务的状态"""
+        for state in due:
+            print(f"{names[states.index(state)]}{datetime.datetime.now():%Y-%m-%d %H:%M:%S} 开始备份")
+            # 备份期间发生的变化会在之后读取到，重新进入待备份状态
+            state["pending_since"] = None
+        sys.stdout.flush()
+        if len(due) == 1:
+            codes = [self.run_backup(due[0]["job"])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(due), thread_name_prefix="backup-job") as pool:
+                codes = list(pool.map(self.run_backup, [state["job"] for state in due]))
+        if isinstance(sys.stdout, JobOutput):
+            sys.stdout.set_job(None)
+        now = time.monotonic()
+        for state, code in zip(due, codes):
+            name = names[states.index(state)]
+            state["last_backup"] = now
+            if code == 0:
+                print(f"{name}备份完成，继续监视源目录")
+            else:
+                # 失败的备份保持待备份状态，等待一段时间后重试
+                state["pending_since"] = state["pending_since"] or now - DAEMON_DEBOUNCE_SECONDS
+                state["last_change"] = min(state["last_change"], now - DAEMON_DEBOUNCE_SECONDS)
+                state["retry_at"] = now + DAEMON_RETRY_DELAY_SECONDS
+                print(f"{name}备份失败（退出码 {code}），{DAEMON_RETRY_DELAY_SECONDS} 秒后重试")
+        sys.stdout.flush()
 
 
 if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="增强版WebDAV备份脚本，不带参数运行时执行完整的备份流程")
+    subparsers = parser.add_subparsers(dest="command")
+    bench_parser = subparsers.add_parser("benchmark-compression", help="测试单线程与并行压缩的吞吐量")
+    bench_parser.add_argument("source", nargs="?", help="用于测试的目录（默认使用SOURCE_DIR）")
+    bench_parser.add_argument("--workers", type=int, default=0, help="并行线程数，0表示使用全部CPU核心")
+    restore_parser = subparsers.add_parser("restore", help="列出或恢复远程备份中的文件（只下载所需的数据范围）")
+    restore_parser.add_argument("paths", nargs="*", help="要恢复的文件或目录（压缩包内路径，如 docs/a.txt），不填表示全部")
+    restore_parser.add_argument("--backup", help="备份文件名或去重存储的快照名（默认使用最新的备份）")
+    restore_parser.add_argument("--list", action="store_true", help="只列出文件，不恢复")
+    restore_parser.add_argument("--target", default=".", help="恢复到的目录（默认为当前目录）")
+    restore_parser.add_argument("--job", help="多任务模式下使用的任务名称")
+    retention_parser = subparsers.add_parser("retention", help="试运行保留策略：列出WebDAV上和本地将要删除的旧备份及可释放的空间，不实际删除")
+    retention_parser.add_argument("--job", help="多任务模式下使用的任务名称")
+    subparsers.add_parser("daemon", help="以守护进程方式常驻运行：监视源目录，有变化时自动备份（配置BACKUP_JOBS时监视全部任务）")
+    decrypt_parser = subparsers.add_parser("decrypt", help="解密本地的加密备份文件（使用配置的密钥文件或口令）")
+    decrypt_parser.add_argument("input", help="加密的备份文件（文件名以.enc结尾）")
+    decrypt_parser.add_argument("output", nargs="?", help="输出文件（默认去掉.enc后缀）")
+    args = parser.parse_args()
+    
+    if args.command == "decrypt":
+        output_path = args.output or (args.input[:-len(ENCRYPTED_SUFFIX)] if args.input.endswith(ENCRYPTED_SUFFIX)
+                                      else args.input + ".decrypted")
+        try:
+            decrypted_size = decrypt_backup_file(args.input, output_path, EncryptionKey.from_config())
+        except (ImportError, ValueError, OSError) as e:
+            print(f"错误：解密失败！")
+            print(f"详细错误：{str(e) or type(e).__name__}")
+            sys.exit(1)
+        print(f"解密完成: {output_path}（{decrypted_size / 1024 / 1024:.2f} MB）")
+        sys.exit(0)
+    
+    job = None
+    if getattr(args, "job", None):
+        job = next((job for job in BACKUP_JOBS if job.get("name") == args.job), None)
+        if job is None:
+            print(f"错误：没有找到名为 {args.job} 的备份任务")
+            sys.exit(1)
+    
+    if args.command == "restore":
+        restore_script = WebDAVBackup(job=job)
+        sys.exit(0 if restore_script.restore(args.backup, args.paths, args.target, args.list) else 1)
+    
+    if args.command == "retention":
+        RETENTION_DRY_RUN = True
+        retention_script = WebDAVBackup(job=job)
+        if ENABLE_DEDUP_STORE:
+            retention_script.clean_dedup_store()
+        else:
+            retention_script.clean_remote_backups(None)
+            if os.path.isdir(retention_script.local_backup_dir):
+                retention_script.clean_local_backups(None)
+        sys.exit(0)
+    
+    if args.command == "daemon":
+        sys.exit(BackupDaemon(BACKUP_JOBS).run())
+    
     backup_script = WebDAVBackup()
-    backup_script.run()
\ No newline at end of file
+    if args.command == "benchmark-compression":
+        if args.source:
+            backup_script.source_dir = args.source
+        backup_script.benchmark_compression(args.workers)
+    elif BACKUP_JOBS:
+        sys.exit(BackupScheduler(BACKUP_JOBS).run())
+    else:
+        backup_script.run()
\ No newline at end of file
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WebDAV备份性能测试工具
+
+生成合成测试目录（大量小文件、少量大文件、可压缩与不可压缩混合），对进程内的本地WebDAV服务器
+（可模拟网络延迟和带宽）执行完整的备份流程，输出各阶段的耗时、吞吐量、系统调用次数和内存峰值（JSON格式）。
+每次备份在单独的子进程中执行，内存峰值和系统调用次数只包含备份本身，不包含服务器和测试目录的生成。
+
+用法：
+    python3 webdav_benchmark.py
+    python3 webdav_benchmark.py --profiles small,mixed --size-mb 512 --latency-ms 20 --bandwidth 50M
+    python3 webdav_benchmark.py --set BACKUP_FORMAT=tar.zst --set COMPRESSION_WORKERS=4 --output result.json
+
+--set 可覆盖 webdav_backup.py 中的任意配置参数，值按Python字面量解析（解析失败时作为字符串）。
+系统调用次数和读写字节数来自 /proc/self/io（仅Linux），是整个进程的计数，阶段同时进行时会重复计入。
+"""
+
+import os
+import sys
+import ast
+import json
+import math
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import functools
+import inspect
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import webdav_backup
+import webdav_local_server
+
+
+# 测试目录类型：small=大量小文件，large=少量大文件，mixed=文本、图片、二进制混合（大小按对数正态分布）
+PROFILES = ("small", "large", "mixed")
+
+# 计时的备份方法及对应的阶段名称
+STAGE_METHODS = (
+    ("get_source_manifest", "scan"),
+    ("plan_backup", "plan"),
+    ("create_source_snapshot", "snapshot"),
+    ("create_backup_file", "compress"),
+    ("async_create_webdav_directories", "mkdir"),
+    ("upload_to_webdav", "upload"),
+    ("stream_backup_to_webdav", "stream"),
+    ("check_integrity", "integrity"),
+    ("upload_archive_index", "index_upload"),
+    ("clean_remote_backups", "clean_remote"),
+    ("clean_local_backups", "clean_local"),
+)
+
+# 计算吞吐量时各阶段处理的数据量：source=源目录大小，archive=压缩包大小
+STAGE_BYTES = {
+    "scan": "source",
+    "snapshot": "source",
+    "compress": "source",
+    "stream": "source",
+    "upload": "archive",
+    "integrity": "archive",
+}
+
+# 文本文件使用的词表（生成的内容与普通文本的压缩率接近）
+WORDS = ("backup", "webdav", "server", "upload", "archive", "the", "of", "and", "to", "in", "is", "for",
+         "file", "directory", "data", "config", "error", "warning", "info", "request", "response", "time",
+         "2024-01-01", "12:00:00", "user", "id", "value", "status", "OK", "200", "404", "GET", "PUT",
+         "import", "def", "return", "class", "self", "None", "True", "False", "=", "(", ")", ":", "{", "}")
+
+WRITE_CHUNK = 1024 * 1024
+
+
+class TreeGenerator:
+    """按固定随机种子生成测试目录，相同参数的目录只生成一次"""
+
+    def __init__(self, root, profile, size_mb, small_files, large_files, seed):
+        self.root = root
+        self.profile = profile
+        self.total_bytes = int(size_mb * 1024 * 1024)
+        self.small_files = small_files
+        self.large_files = large_files
+        self.rng = random.Random(f"{profile}-{seed}")
+        self.corpus = None
+        self.files = 0
+        self.bytes = 0
+
+    def text_corpus(self):
+        """生成4MB的文本语料，文本文件从中随机截取"""
+        if self.corpus is None:
+            lines = []
+            size = 0
+            while size < 4 * 1024 * 1024:
+                line = " ".join(self.rng.choices(WORDS, k=self.rng.randint(4, 16)))
+                lines.append(line)
+                size += len(line) + 1
+            self.corpus = ("\n".join(lines) + "\n").encode()
+        return self.corpus
+
+    def text_data(self, size):
+        corpus = self.text_corpus()
+        start = self.rng.randrange(len(corpus))
+        data = corpus[start:start + size]
+        while len(data) < size:
+            data += corpus[:size - len(data)]
+        return data
+
+    def write_file(self, rel_path, size, kind):
+        """写入单个文件，kind为text（可压缩）、random（不可压缩）或half（前半随机、后半为零）"""
+        path = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            written = 0
+            while written < size:
+                length = min(WRITE_CHUNK, size - written)
+                if kind == "text":
+                    f.write(self.text_data(length))
+                elif kind == "random" or (kind == "half" and written < size // 2):
+                    f.write(self.rng.randbytes(length))
+                else:
+                    f.write(bytes(length))
+                written += length
+        self.files += 1
+        self.bytes += size
+
+    def generate(self):
+        getattr(self, f"generate_{self.profile}")()
+        return {"files": self.files, "bytes": self.bytes}
+
+    def generate_small(self):
+        """大量小文件：每个目录50个文件，80%为文本，20%为随机数据"""
+        average = max(self.total_bytes // self.small_files, 1)
+        for index in range(self.small_files):
+            size = self.rng.randint(average // 2, average * 3 // 2)
+            kind = "text" if self.rng.random() < 0.8 else "random"
+            directory = os.path.join(f"d{index // 2500:03d}", f"s{index // 50 % 50:02d}")
+            extension = ".txt" if kind == "text" else ".dat"
+            self.write_file(os.path.join(directory, f"f{index:06d}{extension}"), size, kind)
+
+    def generate_large(self):
+        """少量大文件：文本和随机数据交替"""
+        size = self.total_bytes // self.large_files
+        for index in range(self.large_files):
+            kind = "text" if index % 2 == 0 else "random"
+            extension = ".log" if kind == "text" else ".bin"
+            self.write_file(f"large{index:02d}{extension}", size, kind)
+
+    def generate_mixed(self):
+        """混合目录：60%文本（约16KB），30%图片（约1MB，不可压缩），10%二进制（约8MB，一半为零）"""
+        kinds = (("text", ".txt", 16 * 1024), ("random", ".jpg", 1024 * 1024), ("half", ".bin", 8 * 1024 * 1024))
+        index = 0
+        while self.bytes < self.total_bytes:
+            kind, extension, median = self.rng.choices(kinds, weights=(60, 30, 10))[0]
+            size = int(self.rng.lognormvariate(math.log(median), 1.0))
+            size = max(1, min(size, 64 * 1024 * 1024, self.total_bytes - self.bytes))
+            directory = os.path.join(f"m{index // 200:03d}", kind)
+            self.write_file(os.path.join(directory, f"f{index:06d}{extension}"), size, kind)
+            index += 1
+
+
+def prepare_tree(work_dir, profile, args):
+    """生成（或复用已生成的）测试目录，返回 (目录路径, 统计信息)"""
+    name = f"{profile}-{args.size_mb}mb-{args.small_files}-{args.large_files}-{args.seed}"
+    tree_dir = os.path.join(work_dir, "trees", name)
+    meta_path = tree_dir + ".json"
+    if os.path.isdir(tree_dir) and os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return tree_dir, json.load(f)
+
+    shutil.rmtree(tree_dir, ignore_errors=True)
+    log(f"生成测试目录: {tree_dir}")
+    start = time.time()
+    meta = TreeGenerator(tree_dir, profile, args.size_mb, args.small_files, args.large_files, args.seed).generate()
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    log(f"生成完成: {meta['files']} 个文件，{meta['bytes'] / 1024 / 1024:.1f} MB，耗时 {time.time() - start:.1f} 秒")
+    return tree_dir, meta
+
+
+def parse_override(text):
+    """解析 KEY=VALUE 形式的配置覆盖，值按Python字面量解析，失败时作为字符串"""
+    if "=" not in text:
+        raise argparse.ArgumentTypeError(f"格式应为 KEY=VALUE: {text}")
+    key, value = text.split("=", 1)
+    key = key.strip()
+    if not hasattr(webdav_backup, key) or not key.isupper():
+        raise argparse.ArgumentTypeError(f"未知的配置参数: {key}")
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return key, value
+
+
+def read_proc_io():
+    """读取 /proc/self/io 中的系统调用次数和读写字节数，不支持时返回空字典"""
+    try:
+        with open("/proc/self/io", "r") as f:
+            return {key: int(value) for key, value in (line.split(":") for line in f)}
+    except OSError:
+        return {}
+
+
+def peak_rss_kb():
+    """返回当前进程的内存峰值（KB）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS上ru_maxrss的单位是字节
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+class StageRecorder:
+    """包装备份对象的各阶段方法，累计每个阶段的调用次数、耗时、CPU时间和系统调用次数"""
+
+    IO_FIELDS = (("syscr", "read_syscalls"), ("syscw", "write_syscalls"), ("rchar", "read_bytes"), ("wchar", "write_bytes"))
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def attach(self, backup):
+        for method_name, stage in STAGE_METHODS:
+            method = getattr(backup, method_name, None)
+            if method is not None:
+                setattr(backup, method_name, self.wrap(method, stage))
+
+    def wrap(self, method, stage):
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                start = self.sample()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    self.record(stage, start)
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = self.sample()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(stage, start)
+        return wrapper
+
+    def sample(self):
+        return time.perf_counter(), time.process_time(), read_proc_io()
+
+    def record(self, stage, start):
+        end = self.sample()
+        with self.lock:
+            stats = self.stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "cpu_seconds": 0.0})
+            stats["calls"] += 1
+            stats["seconds"] += end[0] - start[0]
+            stats["cpu_seconds"] += end[1] - start[1]
+            for field, name in self.IO_FIELDS:
+                if field in start[2] and field in end[2]:
+                    stats[name] = stats.get(name, 0) + end[2][field] - start[2][field]
+
+
+def run_worker(spec_path):
+    """子进程入口：按spec配置执行一次完整备份，把测量结果写入spec中的result_path"""
+    with open(spec_path, "r", encoding="utf-8") as f:
+        spec = json.load(f)
+    for key, value in spec["overrides"].items():
+        setattr(webdav_backup, key, value)
+
+    recorder = StageRecorder()
+    start_io = read_proc_io()
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    exit_code = 0
+    try:
+        backup = webdav_backup.WebDAVBackup()
+        recorder.attach(backup)
+        backup.run()
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        print(f"错误：备份过程中发生异常！\n详细错误：{str(e)}")
+        exit_code = 1
+    end_io = read_proc_io()
+
+    result = {
+        "exit_code": exit_code,
+        "wall_seconds": time.perf_counter() - start,
+        "cpu_seconds": time.process_time() - start_cpu,
+        "peak_rss_kb": peak_rss_kb(),
+        "stages": recorder.stages,
+        "syscalls": {name: end_io[field] - start_io[field]
+                     for field, name in StageRecorder.IO_FIELDS if field in start_io and field in end_io},
+    }
+    with open(spec["result_path"], "w", encoding="utf-8") as f:
+        json.dump(result, f)
+    return 0
+
+
+def find_archive_size(upload_dir, prefix):
+    """返回上传目录中备份文件的总大小（不含随机访问索引），分片上传的目录按分片合计"""
+    total = 0
+    if not os.path.isdir(upload_dir):
+        return 0
+    for name in os.listdir(upload_dir):
+        if not name.startswith(prefix) or name.endswith(webdav_backup.ARCHIVE_INDEX_SUFFIX):
+            continue
+        path = os.path.join(upload_dir, name)
+        if os.path.isdir(path):
+            total += sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+        else:
+            total += os.path.getsize(path)
+    return total
+
+
+def summarize(result, meta, archive_bytes):
+    """根据阶段处理的数据量计算吞吐量（MB/s）"""
+    sizes = {"source": meta["bytes"], "archive": archive_bytes}
+    for stage, stats in result["stages"].items():
+        kind = STAGE_BYTES.get(stage)
+        if kind is None:
+            continue
+        stats["bytes"] = sizes[kind]
+        stats["mb_per_second"] = round(sizes[kind] / 1024 / 1024 / stats["seconds"], 2) if stats["seconds"] > 0 else None
+    for stats in result["stages"].values():
+        stats["seconds"] = round(stats["seconds"], 4)
+        stats["cpu_seconds"] = round(stats["cpu_seconds"], 4)
+    result["wall_seconds"] = round(result["wall_seconds"], 3)
+    result["cpu_seconds"] = round(result["cpu_seconds"], 3)
+    result["source_files"] = meta["files"]
+    result["source_bytes"] = meta["bytes"]
+    result["archive_bytes"] = archive_bytes
+    result["compression_ratio"] = round(archive_bytes / meta["bytes"], 4) if meta["bytes"] else None
+    result["mb_per_second"] = round(meta["bytes"] / 1024 / 1024 / result["wall_seconds"], 2) if result["wall_seconds"] else None
+
+
+def run_benchmark(args):
+    work_dir = args.work_dir or os.path.join(tempfile.gettempdir(), "webdav_benchmark")
+    dav_root = os.path.join(work_dir, "dav")
+    shutil.rmtree(dav_root, ignore_errors=True)
+    server = webdav_local_server.start(dav_root, latency=args.latency_ms / 1000, bandwidth=args.bandwidth)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    log(f"本地WebDAV服务器: {base_url}（延迟 {args.latency_ms} 毫秒，带宽 {args.bandwidth or '不限制'}）")
+
+    # 关闭邮件通知和上传限速（带宽由服务器模拟），其余使用脚本配置，再应用 --set 覆盖
+    overrides = {
+        "BACKUP_JOBS": [],
+        "ENABLE_EMAIL_NOTIFICATION": False,
+        "SMALL_FILE_RATE_LIMIT": "",
+        "LARGE_FILE_RATE_LIMIT": "",
+    }
+    overrides.update(dict(args.set))
+
+    runs = []
+    try:
+        for profile in args.profiles:
+            source_dir, meta = prepare_tree(work_dir, profile, args)
+            for repeat in range(1, args.repeat + 1):
+                run_name = f"{profile}-{repeat}"
+                local_dir = os.path.join(work_dir, "local", run_name)
+                upload_dir = f"bench/{run_name}"
+                shutil.rmtree(local_dir, ignore_errors=True)
+                shutil.rmtree(os.path.join(dav_root, "bench", run_name), ignore_errors=True)
+                spec = {
+                    "overrides": dict(overrides, SOURCE_DIR=source_dir, LOCAL_BACKUP_DIR=local_dir,
+                                      WEBDAV_BASE_URL=base_url, WEBDAV_UPLOAD_DIR=upload_dir),
+                    "result_path": os.path.join(work_dir, f"{run_name}.result.json"),
+                }
+                spec_path = os.path.join(work_dir, f"{run_name}.spec.json")
+                with open(spec_path, "w", encoding="utf-8") as f:
+                    json.dump(spec, f)
+
+                log(f"开始测试: {run_name}")
+                server.request_counts.clear()
+                log_path = os.path.join(work_dir, f"{run_name}.log")
+                with open(log_path, "w", encoding="utf-8") as log_file:
+                    output = None if args.verbose else log_file
+                    subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", spec_path],
+                                   stdout=output, stderr=subprocess.STDOUT if output else None)
+                try:
+                    with open(spec["result_path"], "r", encoding="utf-8") as f:
+                        result = json.load(f)
+                except (OSError, ValueError):
+                    result = {"exit_code": None, "stages": {}, "error": f"测试进程没有输出结果，请查看 {log_path}"}
+                    runs.append(dict(result, profile=profile, repeat=repeat))
+                    log(f"错误：{run_name} 测试失败，请查看 {log_path}")
+                    continue
+
+                archive_bytes = find_archive_size(os.path.join(dav_root, upload_dir), webdav_backup.BACKUP_PREFIX)
+                summarize(result, meta, archive_bytes)
+                result["http_requests"] = dict(server.request_counts)
+                runs.append(dict(profile=profile, repeat=repeat, **result))
+                if result["exit_code"] != 0:
+                    log(f"警告：{run_name} 备份退出码为 {result['exit_code']}，请查看 {log_path}")
+                log(f"完成: {run_name} 耗时 {result['wall_seconds']} 秒，{result['mb_per_second']} MB/s，"
+                    f"内存峰值 {(result['peak_rss_kb'] or 0) / 1024:.1f} MB，压缩率 {result['compression_ratio']}")
+                for stage, stats in result["stages"].items():
+                    rate = f"，{stats['mb_per_second']} MB/s" if stats.get("mb_per_second") else ""
+                    log(f"  {stage:<13} {stats['seconds']:>9.3f} 秒{rate}")
+
+                if not args.keep:
+                    shutil.rmtree(local_dir, ignore_errors=True)
+                    shutil.rmtree(os.path.join(dav_root, "bench", run_name), ignore_errors=True)
+    finally:
+        server.shutdown()
+
+    report = {
+        "config": {
+            "profiles": args.profiles,
+            "size_mb": args.size_mb,
+            "small_files": args.small_files,
+            "large_files": args.large_files,
+            "seed": args.seed,
+            "latency_ms": args.latency_ms,
+            "bandwidth": args.bandwidth,
+            "overrides": dict(args.set),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "runs": runs,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        log(f"测试结果已保存: {args.output}")
+    else:
+        print(text)
+    return 0 if all(run["exit_code"] == 0 for run in runs) else 1
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "--worker":
+        return run_worker(sys.argv[2])
+
+    parser = argparse.ArgumentParser(description="对本地WebDAV服务器执行完整备份流程，输出各阶段的吞吐量、内存峰值和系统调用次数")
+    parser.add_argument("--profiles", default=",".join(PROFILES),
+                        type=lambda value: [item.strip() for item in value.split(",") if item.strip()],
+                        help="测试目录类型，逗号分隔：small（大量小文件）、large（少量大文件）、mixed（混合），默认全部")
+    parser.add_argument("--size-mb", type=int, default=256, help="每个测试目录的总大小（MB），默认256")
+    parser.add_argument("--small-files", type=int, default=20000, help="small目录的文件数，默认20000")
+    parser.add_argument("--large-files", type=int, default=4, help="large目录的文件数，默认4")
+    parser.add_argument("--seed", type=int, default=1, help="生成测试目录的随机种子，相同参数的目录会复用")
+    parser.add_argument("--repeat", type=int, default=1, help="每种目录重复测试的次数")
+    parser.add_argument("--latency-ms", type=float, default=0, help="模拟每个请求的网络延迟（毫秒）")
+    parser.add_argument("--bandwidth", help="模拟带宽，如 50M 表示50MB/s（默认不限制）")
+    parser.add_argument("--set", action="append", default=[], type=parse_override, metavar="KEY=VALUE",
+                        help="覆盖webdav_backup.py中的配置参数，可多次指定")
+    parser.add_argument("--work-dir", help="测试目录、备份文件和日志的保存目录（默认为临时目录下的webdav_benchmark）")
+    parser.add_argument("--output", help="测试结果（JSON）的保存路径，默认输出到标准输出")
+    parser.add_argument("--keep", action="store_true", help="保留每次测试生成的本地备份和上传的文件")
+    parser.add_argument("--verbose", action="store_true", help="显示备份过程的输出（默认写入工作目录下的日志文件）")
+    args = parser.parse_args()
+
+    unknown = [profile for profile in args.profiles if profile not in PROFILES]
+    if unknown:
+        parser.error(f"未知的测试目录类型: {', '.join(unknown)}")
+    return run_benchmark(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
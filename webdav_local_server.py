@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地WebDAV服务器（用于在没有真实WebDAV服务器时调试备份脚本）
+
+在进程内以线程方式运行，将请求映射到本地目录，支持备份脚本用到的方法：
+PUT（含Content-Range分段写入）、GET（含Range范围请求）、HEAD、DELETE、MKCOL、MOVE、PROPFIND。
+不做身份验证，也不实现锁等完整的WebDAV语义，只能用于本机调试。
+可模拟网络延迟（每个请求固定等待）和带宽（所有连接共享，上传和下载合计），用于性能测试。
+
+用法：
+    python3 webdav_local_server.py /tmp/webdav_root 8080
+或在Python中：
+    server = start("/tmp/webdav_root")
+    url = f"http://127.0.0.1:{server.server_port}"
+"""
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import threading
+import email.utils
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import quote, unquote, urlparse
+from xml.sax.saxutils import escape
+
+
+class WebDAVRequestHandler(BaseHTTPRequestHandler):
+    """处理单个WebDAV请求，文件保存在server.root目录下"""
+
+    protocol_version = "HTTP/1.1"
+    # 读写请求体和响应体的块大小，模拟带宽时按块等待
+    CHUNK_SIZE = 64 * 1024
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        self.server.request_counts[self.command] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        return True
+
+    def _local_path(self, url_path=None):
+        path = unquote(urlparse(url_path or self.path).path)
+        parts = [part for part in path.split('/') if part not in ('', '.', '..')]
+        return os.path.join(self.server.root, *parts)
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            view = memoryview(body)
+            for start in range(0, len(body), self.CHUNK_SIZE):
+                self.server.throttle(min(self.CHUNK_SIZE, len(body) - start))
+                self.wfile.write(view[start:start + self.CHUNK_SIZE])
+
+    def _read_body(self):
+        """读取请求体，支持Content-Length和分块传输编码"""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                self.server.throttle(size)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            return bytes(body)
+        body = bytearray()
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining > 0:
+            data = self.rfile.read(min(self.CHUNK_SIZE, remaining))
+            if not data:
+                break
+            self.server.throttle(len(data))
+            body += data
+            remaining -= len(data)
+        return bytes(body)
+
+    def _etag(self, stat):
+        return '"%x-%x"' % (stat.st_size, stat.st_mtime_ns)
+
+    def do_PUT(self):
+        body = self._read_body()
+        path = self._local_path()
+        if not os.path.isdir(os.path.dirname(path)):
+            return self._send(409)
+        content_range = self.headers.get("Content-Range")
+        if content_range:
+            # Content-Range: bytes start-end/total，写入到已有文件的指定位置
+            start = int(content_range.split()[1].split('-')[0])
+            with open(path, 'r+b' if os.path.exists(path) else 'w+b') as f:
+                f.seek(start)
+                f.write(body)
+            return self._send(204)
+        existed = os.path.exists(path)
+        with open(path, 'wb') as f:
+            f.write(body)
+        self._send(204 if existed else 201)
+
+    def do_GET(self):
+        path = self._local_path()
+        if os.path.isdir(path):
+            # 目录返回简单的HTML列表，与常见WebDAV服务器的浏览器视图类似
+            names = sorted(name + ('/' if os.path.isdir(os.path.join(path, name)) else '') for name in os.listdir(path))
+            body = "\n".join(f'<a href="{quote(name)}">{escape(name)}</a>' for name in names).encode('utf-8')
+            return self._send(200, body, {"Content-Type": "text/html; charset=utf-8"})
+        if not os.path.isfile(path):
+            return self._send(404)
+        stat = os.stat(path)
+        with open(path, 'rb') as f:
+            range_header = self.headers.get("Range", "")
+            if range_header.startswith("bytes=") and stat.st_size:
+                first, _, last = range_header[6:].split(',')[0].partition('-')
+                if first:
+                    start, end = int(first), int(last) if last else stat.st_size - 1
+                else:
+                    start, end = max(0, stat.st_size - int(last)), stat.st_size - 1
+                end = min(end, stat.st_size - 1)
+                if start > end:
+                    return self._send(416, headers={"Content-Range": f"bytes */{stat.st_size}"})
+                f.seek(start)
+                return self._send(206, f.read(end - start + 1), {
+                    "Content-Range": f"bytes {start}-{end}/{stat.st_size}",
+                    "ETag": self._etag(stat),
+                })
+            self._send(200, f.read(), {"ETag": self._etag(stat), "Accept-Ranges": "bytes"})
+
+    def do_HEAD(self):
+        path = self._local_path()
+        if not os.path.exists(path):
+            return self._send(404)
+        self.send_response(200)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            self.send_header("ETag", self._etag(stat))
+            self.send_header("Last-Modified", email.utils.formatdate(stat.st_mtime, usegmt=True))
+            if self.server.checksums:
+                # 模拟Nextcloud/ownCloud的OC-Checksum响应头
+                digest = hashlib.md5()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+                self.send_header("OC-Checksum", f"MD5:{digest.hexdigest()}")
+            self.send_header("Content-Length", str(stat.st_size))
+        else:
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_DELETE(self):
+        path = self._local_path()
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        else:
+            return self._send(404)
+        self._send(204)
+
+    def do_MKCOL(self):
+        self._read_body()
+        path = self._local_path().rstrip(os.sep)
+        if os.path.exists(path):
+            return self._send(405)
+        if not os.path.isdir(os.path.dirname(path)):
+            return self._send(409)
+        os.mkdir(path)
+        self._send(201)
+
+    def do_MOVE(self):
+        destination = self.headers.get("Destination")
+        if not destination:
+            return self._send(400)
+        source = self._local_path()
+        target = self._local_path(destination)
+        if self.path.rstrip('/').endswith('/.file'):
+            # Nextcloud分块上传：按分片名称顺序合并上传目录中的分片
+            upload_dir = os.path.dirname(source.rstrip(os.sep))
+            with open(target, 'wb') as out:
+                for name in sorted(name for name in os.listdir(upload_dir) if name.isdigit()):
+                    with open(os.path.join(upload_dir, name), 'rb') as part:
+                        shutil.copyfileobj(part, out)
+            shutil.rmtree(upload_dir)
+            return self._send(201)
+        if not os.path.exists(source):
+            return self._send(404)
+        existed = os.path.exists(target)
+        if existed and os.path.isdir(target):
+            shutil.rmtree(target)
+        shutil.move(source, target)
+        self._send(204 if existed else 201)
+
+    def _propstat(self, href, path):
+        stat = os.stat(path)
+        is_dir = os.path.isdir(path)
+        props = ["<d:resourcetype><d:collection/></d:resourcetype>" if is_dir else "<d:resourcetype/>"]
+        if not is_dir:
+            props.append(f"<d:getcontentlength>{stat.st_size}</d:getcontentlength>")
+        props.append(f"<d:getlastmodified>{email.utils.formatdate(stat.st_mtime, usegmt=True)}</d:getlastmodified>")
+        props.append(f"<d:getetag>{escape(self._etag(stat))}</d:getetag>")
+        if is_dir:
+            usage = shutil.disk_usage(path)
+            props.append(f"<d:quota-available-bytes>{usage.free}</d:quota-available-bytes>")
+            props.append(f"<d:quota-used-bytes>{usage.used}</d:quota-used-bytes>")
+        return (f"<d:response><d:href>{escape(quote(href))}</d:href><d:propstat><d:prop>{''.join(props)}</d:prop>"
+                f"<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>")
+
+    def do_PROPFIND(self):
+        self._read_body()
+        path = self._local_path()
+        if not os.path.exists(path):
+            return self._send(404)
+        href = unquote(urlparse(self.path).path)
+        responses = [self._propstat(href, path)]
+        if self.headers.get("Depth", "1") != "0" and os.path.isdir(path):
+            base = href.rstrip('/')
+            for name in sorted(os.listdir(path)):
+                child = os.path.join(path, name)
+                responses.append(self._propstat(f"{base}/{name}" + ('/' if os.path.isdir(child) else ''), child))
+        body = ('<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:">'
+                + "".join(responses) + "</d:multistatus>").encode('utf-8')
+        self._send(207, body, {"Content-Type": 'application/xml; charset="utf-8"'})
+
+
+class WebDAVServer(ThreadingHTTPServer):
+    """客户端读到所需数据后提前断开连接（如范围读取）属于正常情况，不输出异常信息"""
+
+    daemon_threads = True
+
+    def __init__(self, *args, latency=0.0, bandwidth=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.request_counts = Counter()
+        self._throttle_lock = threading.Lock()
+        self._throttle_until = 0.0
+
+    def throttle(self, size):
+        """按带宽等待传输size字节所需的时间（所有连接共享带宽，按到达顺序排队）"""
+        if not self.bandwidth:
+            return
+        with self._throttle_lock:
+            start = max(time.monotonic(), self._throttle_until)
+            self._throttle_until = start + size / self.bandwidth
+            wait = self._throttle_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def parse_bandwidth(value):
+    """解析带宽（字节/秒），支持K/M/G后缀，如 10M；空值表示不限制"""
+    if not value:
+        return None
+    value = str(value).strip().upper()
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def start(root, port=0, host="127.0.0.1", checksums=False, verbose=False, latency=0.0, bandwidth=None):
+    """在后台线程中启动服务器并返回服务器对象（port为0时自动选择端口，用server.server_port获取）
+
+    latency为每个请求的固定延迟（秒），bandwidth为带宽（字节/秒或带K/M/G后缀的字符串），None表示不限制
+    """
+    os.makedirs(root, exist_ok=True)
+    server = WebDAVServer((host, port), WebDAVRequestHandler, latency=latency, bandwidth=parse_bandwidth(bandwidth))
+    server.root = os.path.abspath(root)
+    server.checksums = checksums
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, name="webdav-local-server", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="在本机启动一个简易WebDAV服务器，用于调试备份脚本")
+    parser.add_argument("root", help="保存上传文件的本地目录")
+    parser.add_argument("port", type=int, nargs="?", default=8080, help="监听端口（默认8080）")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址（默认127.0.0.1）")
+    parser.add_argument("--checksums", action="store_true", help="HEAD响应中返回OC-Checksum校验和")
+    parser.add_argument("--latency-ms", type=float, default=0, help="模拟每个请求的网络延迟（毫秒）")
+    parser.add_argument("--bandwidth", help="模拟带宽，如 10M 表示10MB/s（默认不限制）")
+    args = parser.parse_args()
+
+    server = start(args.root, args.port, host=args.host, checksums=args.checksums, verbose=True,
+                   latency=args.latency_ms / 1000, bandwidth=args.bandwidth)
+    print(f"WebDAV服务器已启动: http://{args.host}:{server.server_port}/ （目录: {server.root}）")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)